@@ -0,0 +1,1078 @@
+import argparse
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial
+
+import chatconsole
+import chatlog
+import chatserver
+from chatprotocol import Deflater, FrameDecoder, encode_frame, encode_frames, encode_shared
+
+
+def make_clients(count, framed, client_class=chatserver.Client):
+    """
+    Creates clients whose connections are one end of a socket pair, so the benchmark pays for real send calls
+
+    :param count: How many clients to create
+    :param framed: True to create clients which use the framed protocol
+    :param client_class: The class of the clients
+    :return: The clients, and the sockets on the other end of their connections
+    """
+    clients = []
+    peers = []
+    channel = chatserver.Channel("bench", 0, count)
+    channel.activate()
+    for i in range(count):
+        conn, peer = socket.socketpair()
+        peer.setblocking(False)
+        decoder = chatserver.FrameDecoder() if framed else None
+        clients.append(client_class(f"user{i}", conn, channel, chatserver.CONNECTED, decoder))
+        peers.append(peer)
+    return clients, peers
+
+
+def drain(peers):
+    """
+    Reads everything waiting on the given sockets so the send buffers never fill up
+
+    :param peers: The sockets to read from
+    """
+    for peer in peers:
+        try:
+            while peer.recv(1 << 16):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def per_recipient_broadcast(name, text, client_list):
+    """
+    The fan-out as it used to be: the timestamp is formatted and the message encoded again for every recipient
+
+    :param name: The name of the sender
+    :param text: The chat message
+    :param client_list: All recipients of the message
+    """
+    message = f"[{name} ({time.strftime('%H:%M:%S')})] {text}"
+    for client in client_list:
+        client.write(message.encode('ascii'))
+    print_line = f"[{name} ({time.strftime('%H:%M:%S')})] {text}"
+    return print_line
+
+
+def shared_broadcast(name, text, client_list):
+    """
+    The current fan-out: one cached timestamp, one encode and one framed buffer shared by every recipient
+
+    :param name: The name of the sender
+    :param text: The chat message
+    :param client_list: All recipients of the message
+    """
+    line = f"[{name} ({chatserver.timestamp()})] {text}"
+    chatserver.broadcast(line, client_list)
+    return line
+
+
+def linear_check_name(name, channel):
+    """
+    The lookup as it used to be: a scan over every connected client of the channel
+
+    :param name: Name to check
+    :param channel: Channel to check in
+    """
+    for client in channel.connected:
+        if name == client.name:
+            return client
+    return name
+
+
+def linear_name_exists(name, channel):
+    """
+    The name check as it used to be: a scan over the connected clients and the queue
+
+    :param name: Name to check
+    :param channel: Channel to check in
+    """
+    for client in channel.connected:
+        if client.name == name:
+            return True
+    for client in channel.queue:
+        if client.name == name:
+            return True
+    return False
+
+
+def time_lookups(lookup, names, channel, repeat):
+    """
+    Times the given lookup over a list of names
+
+    :return: The average time of one lookup in nanoseconds
+    """
+    start = time.perf_counter()
+    for i in range(repeat):
+        for name in names:
+            lookup(name, channel)
+    return (time.perf_counter() - start) / (repeat * len(names)) * 1e9
+
+
+def bench_index(args):
+    """
+    Compares the old linear name lookups with the dictionary indexes against the number of members in a room
+    """
+    print(f"{'members':>8} {'check_name':>22} {'name_exists':>22} {'check_channel':>15}")
+    print(f"{'':>8} {'scan':>10} {'index':>11} {'scan':>10} {'index':>11} {'index':>15}")
+    for size in args.sizes:
+        channel = chatserver.Channel("bench", 0, size)
+        for i in range(size):
+            client = chatserver.Client(f"user{i}", None, channel, chatserver.CONNECTED)
+            channel.connected_names[client.name] = client
+        channel.connected = tuple(channel.connected_names.values())
+        chatserver.channel_index[channel.name] = channel
+
+        # Half of the lookups hit a member spread over the room, half miss
+        names = [f"user{i * size // 50}" for i in range(50)] + [f"missing{i}" for i in range(50)]
+        repeat = args.lookups // len(names)
+        # The scans are run fewer times in large rooms so the benchmark finishes in reasonable time
+        scan_repeat = max(1, repeat * 10 // size)
+        results = [time_lookups(linear_check_name, names, channel, scan_repeat),
+                   time_lookups(chatserver.check_name, names, channel, repeat),
+                   time_lookups(linear_name_exists, names, channel, scan_repeat),
+                   time_lookups(chatserver.name_exists, names, channel, repeat)]
+
+        start = time.perf_counter()
+        for i in range(args.lookups):
+            chatserver.check_channel("bench")
+        results.append((time.perf_counter() - start) / args.lookups * 1e9)
+        print(f"{size:>8} {results[0]:>8.0f}ns {results[1]:>9.0f}ns {results[2]:>8.0f}ns {results[3]:>9.0f}ns "
+              f"{results[4]:>13.0f}ns", flush=True)
+
+
+def bench_fanout(args):
+    """
+    Measures the CPU time of delivering one chat line against the number of members in the channel
+    """
+    chatserver.event_loop = chatserver.EventLoop()
+    chatserver.scheduler = chatserver.Scheduler(chatserver.event_loop.wake)
+    text = "x" * args.length
+
+    print(f"{'members':>8} {'framed':>7} {'per-recipient':>14} {'shared':>10} {'per member':>11}")
+    for size in args.sizes:
+        for framed in (False, True):
+            clients, peers = make_clients(size, framed)
+            results = []
+            for fanout in (per_recipient_broadcast, shared_broadcast):
+                elapsed = 0
+                for i in range(args.messages):
+                    start = time.process_time()
+                    fanout("bench", text, clients)
+                    elapsed += time.process_time() - start
+                    drain(peers)
+                results.append(elapsed / args.messages * 1e6)
+            print(f"{size:>8} {str(framed):>7} {results[0]:>12.1f}us {results[1]:>8.1f}us "
+                  f"{results[1] / size:>9.2f}us", flush=True)
+            for client, peer in zip(clients, peers):
+                client.conn.close()
+                peer.close()
+
+
+def connect(port, name):
+    """
+    Connects a framed client to the server
+
+    :param port: The port of the channel
+    :param name: The username
+    :return: The socket of the client
+    """
+    conn = socket.create_connection(("127.0.0.1", port))
+    conn.sendall(encode_frame(name.encode('ascii')))
+    return conn
+
+
+def shard_driver(port, members, messages, length, results):
+    """
+    Fills one channel with clients, has the first one send a stream of messages and counts how many arrive at the
+    others. Runs in its own process so the load generator is not limited to one core either.
+
+    :param port: The port of the channel
+    :param members: How many clients join the channel
+    :param messages: How many messages the first client sends
+    :param length: The length of every message
+    :param results: Queue the number of deliveries and the time taken are put on
+    """
+    names = [f"bench{port}x{i}" for i in range(members)]
+    conns = [connect(port, name) for name in names]
+    time.sleep(1)
+    selector = selectors.DefaultSelector()
+    decoders = {}
+    for conn in conns[1:]:
+        conn.setblocking(False)
+        decoders[conn] = FrameDecoder()
+        selector.register(conn, selectors.EVENT_READ)
+
+    prefix = f"[{names[0]} ".encode('ascii')
+    payload = ("x" * length).encode('ascii')
+    expected = messages * (members - 1)
+    delivered = 0
+
+    def send():
+        for i in range(0, messages, 100):
+            conns[0].sendall(encode_frames([payload] * min(100, messages - i)))
+
+    start = time.perf_counter()
+    threading.Thread(target=send, daemon=True).start()
+    deadline = start + 60
+    while delivered < expected and time.perf_counter() < deadline:
+        for key, events in selector.select(timeout=1):
+            decoder = decoders[key.fileobj]
+            try:
+                decoder.feed(key.fileobj.recv(1 << 16))
+            except BlockingIOError:
+                continue
+            delivered += sum(1 for frame in decoder if frame.startswith(prefix))
+    results.put((delivered, time.perf_counter() - start))
+    for conn in conns:
+        conn.close()
+
+
+def bench_shards(args):
+    """
+    Measures the aggregate delivery rate of several busy channels against the number of worker processes. Every channel
+    is driven by its own process, so the numbers only scale with shards on a machine with enough cores for both.
+    """
+    print(f"{'shards':>7} {'channels':>9} {'delivered':>10} {'seconds':>8} {'msgs/s':>10}")
+    for shards in args.shards:
+        port = random.randint(20000, 60000 - args.channels)
+        capacity = max(5, args.members)
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as config:
+            config.write("\n".join(f"channel bench{i} {port + i} {capacity}" for i in range(max(3, args.channels))))
+        server = subprocess.Popen([sys.executable, chatserver.__file__, config.name, "--mode", "event",
+                                   "--shards", str(shards), "--outbox-limit", str(64 << 20)],
+                                  stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+        time.sleep(1)
+
+        results = multiprocessing.Queue()
+        drivers = [multiprocessing.Process(target=shard_driver,
+                                           args=(port + i, args.members, args.messages, args.length, results))
+                   for i in range(args.channels)]
+        for driver in drivers:
+            driver.start()
+        outcomes = [results.get() for driver in drivers]
+        for driver in drivers:
+            driver.join()
+
+        server.stdin.write("/shutdown\n")
+        server.stdin.flush()
+        server.wait(10)
+        delivered = sum(outcome[0] for outcome in outcomes)
+        elapsed = max(outcome[1] for outcome in outcomes)
+        print(f"{shards:>7} {args.channels:>9} {delivered:>10} {elapsed:>8.2f} {delivered / elapsed:>10.0f}", flush=True)
+
+
+def start_node(name, port, peers, config_path):
+    """
+    Starts one node of a cluster on localhost
+
+    :param name: The name of the node
+    :param port: The first port of the node, its channel uses this one and the cluster link the next
+    :param peers: The other nodes as (name, first port) pairs
+    :param config_path: Where to write the config file of the node
+    :return: The server process
+    """
+    with open(config_path, "w") as config:
+        config.write("\n".join(f"channel bench{i} {port + 2 + i} 100" for i in range(3)))
+    # The burst is read only once it has been sent, so the outbox limit is raised to keep the receiver connected
+    command = [sys.executable, chatserver.__file__, config_path, "--node", name, "--cluster-port", str(port),
+               "--outbox-limit", str(64 << 20)]
+    for peer, peer_port in peers:
+        command += ["--peer", f"{peer}=127.0.0.1:{peer_port}"]
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+
+
+def receive_frames(conn, decoder, prefix):
+    """
+    Reads from the socket until at least one frame starting with prefix has arrived
+
+    :return: The matching frames
+    """
+    while True:
+        data = conn.recv(1 << 16)
+        if not data:
+            raise ConnectionError("The server closed the connection.")
+        decoder.feed(data)
+        frames = [frame for frame in decoder if frame.startswith(prefix)]
+        if frames:
+            return frames
+
+
+def measure_path(sender, receiver, messages, burst):
+    """
+    Measures the delivery latency of single messages and the rate of a burst from one client to another
+
+    :param sender: Socket of the sending client
+    :param receiver: Socket of the receiving client
+    :param messages: How many single messages to time
+    :param burst: How many messages to send at once for the rate
+    :return: p50 and p99 latency in microseconds and messages per second
+    """
+    decoder = FrameDecoder()
+    prefix = b"[sender "
+    latencies = []
+    for i in range(messages):
+        start = time.perf_counter()
+        sender.sendall(encode_frame(b"ping"))
+        receive_frames(receiver, decoder, prefix)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    latencies.sort()
+
+    start = time.perf_counter()
+    for i in range(0, burst, 100):
+        sender.sendall(encode_frames([b"x" * 80] * min(100, burst - i)))
+    received = 0
+    while received < burst:
+        received += len(receive_frames(receiver, decoder, prefix))
+    rate = burst / (time.perf_counter() - start)
+    return latencies[len(latencies) // 2], latencies[len(latencies) * 99 // 100], rate
+
+
+def bench_cluster(args):
+    """
+    Compares chat delivery between two clients of the same node with delivery between clients of two nodes, which
+    goes through the peer link
+    """
+    port = random.randint(20000, 59000)
+    directory = tempfile.mkdtemp()
+    nodes = [start_node("a", port, [("b", port + 10)], f"{directory}/a.txt"),
+             start_node("b", port + 10, [("a", port)], f"{directory}/b.txt")]
+    time.sleep(2)
+
+    print(f"{'path':>11} {'p50':>9} {'p99':>9} {'msgs/s':>9}")
+    for path, node_port in (("same node", port + 2), ("cross node", port + 12)):
+        sender = connect(port + 2, "sender")
+        time.sleep(0.2)
+        receiver = connect(node_port, "receiver")
+        time.sleep(0.5)
+        p50, p99, rate = measure_path(sender, receiver, args.messages, args.burst)
+        print(f"{path:>11} {p50:>7.0f}us {p99:>7.0f}us {rate:>9.0f}", flush=True)
+        sender.close()
+        receiver.close()
+        time.sleep(0.5)
+
+    for node in nodes:
+        node.stdin.write("/shutdown\n")
+        node.stdin.flush()
+        node.wait(10)
+
+
+def bench_log(args):
+    """
+    Measures the durable message log: how fast messages can be appended and committed with group commit against a
+    sync after every message, and how fast the log is replayed and searched
+    """
+    payload = ("x" * args.length).encode('ascii')
+    directory = tempfile.mkdtemp()
+
+    message_log = chatlog.MessageLog(directory, args.interval)
+    log = message_log.channel("bench")
+    start = time.perf_counter()
+    append_time = 0
+    for i in range(args.messages):
+        begin = time.perf_counter()
+        message_log.append(log, chatlog.CHAT, payload if i % 1000 else b"needle " + payload)
+        append_time += time.perf_counter() - begin
+    message_log.close()
+    elapsed = time.perf_counter() - start
+    print(f"group commit:  {args.messages / elapsed:>10.0f} msgs/s durable, {append_time / args.messages * 1e9:>6.0f}ns "
+          f"per append, {log.commits} fsyncs", flush=True)
+
+    count = max(1, args.messages // 100)
+    single = chatlog.ChannelLog(f"{directory}/single", chatlog.SEGMENT_BYTES)
+    start = time.perf_counter()
+    for i in range(count):
+        single.append(chatlog.CHAT, payload)
+        single.commit()
+    elapsed = time.perf_counter() - start
+    single.close()
+    print(f"fsync each:    {count / elapsed:>10.0f} msgs/s durable ({count} messages)", flush=True)
+
+    size = sum(os.path.getsize(path) for path in log.segments())
+    start = time.perf_counter()
+    records = sum(1 for record in log.read())
+    elapsed = time.perf_counter() - start
+    print(f"replay:        {records / elapsed:>10.0f} msgs/s, {size / elapsed / (1 << 20):.0f} MiB/s", flush=True)
+
+    start = time.perf_counter()
+    found = sum(1 for record in log.search(b"needle"))
+    elapsed = time.perf_counter() - start
+    print(f"search:        {found} matches in {elapsed * 1000:.1f}ms, {size / elapsed / (1 << 20):.0f} MiB/s", flush=True)
+
+
+def process_status(pid):
+    """
+    :param pid: The process id
+    :return: The resident memory in kB and the number of threads of the process
+    """
+    fields = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, value = line.split(":", 1)
+            fields[key] = value.split()
+    return int(fields["VmRSS"][0]), int(fields["Threads"][0])
+
+
+def bench_startup(args):
+    """
+    Measures how long the server takes to parse its config and accept on every channel against the number of channels,
+    along with its memory, threads and the time for the first client to join a channel nobody has used yet
+    """
+    print(f"{'channels':>9} {'mode':>9} {'startup s':>10} {'rss MB':>8} {'threads':>8} {'first join ms':>14}")
+    for count in args.channels:
+        for mode in args.modes:
+            # Kept below the ephemeral ports, which the connections probing the server are bound to
+            port = random.randint(10000, 32000 - count)
+            with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as config:
+                config.write("\n".join(f"channel bench{i} {port + i} 5" for i in range(max(3, count))))
+            started = time.perf_counter()
+            server = subprocess.Popen([sys.executable, chatserver.__file__, config.name, "--mode", mode],
+                                      stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+            # The channels are listened on in order, so the server is up once the last one accepts
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port + count - 1)).close()
+                    break
+                except OSError:
+                    if server.poll() is not None:
+                        raise RuntimeError("The server exited while starting.")
+                    time.sleep(0.001)
+            elapsed = time.perf_counter() - started
+            rss, threads = process_status(server.pid)
+
+            joined = time.perf_counter()
+            conn = connect(port + count // 2, "first")
+            decoder = FrameDecoder()
+            receive_frames(conn, decoder, b"[Server message")
+            joined = time.perf_counter() - joined
+            conn.close()
+
+            server.stdin.write("/shutdown\n")
+            server.stdin.flush()
+            server.wait(30)
+            os.unlink(config.name)
+            print(f"{count:>9} {mode:>9} {elapsed:>10.3f} {rss / 1024:>8.1f} {threads:>8} {joined * 1000:>14.2f}",
+                  flush=True)
+
+
+def storm_driver(port, first, count, results):
+    """
+    Connects clients to one channel all at once without waiting for each other, sending every username as soon as its
+    connection is up, and waits until every client has heard from the server
+
+    :param port: The port of the channel
+    :param first: The number of the first username, so the drivers pick different names
+    :param count: How many clients to connect
+    :param results: Queue the number welcomed, the seconds taken and the time each client waited are put on
+    """
+    chatserver.raise_file_limit()
+    selector = selectors.DefaultSelector()
+    started = time.perf_counter()
+    for i in range(count):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setblocking(False)
+        conn.connect_ex(("127.0.0.1", port))
+        selector.register(conn, selectors.EVENT_WRITE, (f"storm{first + i}", time.perf_counter()))
+
+    waits = []
+    pending = count
+    while pending:
+        events = selector.select(10)
+        if not events:
+            break
+        for key, mask in events:
+            name, connected = key.data
+            if mask & selectors.EVENT_WRITE:
+                if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    selector.unregister(key.fileobj)
+                    pending -= 1
+                    continue
+                key.fileobj.send(encode_frame(name.encode('ascii')))
+                selector.modify(key.fileobj, selectors.EVENT_READ, key.data)
+            elif key.fileobj.recv(1 << 16):
+                waits.append(time.perf_counter() - connected)
+                selector.unregister(key.fileobj)
+                pending -= 1
+    results.put((len(waits), time.perf_counter() - started, waits))
+    # The connections stay open until the server is stopped, so every client counts against the channel
+    time.sleep(1)
+
+
+def bench_storm(args):
+    """
+    Measures how many connections per second the server accepts and welcomes when many clients connect to a channel at
+    the same moment, such as after a network outage. A few connections which start a username and never finish it are
+    made first, the rest must not be held up by them.
+    """
+    print(f"{'backlog':>8} {'clients':>8} {'welcomed':>9} {'seconds':>8} {'conn/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    chatserver.raise_file_limit()
+    for backlog in args.backlogs:
+        for clients in args.clients:
+            port = random.randint(20000, 30000)
+            with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as config:
+                config.write("\n".join(f"channel storm{i} {port + i} {max(5, clients)}" for i in range(3)))
+            server = subprocess.Popen([sys.executable, chatserver.__file__, config.name, "--mode", args.mode,
+                                       "--accept-backlog", str(backlog), "--console-level", "warning"],
+                                      stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+            time.sleep(1)
+            silent = [socket.create_connection(("127.0.0.1", port)) for i in range(args.silent)]
+            for conn in silent:
+                # Half of a length prefix, the username never follows
+                conn.send(b"\0\0")
+
+            results = multiprocessing.Queue()
+            share = clients // args.processes
+            drivers = [multiprocessing.Process(target=storm_driver, args=(port, i * share, share, results))
+                       for i in range(args.processes)]
+            for driver in drivers:
+                driver.start()
+            outcomes = [results.get() for driver in drivers]
+            for driver in drivers:
+                driver.join()
+
+            server.stdin.write("/shutdown\n")
+            server.stdin.flush()
+            server.wait(30)
+            for conn in silent:
+                conn.close()
+            os.unlink(config.name)
+            welcomed = sum(outcome[0] for outcome in outcomes)
+            elapsed = max(outcome[1] for outcome in outcomes)
+            waits = sorted(wait for outcome in outcomes for wait in outcome[2])
+            p50 = waits[len(waits) // 2] * 1000 if waits else float('nan')
+            p99 = waits[min(len(waits) - 1, len(waits) * 99 // 100)] * 1000 if waits else float('nan')
+            print(f"{backlog:>8} {share * args.processes:>8} {welcomed:>9} {elapsed:>8.2f} {welcomed / elapsed:>8.0f} "
+                  f"{p50:>8.1f} {p99:>8.1f}", flush=True)
+
+
+def copying_receive(client):
+    """
+    The receive path as it used to be: recv allocates a new bytes object, every frame is copied out of the decoder,
+    decoded, split into words and joined back together twice
+
+    :param client: The client with data waiting on its socket
+    """
+    data = client.conn.recv(chatserver.RECV_SIZE)
+    chatserver.metrics.count(chatserver.BYTES_IN, client.channel.name, len(data))
+    client.decoder.feed(data)
+    for payload in client.decoder:
+        if client.status == chatserver.DISCONNECTED:
+            return
+        message = payload.decode('UTF-8').strip("\n").split(" ")
+        if len(' '.join(message)) == 0 or message[0] == "/quit":
+            return
+        client.chat(' '.join(message))
+        if client.muted == 0:
+            client.last_message = time.monotonic()
+
+
+def pooled_receive(client):
+    """
+    The current receive path: recv_into a pooled buffer, frames parsed in place and chat lines decoded once
+
+    :param client: The client with data waiting on its socket
+    """
+    client.on_readable()
+
+
+def bench_receive(args):
+    """
+    Measures the CPU time and the allocations of reading chat lines from a client, comparing the old copying receive
+    path with the pooled one. The memory allocated on top of what was already in use while one read is handled comes
+    from tracemalloc.
+    """
+    chatserver.event_loop = chatserver.EventLoop()
+    chatserver.scheduler = chatserver.Scheduler(chatserver.event_loop.wake)
+    chatserver.console = chatconsole.Console(level=chatconsole.WARNING)
+    batch = encode_frames([("x" * args.length).encode('ascii')] * args.batch)
+
+    print(f"{'path':>8} {'per message':>12} {'peak per read':>14}")
+    for name, receive in (("copying", copying_receive), ("pooled", pooled_receive)):
+        clients, peers = make_clients(args.members, True)
+        sender, sender_peer = clients[0], peers[0]
+        sender.channel.connected = tuple(clients)
+        sender.reading = True
+        if args.queued:
+            sender.status = chatserver.QUEUE
+        elapsed = 0
+        for i in range(args.rounds):
+            sender_peer.sendall(batch)
+            start = time.process_time()
+            receive(sender)
+            elapsed += time.process_time() - start
+            drain(peers)
+
+        tracemalloc.start()
+        peak = 0
+        for i in range(args.rounds):
+            sender_peer.sendall(batch)
+            drain(peers)
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            receive(sender)
+            peak += tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+
+        messages = args.rounds * args.batch
+        print(f"{name:>8} {elapsed / messages * 1e6:>10.2f}us {peak / args.rounds / 1024:>11.1f}KiB", flush=True)
+        for client, peer in zip(clients, peers):
+            client.conn.close()
+            peer.close()
+
+
+class TimedLock:
+    """
+    Wraps a lock and adds up how long it is held
+    """
+    def __init__(self, lock):
+        """
+        Constructor of the timed lock
+
+        :param lock: The lock to wrap
+        """
+        self.lock = lock
+        self.held = 0.0
+        self.since = 0.0
+
+    def acquire(self):
+        self.lock.acquire()
+        self.since = time.perf_counter()
+
+    def release(self):
+        self.held += time.perf_counter() - self.since
+        self.lock.release()
+
+
+def unlock_after_broadcast(channel):
+    """
+    The membership change as it used to be: the join or leave is broadcast to the channel before the lock is released
+
+    :param channel: The channel whose lock is held
+    """
+    outgoing, channel.outgoing = channel.outgoing, []
+    for message, recipients in outgoing:
+        chatserver.broadcast(message, recipients)
+    channel.lock.release()
+
+
+def bench_membership(args):
+    """
+    Measures how long the channel lock is held while a client joins and leaves against the number of members, when the
+    notices are broadcast with the lock held as before and once it has been released
+    """
+    chatserver.event_loop = chatserver.EventLoop()
+    chatserver.scheduler = chatserver.Scheduler(chatserver.event_loop.wake)
+    chatserver.console = chatconsole.Console(level=chatconsole.WARNING)
+
+    print(f"{'members':>8} {'held before':>12} {'held now':>10}")
+    for size in args.sizes:
+        results = []
+        for unlock in (unlock_after_broadcast, None):
+            clients, peers = make_clients(size + 1, True)
+            channel = clients[0].channel
+            channel.capacity = size + 1
+            channel.connected = tuple(clients[:size])
+            channel.connected_names = {client.name: client for client in clients[:size]}
+            channel.lock = TimedLock(channel.lock)
+            if unlock is not None:
+                channel.unlock = partial(unlock, channel)
+            joiner = clients[size]
+            for i in range(args.rounds):
+                channel.process_connection(chatserver.ADD, joiner)
+                channel.process_connection(chatserver.REMOVE, joiner)
+                drain(peers)
+            results.append(channel.lock.held / args.rounds * 1e6)
+            for client, peer in zip(clients, peers):
+                client.conn.close()
+                peer.close()
+        print(f"{size:>8} {results[0]:>10.1f}us {results[1]:>8.1f}us", flush=True)
+
+
+def read_latencies(peers, expected, latencies):
+    """
+    Reads the frames arriving on the given sockets until all are in, every one carries the time it was broadcast at
+
+    :param peers: The sockets on the client side of the connections
+    :param expected: How many frames to read in all
+    :param latencies: Filled with the delay of every frame in seconds
+    """
+    selector = selectors.DefaultSelector()
+    decoders = {}
+    for peer in peers:
+        selector.register(peer, selectors.EVENT_READ)
+        decoders[peer] = FrameDecoder()
+    while len(latencies) < expected:
+        events = selector.select(timeout=5)
+        if not events:
+            break
+        for key, mask in events:
+            data = key.fileobj.recv(1 << 16)
+            now = time.perf_counter()
+            decoder = decoders[key.fileobj]
+            decoder.feed(data)
+            for payload in decoder:
+                latencies.append(now - float(payload.split(b" ")[1]))
+    selector.close()
+
+
+def bench_coalesce(args):
+    """
+    Measures the send calls made per delivered message and the delay added by coalescing, for a channel receiving a
+    steady stream of broadcasts. Coalescing trades a bounded delay for fewer send calls, so the last column shows how far
+    the largest delay went past the window.
+    """
+    chatserver.event_loop = chatserver.EventLoop()
+    chatserver.scheduler = chatserver.Scheduler(chatserver.event_loop.wake)
+    chatserver.console = chatconsole.Console(level=chatconsole.WARNING)
+    threading.Thread(target=chatserver.event_loop.run, daemon=True).start()
+    gap = 1 / args.rate
+
+    print(f"{'window':>8} {'sends per delivery':>19} {'p50':>8} {'p99':>8} {'max':>8} {'over':>8}")
+    for interval in args.intervals:
+        chatserver.coalesce_interval = interval
+        chatserver.coalesce_bytes = args.bytes
+        clients, peers = make_clients(args.members, True)
+        latencies = []
+        reader = threading.Thread(target=read_latencies, args=(peers, args.messages * args.members, latencies))
+        reader.start()
+        sends = chatserver.metrics.sends
+        due = time.perf_counter()
+        for i in range(args.messages):
+            due += gap
+            while time.perf_counter() < due:
+                time.sleep(0)
+            chatserver.broadcast(f"[user0] {time.perf_counter():.6f} " + "x" * args.length, clients)
+        reader.join()
+        sends = chatserver.metrics.sends - sends
+
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[len(latencies) * 99 // 100] * 1000
+        print(f"{interval * 1000:>6.1f}ms {sends / len(latencies):>19.3f} {p50:>6.2f}ms {p99:>6.2f}ms "
+              f"{latencies[-1] * 1000:>6.2f}ms {(latencies[-1] - interval) * 1000:>6.2f}ms", flush=True)
+        for client, peer in zip(clients, peers):
+            client.conn.close()
+            peer.close()
+    chatserver.event_loop.running = False
+    chatserver.event_loop.wake()
+
+
+class TimedClient(chatserver.Client):
+    """
+    A client which notes when its last message was queued or sent
+    """
+    delivered = 0.0
+
+    def push(self, data, hold=False):
+        super().push(data, hold)
+        self.delivered = time.perf_counter()
+
+
+def bench_skew(args):
+    """
+    Measures how long after a broadcast to a large channel each member has the message, when the sender delivers to
+    every member itself and when the members are split across the fan-out threads. The spread of these delays is the
+    delivery skew between the first and the last member. The time the broadcast call takes is how long the sender is
+    held up.
+    """
+    chatserver.event_loop = chatserver.EventLoop()
+    chatserver.scheduler = chatserver.Scheduler(chatserver.event_loop.wake)
+    chatserver.console = chatconsole.Console(level=chatconsole.WARNING)
+    threading.Thread(target=chatserver.event_loop.run, daemon=True).start()
+    chatserver.raise_file_limit()
+    chatserver.fanout_threads = args.threads
+    line = "[user0] " + "x" * args.length
+
+    print(f"{'members':>8} {'sender p50':>11} {'p99':>8} {'last':>8} {'threads p50':>12} {'p99':>8} {'last':>8} "
+          f"{'call':>8}")
+    for size in args.sizes:
+        clients, peers = make_clients(size, True, TimedClient)
+        results = []
+        for threshold in (0, 1):
+            chatserver.fanout_threshold = threshold
+            delays = []
+            last = []
+            calls = []
+            for i in range(args.messages):
+                start = time.perf_counter()
+                chatserver.broadcast(line, clients)
+                calls.append(time.perf_counter() - start)
+                for worker in chatserver.fanout_workers:
+                    worker.tasks.join()
+                delays.extend(client.delivered - start for client in clients)
+                last.append(max(client.delivered for client in clients) - start)
+                drain(peers)
+            delays.sort()
+            results.append((delays[len(delays) // 2] * 1000, delays[len(delays) * 99 // 100] * 1000,
+                            sorted(last)[len(last) // 2] * 1000, sorted(calls)[len(calls) // 2] * 1000))
+        (p50, p99, slowest, _), (fanout_p50, fanout_p99, fanout_slowest, fanout_call) = results
+        print(f"{size:>8} {p50:>9.2f}ms {p99:>6.2f}ms {slowest:>6.2f}ms {fanout_p50:>10.2f}ms {fanout_p99:>6.2f}ms "
+              f"{fanout_slowest:>6.2f}ms {fanout_call:>6.2f}ms", flush=True)
+        for client, peer in zip(clients, peers):
+            client.conn.close()
+            peer.close()
+    chatserver.event_loop.running = False
+    chatserver.event_loop.wake()
+
+
+def bench_throttle(args):
+    """
+    Measures what the flood limits cost per message, for a channel without limits, for a client within its limit and
+    for a muted client over it, then floods a channel from one client and counts the lines which reach the members
+    """
+    chatserver.event_loop = chatserver.EventLoop()
+    chatserver.scheduler = chatserver.Scheduler(chatserver.event_loop.wake)
+    chatserver.console = chatconsole.Console(level=chatconsole.ERROR)
+    clients, peers = make_clients(args.members, True)
+    sender = clients[0]
+    channel = sender.channel
+    channel.connected = tuple(clients)
+
+    # The broadcast is left out, so only the handling of a line and the limit check around it are timed
+    sender.chat = lambda text: None
+    line = b"x" * 80
+    base = None
+    print(f"{'case':>16} {'per line':>10} {'for the limit':>14}")
+    for case, limit in (("no limit", None), ("within limit", (1e9, 1e9)), ("over limit", (1e-9, 1))):
+        channel.limits = {} if limit is None else {"chat": limit}
+        sender.reset_limits()
+        # Over the limit the first lines take the only token and mute the sender
+        sender.process_message(line)
+        sender.process_message(line)
+        start = time.perf_counter()
+        for i in range(args.checks):
+            sender.process_message(line)
+        elapsed = (time.perf_counter() - start) / args.checks
+        base = elapsed if base is None else base
+        print(f"{case:>16} {elapsed * 1e9:>8.0f}ns {(elapsed - base) * 1e9:>12.0f}ns", flush=True)
+    del sender.chat
+
+    sender.muted = 0
+    channel.limits = {"chat": (args.rate, args.burst)}
+    sender.reset_limits()
+    sent = chatserver.metrics.counters[chatserver.MESSAGES, channel.name]
+    throttled = chatserver.metrics.counters[chatserver.THROTTLED, channel.name]
+    line = encode_frame(b"x" * 80)
+    start = time.perf_counter()
+    for i in range(args.flood):
+        sender.process_message(line[4:])
+    elapsed = time.perf_counter() - start
+    drain(peers)
+    sent = chatserver.metrics.counters[chatserver.MESSAGES, channel.name] - sent
+    throttled = chatserver.metrics.counters[chatserver.THROTTLED, channel.name] - throttled
+    print(f"{args.flood} lines handled in {elapsed * 1000:.0f}ms with chat={args.rate:g}/{args.burst:g}: {sent} "
+          f"broadcast to {args.members} members, {throttled} throttled", flush=True)
+    for client, peer in zip(clients, peers):
+        client.conn.close()
+        peer.close()
+
+
+def chat_traffic(count, seed=1):
+    """
+    Makes up what a client of a busy channel is sent: mostly chat lines of other clients, with joins, leaves,
+    whispers and channel lists in between
+
+    :param count: How many messages
+    :param seed: Seed of the random choices
+    :return: The messages, each with True if it is broadcast to the channel and False if it is sent to one client
+    """
+    rng = random.Random(seed)
+    words = ["the", "a", "server", "channel", "hello", "anyone", "here", "lunch", "deploy", "is", "broken", "again",
+             "fixed", "thanks", "see", "you", "later", "what", "time", "meeting", "ok", "sure", "lol", "build"]
+    messages = []
+    for i in range(count):
+        clock = f"{12 + i // 3600 % 12:02d}:{i // 60 % 60:02d}:{i % 60:02d}"
+        name = f"user{rng.randrange(50)}"
+        kind = rng.random()
+        if kind < 0.8:
+            text = ' '.join(rng.choice(words) for j in range(rng.randint(2, 15)))
+            messages.append((f"[{name} ({clock})] {text}", True))
+        elif kind < 0.9:
+            verb = rng.choice(("joined", "left"))
+            messages.append((f"[Server message ({clock})] {name} has {verb} the channel.\n", True))
+        elif kind < 0.97:
+            text = ' '.join(rng.choice(words) for j in range(rng.randint(2, 10)))
+            messages.append((f"[{name} whispers to you: ({clock})] {text}", False))
+        else:
+            messages.append(('\n'.join(f"[Channel] room{j} {rng.randrange(50)}/50/{rng.randrange(5)}." for j in range(8)),
+                             False))
+    return [(text.encode('ascii'), broadcast) for text, broadcast in messages]
+
+
+def bench_compress(args):
+    """
+    Measures the bytes sent to one client and the CPU time spent on both ends for chat traffic and files, without
+    compression, with every message in the stream of the connection, and as the server sends them: broadcasts
+    compressed once for the whole channel and the rest in the stream of the connection. Compressing a broadcast once is
+    shared by every member, so its cost per member is divided by the channel size.
+    """
+    messages = chat_traffic(args.messages)
+    plain = sum(len(encode_frame(payload)) for payload, broadcast in messages)
+    print(f"{len(messages)} messages, {plain} bytes framed, {args.members} members sharing each broadcast")
+    print(f"{'level':>5} {'mode':>8} {'bytes':>8} {'compress per member':>20} {'inflate':>9}")
+    for level in args.levels:
+        for mode in ("stream", "server"):
+            deflater = Deflater(level)
+            frames = []
+            elapsed = 0.0
+            for payload, broadcast in messages:
+                start = time.process_time()
+                if mode == "server" and broadcast:
+                    frames.append(encode_shared(payload, level))
+                    elapsed += (time.process_time() - start) / args.members
+                else:
+                    frames.append(deflater.frame(payload))
+                    elapsed += time.process_time() - start
+            decoder = FrameDecoder()
+            start = time.process_time()
+            for frame in frames:
+                decoder.feed(frame)
+                for payload in decoder.views():
+                    pass
+            inflate = time.process_time() - start
+            size = sum(len(frame) for frame in frames)
+            print(f"{level:>5} {mode:>8} {size / plain * 100:>7.1f}% {elapsed / len(messages) * 1e6:>18.2f}us "
+                  f"{inflate / len(messages) * 1e6:>7.2f}us", flush=True)
+
+    rng = random.Random(2)
+    text = ''.join(f"{rng.choice(('GET', 'POST'))} /api/item/{rng.randrange(10000)} {rng.choice((200, 404, 500))} "
+                   f"{rng.randrange(1000)}ms\n" for i in range(args.file_size // 30)).encode('ascii')[:args.file_size]
+    files = (("text file", text), ("random file", os.urandom(args.file_size)))
+    print(f"{'level':>5} {'file':>12} {'bytes':>8} {'compress':>10} {'inflate':>10}")
+    for level in args.levels:
+        for name, data in files:
+            start = time.process_time()
+            frames = [encode_shared(data[offset:offset + chatserver.CHUNK_SIZE], level, chatserver.CHUNK)
+                      for offset in range(0, len(data), chatserver.CHUNK_SIZE)]
+            elapsed = time.process_time() - start
+            decoder = FrameDecoder()
+            start = time.process_time()
+            for frame in frames:
+                decoder.feed(frame)
+                for payload in decoder.views():
+                    pass
+            inflate = time.process_time() - start
+            size = sum(len(frame) for frame in frames)
+            megabytes = len(data) / (1 << 20)
+            print(f"{level:>5} {name:>12} {size / len(data) * 100:>7.1f}% {megabytes / elapsed:>6.0f}MB/s "
+                  f"{megabytes / max(inflate, 1e-9):>6.0f}MB/s", flush=True)
+
+
+def parse_args():
+    """
+    Parses the command line arguments of the benchmark
+    """
+    parser = argparse.ArgumentParser(description="Micro benchmarks for the chat server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fanout = commands.add_parser("fanout", help="CPU cost of one broadcast against channel size")
+    fanout.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 500, 1000])
+    fanout.add_argument("--messages", type=int, default=200, help="broadcasts measured per channel size")
+    fanout.add_argument("--length", type=int, default=80, help="length of the chat message")
+    fanout.set_defaults(run=bench_fanout)
+
+    index = commands.add_parser("index", help="name and channel lookups against room size")
+    index.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 50000])
+    index.add_argument("--lookups", type=int, default=100000, help="lookups measured per room size")
+    index.set_defaults(run=bench_index)
+
+    shards = commands.add_parser("shards", help="aggregate throughput of busy channels against worker processes")
+    shards.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    shards.add_argument("--channels", type=int, default=4, help="channels driven at the same time")
+    shards.add_argument("--members", type=int, default=20, help="clients in every channel")
+    shards.add_argument("--messages", type=int, default=2000, help="messages sent in every channel")
+    shards.add_argument("--length", type=int, default=80, help="length of the chat message")
+    shards.set_defaults(run=bench_shards)
+
+    clustered = commands.add_parser("cluster", help="latency and rate of delivery within a node and across two nodes")
+    clustered.add_argument("--messages", type=int, default=1000, help="single messages timed for the latency")
+    clustered.add_argument("--burst", type=int, default=20000, help="messages sent at once for the rate")
+    clustered.set_defaults(run=bench_cluster)
+
+    logged = commands.add_parser("log", help="write, replay and search speed of the durable message log")
+    logged.add_argument("--messages", type=int, default=200000, help="messages appended")
+    logged.add_argument("--length", type=int, default=80, help="length of every message")
+    logged.add_argument("--interval", type=float, default=chatlog.COMMIT_INTERVAL, help="group commit interval")
+    logged.set_defaults(run=bench_log)
+
+    startup = commands.add_parser("startup", help="startup time, memory and threads against the number of channels")
+    startup.add_argument("--channels", type=int, nargs="+", default=[100, 1000, 10000])
+    startup.add_argument("--modes", nargs="+", default=[chatserver.THREADED, chatserver.EVENT],
+                         choices=[chatserver.THREADED, chatserver.EVENT])
+    startup.set_defaults(run=bench_startup)
+
+    storm = commands.add_parser("storm", help="connections accepted per second when many clients connect at once")
+    storm.add_argument("--clients", type=int, nargs="+", default=[1000, 5000])
+    storm.add_argument("--backlogs", type=int, nargs="+", default=[128, 1024])
+    storm.add_argument("--processes", type=int, default=4, help="processes connecting the clients")
+    storm.add_argument("--silent", type=int, default=10, help="connections made first which never finish their username")
+    storm.add_argument("--mode", choices=[chatserver.THREADED, chatserver.EVENT], default=chatserver.EVENT)
+    storm.set_defaults(run=bench_storm)
+
+    received = commands.add_parser("receive", help="CPU time and allocations of reading chat lines from a client")
+    received.add_argument("--rounds", type=int, default=2000, help="reads measured")
+    received.add_argument("--batch", type=int, default=50, help="chat lines waiting on the socket for every read")
+    received.add_argument("--length", type=int, default=80, help="length of the chat message")
+    received.add_argument("--members", type=int, default=2, help="clients in the channel the lines are broadcast to")
+    received.add_argument("--queued", action="store_true",
+                          help="the sender waits in the queue, so its lines are parsed but not broadcast")
+    received.set_defaults(run=bench_receive)
+
+    membership = commands.add_parser("membership", help="time the channel lock is held by a join and a leave")
+    membership.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    membership.add_argument("--rounds", type=int, default=200, help="joins and leaves measured per channel size")
+    membership.set_defaults(run=bench_membership)
+
+    coalesced = commands.add_parser("coalesce", help="send calls per delivered message and delay against the window")
+    coalesced.add_argument("--intervals", type=float, nargs="+", default=[0.0, 0.002, 0.005, 0.01],
+                           help="coalescing windows in seconds, 0 sends every message straight away")
+    coalesced.add_argument("--bytes", type=int, default=chatserver.coalesce_bytes,
+                           help="bytes held back for one client after which they are sent")
+    coalesced.add_argument("--members", type=int, default=20, help="clients in the channel")
+    coalesced.add_argument("--messages", type=int, default=2000, help="messages broadcast per window")
+    coalesced.add_argument("--rate", type=float, default=1000, help="messages broadcast per second")
+    coalesced.add_argument("--length", type=int, default=80, help="length of the chat message")
+    coalesced.set_defaults(run=bench_coalesce)
+
+    skew = commands.add_parser("skew", help="delay until every member of a large channel has a broadcast")
+    skew.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000, 9000])
+    skew.add_argument("--threads", type=int, default=chatserver.fanout_threads, help="fan-out threads")
+    skew.add_argument("--messages", type=int, default=50, help="broadcasts measured per channel size")
+    skew.add_argument("--length", type=int, default=80, help="length of the chat message")
+    skew.set_defaults(run=bench_skew)
+
+    throttle = commands.add_parser("throttle", help="cost of the flood limits and what a flood reaches the channel")
+    throttle.add_argument("--checks", type=int, default=1000000, help="chat lines timed per case")
+    throttle.add_argument("--members", type=int, default=100, help="clients in the flooded channel")
+    throttle.add_argument("--flood", type=int, default=10000, help="chat lines sent by the flooding client")
+    throttle.add_argument("--rate", type=float, default=2, help="chat lines per second allowed")
+    throttle.add_argument("--burst", type=float, default=10, help="chat lines allowed at once")
+    throttle.set_defaults(run=bench_throttle)
+
+    compressed = commands.add_parser("compress", help="bytes sent and CPU spent with compression")
+    compressed.add_argument("--levels", type=int, nargs="+", default=[1, 6, 9], help="zlib levels")
+    compressed.add_argument("--messages", type=int, default=20000, help="messages of chat traffic")
+    compressed.add_argument("--members", type=int, default=50, help="clients sharing each compressed broadcast")
+    compressed.add_argument("--file-size", type=int, default=4 << 20, help="bytes of each file sent")
+    compressed.set_defaults(run=bench_compress)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.run(args)
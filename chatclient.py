@@ -1,101 +1,139 @@
+import argparse
+import asyncio
+import os
 import socket
-import time
-import sys
 import threading
-import os
+import time
+
+from chatlib import ChatClient
+
+reported = {}
+
+
+def report_progress(verb, name, done, size):
+    """
+    Prints the progress of a file transfer every 10 percent
+
+    :param verb: What is happening to the file, i.e. Sending or Receiving
+    :param name: The file name
+    :param done: How many bytes have been transferred
+    :param size: The size of the file
+    """
+    percent = 100 if size == 0 else done * 100 // size
+    last = reported.get((verb, name), -1)
+    if percent // 10 > last // 10 or (percent == 100 and last < 100):
+        print(f"[Server message ({time.strftime('%H:%M:%S')})] {verb} {name}: {percent}% of {size} bytes.", flush=True)
+        reported[(verb, name)] = percent
+    if percent == 100:
+        reported.pop((verb, name), None)
 
 
-def send():
+def print_message(message):
     """
-    Handles message sending of the client
+    Prints a message received from the server
+
+    :param message: The text of the message
+    """
+    print(message, flush=True)
+
+
+def read_input(loop, lines):
     """
-    global send_user
-    global file_path
+    Reads the lines typed by the user on its own thread, which waits in input() without using CPU
 
+    :param loop: The event loop of the client
+    :param lines: The queue the lines are handed to the event loop through
+    """
     while True:
         try:
-            message = input("").strip("\n").split(" ")
-            if message[0] == "/send":
-                try:
-                    send_user = message[1]
-                    file_path = message[2]
-                except:
-                    continue
-
-            server.sendall((' '.join(message)).encode('ascii'))
-            if message[0] == "/quit":
-                exit()
+            line = input("")
         except EOFError:
-            continue
+            return
+        loop.call_soon_threadsafe(lines.put_nowait, line)
 
 
-def receive():
+async def send_file(client, target, path):
     """
-    Parses all messages received by the client
+    Sends a file and prints how it went
+
+    :param client: The ChatClient
+    :param target: The name of the client receiving the file
+    :param path: The path of the file to send
+    """
+    try:
+        sent = await client.send_file(target, path)
+    except OSError:
+        print(f"[Server message ({time.strftime('%H:%M:%S')})] {path} does not exist.", flush=True)
+        return
+    if sent:
+        print(f"[Server message ({time.strftime('%H:%M:%S')})] You sent {path} to {target}.", flush=True)
+    else:
+        print(f"[Server message ({time.strftime('%H:%M:%S')})] {target} is not here.", flush=True)
+
+
+async def run_commands(client, lines):
+    """
+    Sends the lines typed by the user to the server
+
+    :param client: The ChatClient
+    :param lines: The queue of typed lines
     """
     while True:
+        message = (await lines.get()).strip("\n").split(" ")
         try:
-            msg = str(server.recv(2048).decode('utf-8'))
-
-            if not msg:
-                break
-
-            # Checks if the server is fine with the client sending the file
-            if msg == "/send_ok":
-                try:
-                    file = open(file_path, 'r')
-                    data = file.read()
-                    server.sendall(data.encode('ascii'))
-                    file.close()
-                    print(f"[Server message ({time.strftime('%H:%M:%S')})] You sent {file_path} to {send_user}.",
-                          flush=True)
-                except:
-                    server.sendall("/bad_path".encode('ascii'))
-                    print(f"[Server message ({time.strftime('%H:%M:%S')})] {file_path} does not exist.", flush=True)
-
-            # Checks if /send was targeting an invalid client
-            elif msg == "/send_bad_user":
-                print(f"[Server message ({time.strftime('%H:%M:%S')})] {send_user} is not here.", flush=True)
-                try:
-                    file = open(file_path, 'r')
-                    file.close()
-                except:
-                    print(f"[Server message ({time.strftime('%H:%M:%S')})] {file_path} does not exist.", flush=True)
-
-            # Processes receiving the file
-            elif msg.split(" ")[0] == "/sending":
-                name = msg.split("/")[-1]
-
-                file = open(f"{name}", "w")
-                content = server.recv(2048).decode('utf-8')
-                file.write(content)
-                file.close()
+            if message[0] == "/send":
+                if len(message) < 3:
+                    continue
+                # Runs alongside so the next lines are read, they are sent once the file is
+                asyncio.ensure_future(send_file(client, message[1], message[2]))
+                await asyncio.sleep(0)
+            elif message[0] == "/quit":
+                await client.quit()
+                return
             else:
-                print(msg.strip('\n'), flush=True)
-        except:
-            break
-    os._exit(os.X_OK)
+                await client.command(' '.join(message))
+        except (UnicodeEncodeError, ConnectionError):
+            continue
 
 
-if __name__ == '__main__':
-    try:
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        host = socket.gethostbyname(socket.gethostname())
-        port = int(sys.argv[1])
-        username = sys.argv[2]
+async def main(args):
+    """
+    Connects to the server and runs until the connection is closed
 
-        addr = (host, port)
-        server.connect(addr)
-        server.sendall(username.encode('ascii'))
+    :param args: The parsed command line arguments
+    """
+    client = ChatClient(socket.gethostbyname(socket.gethostname()), args.port, args.username,
+                        on_message=print_message, progress=report_progress, reconnect=args.reconnect,
+                        compress=args.compress)
+    await client.connect()
 
-        to = threading.Thread(target=send, daemon=True)
-        to.start()
+    lines = asyncio.Queue()
+    thread = threading.Thread(target=read_input, args=(asyncio.get_running_loop(), lines), daemon=True)
+    thread.start()
+    commands = asyncio.ensure_future(run_commands(client, lines))
+    await client.wait_closed()
+    commands.cancel()
 
-        rc = threading.Thread(target=receive, daemon=True)
-        rc.start()
 
-        while True:
-            pass
-    except:
-        exit(1)
+def parse_args():
+    """
+    Parses the command line arguments of the client
+    """
+    parser = argparse.ArgumentParser(description="Chat client.")
+    parser.add_argument("port", type=int, help="port of the channel to join")
+    parser.add_argument("username", help="name to use in the channel")
+    parser.add_argument("--reconnect", action="store_true",
+                        help="connect again when the connection is lost and return to the channel")
+    parser.add_argument("--compress", action="store_true",
+                        help="ask the server to compress what it sends, saves bandwidth for some CPU on both ends")
+    return parser.parse_args()
 
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        asyncio.run(main(args))
+    except:
+        os._exit(1)
+    # The input thread may still be waiting in input(), which would hold up a normal exit
+    os._exit(os.X_OK)
@@ -0,0 +1,109 @@
+import json
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+TEXT = 'text'
+JSON = 'json'
+
+
+class Console:
+    """
+    Writes the server messages from a background thread, so a slow terminal or log collector never holds up the
+    thread which logged them. Messages wait in a bounded queue; once it is full new messages are dropped and counted
+    rather than blocking the server. In text format the messages are written exactly as given, in JSON format every
+    message becomes one JSON object per line.
+    """
+    def __init__(self, stream=None, level=INFO, style=TEXT, capacity=10000):
+        """
+        Constructor of the console, starts the writer thread
+
+        :param stream: The file to write to, stdout if not given
+        :param level: Messages below this level are ignored
+        :param style: TEXT or JSON
+        :param capacity: How many messages may wait to be written
+        """
+        self.stream = stream if stream is not None else sys.stdout
+        self.level = level
+        self.style = style
+        self.capacity = capacity
+        self.queue = queue.Queue(capacity)
+        self.dropped = 0
+        self.reported = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, message, level=INFO, **fields):
+        """
+        Queues a message to be written, never waits
+
+        :param message: The message, already in the console format
+        :param level: DEBUG, INFO, WARNING or ERROR
+        :param fields: Extra values added to the message in JSON format, such as the channel
+        """
+        if level < self.level:
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, message, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def format(self, record):
+        """
+        :param record: The time, level, message and fields of a message
+        :return: The line to write
+        """
+        when, level, message, fields = record
+        if self.style == TEXT:
+            return message
+        name = next(name for name, value in LEVELS.items() if value == level)
+        return json.dumps({"time": round(when, 6), "level": name, "message": message, **fields})
+
+    def run(self):
+        """
+        The writer thread, writes every waiting message with one write and one flush
+        """
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.capacity:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write(records)
+            if None in records:
+                return
+
+    def write(self, records):
+        """
+        Writes a batch of messages, noting how many were dropped since the last batch
+
+        :param records: The queued messages
+        """
+        lines = [self.format(record) for record in records if record is not None]
+        dropped = self.dropped
+        if dropped != self.reported:
+            message = f"[Server message ({time.strftime('%H:%M:%S')})] {dropped - self.reported} message(s) were " \
+                      f"dropped because the console could not keep up."
+            lines.append(self.format((time.time(), WARNING, message, {"dropped": dropped})))
+            self.reported = dropped
+        if not lines:
+            return
+        try:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def close(self):
+        """
+        Writes every waiting message and stops the writer thread
+        """
+        self.queue.put(None)
+        self.thread.join()
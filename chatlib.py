@@ -0,0 +1,426 @@
+import asyncio
+import collections
+import hashlib
+import inspect
+import os
+import time
+
+from chatprotocol import CHUNK_SIZE, HEADER, FrameDecoder, encode_frame, encode_shared
+
+RECV_SIZE = 65536
+RECONNECT_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+# Level of the frames compressed by the client, low as they are mostly chat lines and file chunks
+COMPRESSION_LEVEL = 1
+
+
+def server_message(text):
+    """
+    :param text: The text of a message generated by the client itself
+    :return: The text formatted like the server messages
+    """
+    return f"[Server message ({time.strftime('%H:%M:%S')})] {text}"
+
+
+class Download:
+    """
+    Writes a file streamed by the server to disk one chunk at a time and checks it against the digest sent at the end
+    """
+    def __init__(self, path, size, progress):
+        """
+        Constructor of the download
+
+        :param path: Where to write the file
+        :param size: The announced size of the file
+        :param progress: Called with the verb, name, bytes done and size after every chunk, may be None
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = size
+        self.remaining = size
+        self.file = open(path, "wb")
+        self.digest = hashlib.sha256()
+        self.progress = progress
+
+    def write(self, chunk):
+        """
+        Writes the next chunk of the file
+
+        :param chunk: The bytes received
+        """
+        self.file.write(chunk)
+        self.digest.update(chunk)
+        self.remaining -= len(chunk)
+        if self.progress is not None:
+            self.progress("Receiving", self.name, self.size - self.remaining, self.size)
+
+    def finish(self, digest):
+        """
+        Closes the file and checks that it arrived intact
+
+        :param digest: The SHA-256 digest of the file computed by the sender
+        :return: True if the file is intact
+        """
+        self.file.close()
+        return digest == self.digest.hexdigest()
+
+
+class ChatClient:
+    """
+    A client of the chat server built on asyncio, for the command line client and for bots. Everything runs on the
+    event loop of the caller, so an idle client only waits in the selector and uses no CPU.
+
+    Messages from the server are passed to on_message if given, otherwise they are queued for the async iterator of the
+    client. Files sent to the client are written to download_dir and reported as a message once complete.
+
+    With reconnect the client connects again whenever the connection is lost, waiting longer after every failed attempt,
+    and switches back to the channel it was in. Calls made while it is away wait until it is back.
+
+    With compress the client asks for compressed frames in its handshake. Once the server agrees, messages and file
+    chunks which shrink are sent compressed as well.
+    """
+    def __init__(self, host, port, username, on_message=None, progress=None, reconnect=False, download_dir=".",
+                 compress=False):
+        """
+        Constructor of the client, nothing is sent until connect is called
+
+        :param host: The address of the server
+        :param port: The port of the channel to join
+        :param username: The name of the client
+        :param on_message: Called with the text of every message, may be a coroutine function
+        :param progress: Called with the verb, file name, bytes done and size while a file is sent or received
+        :param reconnect: True to connect again when the connection is lost
+        :param download_dir: The directory received files are written to
+        :param compress: True to ask the server for compression
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.on_message = on_message
+        self.progress = progress
+        self.reconnect = reconnect
+        self.download_dir = download_dir
+        self.compress = compress
+        self.compressing = False
+        self.channel = None
+        self.rejoin_channel = None
+        self.reader = None
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.closed = False
+        self.send_lock = asyncio.Lock()
+        self.messages = asyncio.Queue()
+        self.file_reply = None
+        self.list_waiters = collections.deque()
+        self.download = None
+        self.receiver = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.quit()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        :return: The next message from the server, ends once the client is closed
+        """
+        message = await self.messages.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self):
+        """
+        Connects to the server, sends the username and starts receiving
+
+        :raises OSError: If the server cannot be reached
+        """
+        await self.open()
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    async def open(self):
+        """
+        Opens the connection and sends the username
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.compressing = False
+        handshake = self.username + " compress" if self.compress else self.username
+        self.writer.write(encode_frame(handshake.encode('ascii')))
+        await self.writer.drain()
+        self.connected.set()
+
+    async def wait_closed(self):
+        """
+        Waits until the connection is closed for good, by quit or by the server when not reconnecting
+        """
+        if self.receiver is not None:
+            await self.receiver
+
+    async def write(self, payload):
+        """
+        Sends one message to the server, waiting for the connection to come back if it was lost
+
+        :param payload: The bytes of the message
+        """
+        async with self.send_lock:
+            await self.ready()
+            self.writer.write(encode_shared(payload, COMPRESSION_LEVEL) if self.compressing else encode_frame(payload))
+            await self.writer.drain()
+
+    async def ready(self):
+        """
+        Waits until the client is connected
+
+        :raises ConnectionError: If the client has been closed
+        """
+        if self.closed:
+            raise ConnectionError("The client is closed.")
+        await self.connected.wait()
+
+    async def command(self, text):
+        """
+        Sends a line as typed by a user, a chat message or a command such as /history 10
+
+        :param text: The line to send
+        """
+        await self.write(text.encode('ascii'))
+
+    async def send(self, text):
+        """
+        Sends a chat message to everyone in the channel
+
+        :param text: The message
+        """
+        await self.command(text)
+
+    async def whisper(self, target, text):
+        """
+        Sends a message only the target sees
+
+        :param target: The name of a client in the same channel
+        :param text: The message
+        """
+        await self.command(f"/whisper {target} {text}")
+
+    async def switch(self, channel):
+        """
+        Asks to be moved to another channel, the welcome message tells when it has happened
+
+        :param channel: The name of the channel
+        """
+        await self.command(f"/switch {channel}")
+
+    async def history(self, count=None):
+        """
+        Asks for the chat messages said before the oldest one seen so far, they arrive as messages
+
+        :param count: How many messages, the server default if not given
+        """
+        await self.command("/history" if count is None else f"/history {count}")
+
+    async def list(self):
+        """
+        Fetches the channels of the server
+
+        :return: The name, connected clients, capacity and queue length of every channel
+        :raises RuntimeError: If the server turned the request down for going over the flood limits
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self.list_waiters.append(waiter)
+        await self.command("/list")
+        channels = []
+        for line in (await waiter).split("\n"):
+            name, counts = line[len("[Channel] "):].rstrip(".").split(" ")
+            connected, capacity, queued = (int(count) for count in counts.split("/"))
+            channels.append((name, connected, capacity, queued))
+        return channels
+
+    async def send_file(self, target, path):
+        """
+        Streams a file to another client of the channel in chunks with sendfile, so memory use does not depend on the
+        size of the file. Nothing else is sent until the transfer is over.
+
+        :param target: The name of the client receiving the file
+        :param path: The path of the file
+        :return: True once the file is sent, False if the target is not in the channel
+        :raises OSError: If the file cannot be opened, before anything is sent
+        """
+        file = open(path, 'rb')
+        loop = asyncio.get_running_loop()
+        with file:
+            async with self.send_lock:
+                await self.ready()
+                self.file_reply = loop.create_future()
+                self.writer.write(encode_frame(f"/send {target} {path}".encode('ascii')))
+                await self.writer.drain()
+                if not await self.file_reply:
+                    return False
+
+                size = os.fstat(file.fileno()).st_size
+                digest = hashlib.sha256()
+                buffer = bytearray(CHUNK_SIZE)
+                self.writer.write(encode_frame(f"/file {size}".encode('ascii')))
+                offset = 0
+                compress = self.compressing
+                while offset < size:
+                    # The chunk is read once for the digest, the kernel sends it straight from the file unless it
+                    # shrinks when compressed. Once one does not, the file is taken to be compressed already.
+                    count = file.readinto(buffer)
+                    if not count:
+                        break
+                    chunk = memoryview(buffer)[:count]
+                    digest.update(chunk)
+                    frame = encode_shared(chunk, COMPRESSION_LEVEL) if compress else None
+                    if frame is not None and len(frame) < HEADER.size + count:
+                        self.writer.write(frame)
+                        await self.writer.drain()
+                    else:
+                        compress = False
+                        self.writer.write(HEADER.pack(count))
+                        await self.writer.drain()
+                        await loop.sendfile(self.writer.transport, file, offset, count)
+                    offset += count
+                    if self.progress is not None:
+                        self.progress("Sending", path, offset, size)
+                self.writer.write(encode_frame(f"/file_end {digest.hexdigest()}".encode('ascii')))
+                await self.writer.drain()
+        return True
+
+    async def quit(self):
+        """
+        Leaves the channel and closes the connection
+        """
+        if self.closed:
+            return
+        if self.connected.is_set():
+            try:
+                await self.write(b"/quit")
+            except OSError:
+                pass
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+        await self.wait_closed()
+
+    async def emit(self, message):
+        """
+        Hands a message to on_message, or to the iterator of the client
+
+        :param message: The text of the message, None once the client is closed
+        """
+        if self.on_message is None:
+            self.messages.put_nowait(message)
+        elif message is not None:
+            result = self.on_message(message)
+            if inspect.isawaitable(result):
+                await result
+
+    async def receive(self):
+        """
+        Reads messages from the server until the client is closed, connecting again when the connection is lost if
+        reconnect is set
+        """
+        while True:
+            decoder = FrameDecoder()
+            try:
+                while True:
+                    data = await self.reader.read(RECV_SIZE)
+                    if not data:
+                        break
+                    decoder.feed(data)
+                    for payload in decoder:
+                        await self.dispatch(payload, decoder.chunk)
+            except (OSError, ValueError):
+                pass
+
+            self.lost()
+            if self.closed or not self.reconnect:
+                break
+            await self.rejoin()
+            if self.closed:
+                break
+        self.closed = True
+        await self.emit(None)
+
+    def lost(self):
+        """
+        Cleans up after the connection is lost, calls waiting for an answer fail
+        """
+        self.connected.clear()
+        if self.writer is not None:
+            self.writer.close()
+        if self.download is not None:
+            self.download.file.close()
+            self.download = None
+        if self.file_reply is not None and not self.file_reply.done():
+            self.file_reply.set_exception(ConnectionError("The connection was lost."))
+        while self.list_waiters:
+            waiter = self.list_waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(ConnectionError("The connection was lost."))
+
+    async def rejoin(self):
+        """
+        Connects again until it works or the client is closed, then switches back to the channel it was in
+        """
+        delay = RECONNECT_DELAY
+        while not self.closed:
+            await asyncio.sleep(delay)
+            try:
+                await self.open()
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            self.rejoin_channel = self.channel
+            await self.emit(server_message("Connected again."))
+            return
+
+    async def dispatch(self, payload, chunk):
+        """
+        Handles one message from the server
+
+        :param payload: The bytes of the message
+        :param chunk: True if the frame holds a chunk of the file announced by /sending
+        """
+        # Messages to the client may arrive between the chunks, only the flagged frames belong to the file
+        if chunk:
+            if self.download is not None:
+                self.download.write(payload)
+            return
+
+        message = payload.decode('utf-8')
+        words = message.split(" ")
+
+        if self.download is not None and words[0] == "/sent":
+            name = self.download.name
+            if self.download.finish(words[1]):
+                await self.emit(server_message(f"Received {name}."))
+            else:
+                await self.emit(server_message(f"{name} was damaged in transfer."))
+            self.download = None
+        elif message == "/compress_ok":
+            self.compressing = True
+        elif message in ("/send_ok", "/send_bad_user"):
+            if self.file_reply is not None and not self.file_reply.done():
+                self.file_reply.set_result(message == "/send_ok")
+        elif words[0] == "/sending":
+            name = os.path.basename(words[1])
+            self.download = Download(os.path.join(self.download_dir, name), int(words[2]), self.progress)
+        elif message.startswith("[Channel] ") and self.list_waiters:
+            self.list_waiters.popleft().set_result(message)
+        elif message.endswith(" You are sending commands too fast.\n") and self.list_waiters:
+            self.list_waiters.popleft().set_exception(RuntimeError("Too many commands sent."))
+            await self.emit(message.strip('\n'))
+        else:
+            if message.startswith("[Server message") and " Welcome to the " in message:
+                self.channel = message.split(" Welcome to the ")[1].split(" ")[0]
+                if self.rejoin_channel is not None and self.rejoin_channel != self.channel:
+                    # The connection went to the first channel, move on to the one the client was in
+                    asyncio.ensure_future(self.switch(self.rejoin_channel))
+                self.rejoin_channel = None
+            await self.emit(message.strip('\n'))
@@ -0,0 +1,782 @@
+import argparse
+import errno
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+from chatprotocol import CHUNK_SIZE, FrameDecoder, encode_frame, encode_frames
+
+CONNECTING = "connecting"
+JOINING = "joining"
+CONNECTED = "connected"
+QUEUE = "queue"
+SWITCHING = "switching"
+SENDING = "sending"
+FAILED = "failed"
+
+CHAT = "chat"
+WHISPER = "whisper"
+SWITCH = "switch"
+LIST = "list"
+SEND = "send"
+ACTIONS = (CHAT, WHISPER, SWITCH, LIST, SEND)
+
+TICK = 0.01
+
+
+def read_config(path):
+    """
+    Reads the channels of a server config file
+
+    :param path: Path to the config file
+    :return: The name and port of every channel
+    """
+    channels = []
+    with open(path) as file:
+        for line in file.read().split('\n'):
+            config = line.split(" ")
+            if len(config) >= 4 and config[0] == "channel":
+                channels.append((config[1], int(config[2])))
+    return channels
+
+
+def process_rss(pid):
+    """
+    Adds up the resident memory of a process and of every process it started, such as the workers of a sharded server
+
+    :param pid: The process id
+    :return: The resident set size in bytes, None if it cannot be read
+    """
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            rss = next(int(line.split()[1]) * 1024 for line in file if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            children = [int(child) for child in file.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        rss += process_rss(child) or 0
+    return rss
+
+
+def percentiles(samples):
+    """
+    :param samples: The latencies in seconds
+    :return: The count, p50, p99, p999 and maximum in milliseconds, None for each if there are no samples
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0, "p50": None, "p99": None, "p999": None, "max": None}
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 3)
+    return {"count": len(samples), "p50": at(0.5), "p99": at(0.99), "p999": at(0.999), "max": at(1.0)}
+
+
+class Roster:
+    """
+    The users of one channel able to receive a whisper or a file, with constant time adding, removing and random picks
+    """
+    def __init__(self):
+        """
+        Constructor of the roster
+        """
+        self.users = []
+        self.index = {}
+
+    def add(self, user):
+        """
+        :param user: The user to add
+        """
+        if user.name not in self.index:
+            self.index[user.name] = len(self.users)
+            self.users.append(user)
+
+    def remove(self, user):
+        """
+        :param user: The user to remove, moved into its place is the last user of the list
+        """
+        position = self.index.pop(user.name, None)
+        if position is None:
+            return
+        last = self.users.pop()
+        if position < len(self.users):
+            self.users[position] = last
+            self.index[last.name] = position
+
+    def pick(self, exclude):
+        """
+        :param exclude: The user which must not be picked, usually the one sending
+        :return: A random other user, None if there is none
+        """
+        if len(self.users) < 2 and (not self.users or self.users[0] is exclude):
+            return None
+        while True:
+            user = random.choice(self.users)
+            if user is not exclude:
+                return user
+
+
+class Samples:
+    """
+    Keeps a uniform random sample of at most capacity values, so long runs do not hold every latency in memory
+    """
+    def __init__(self, capacity):
+        """
+        Constructor of the sample
+
+        :param capacity: How many values to keep at most
+        """
+        self.capacity = capacity
+        self.values = []
+        self.seen = 0
+
+    def add(self, value):
+        """
+        :param value: The value to consider for the sample
+        """
+        self.seen += 1
+        if len(self.values) < self.capacity:
+            self.values.append(value)
+            return
+        slot = random.randrange(self.seen)
+        if slot < self.capacity:
+            self.values[slot] = value
+
+
+class User:
+    """
+    One simulated client, speaking the framed protocol of chatclient.py over a non-blocking socket
+    """
+    def __init__(self, name, channel):
+        """
+        Constructor of the user
+
+        :param name: The username
+        :param channel: The channel the user joins first
+        """
+        self.name = name
+        self.channel = channel
+        self.state = CONNECTING
+        self.sock = None
+        self.decoder = FrameDecoder()
+        self.out = bytearray()
+        self.placed = False
+        self.list_sent = None
+        self.download = 0
+        self.download_started = None
+
+
+class Loader:
+    """
+    Drives the users of one load process from a single selector. Actions are spread over ticks of TICK seconds: every
+    tick each kind of action gets its rate times the number of active users times the tick length added to a budget,
+    and one action is made on a random user for every whole unit of budget.
+    """
+    def __init__(self, args, channels, names):
+        """
+        Constructor of the loader
+
+        :param args: The parsed command line arguments
+        :param channels: The name and port of every channel
+        :param names: The usernames and first channels of the users of this process
+        """
+        self.args = args
+        self.channels = channels
+        self.ports = dict(channels)
+        self.selector = selectors.DefaultSelector()
+        self.users = [User(name, channel) for name, channel in names]
+        self.rosters = {name: Roster() for name, port in channels}
+        self.active = Roster()
+        self.rates = {CHAT: args.chat_rate, WHISPER: args.whisper_rate, SWITCH: args.switch_rate,
+                      LIST: args.list_rate, SEND: args.send_rate}
+        self.budget = dict.fromkeys(ACTIONS, 0.0)
+        self.sent = dict.fromkeys(ACTIONS, 0)
+        self.received = dict.fromkeys(ACTIONS, 0)
+        self.errors = {}
+        self.latency = {kind: Samples(args.samples) for kind in (CHAT, WHISPER, LIST, SEND)}
+        self.measuring = False
+        self.placed = 0
+        self.padding = "x" * max(0, args.length - 25)
+        self.file = bytes(args.file_bytes)
+        self.file_digest = hashlib.sha256(self.file).hexdigest()
+
+    def error(self, kind):
+        """
+        :param kind: What went wrong
+        """
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def connect(self, user):
+        """
+        Starts connecting a user without waiting for the connection to complete
+
+        :param user: The user to connect
+        """
+        user.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        user.sock.setblocking(False)
+        result = user.sock.connect_ex((self.args.host, self.ports[user.channel]))
+        if result not in (0, errno.EINPROGRESS):
+            self.fail(user, "connect")
+            return
+        self.selector.register(user.sock, selectors.EVENT_WRITE, user)
+
+    def connected(self, user):
+        """
+        Sends the username once the connection is up
+
+        :param user: The user whose socket became writable
+        """
+        if user.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            self.fail(user, "connect")
+            return
+        user.state = JOINING
+        self.selector.modify(user.sock, selectors.EVENT_READ, user)
+        self.write(user, encode_frame(user.name.encode('ascii')))
+
+    def fail(self, user, kind):
+        """
+        Gives up on a user
+
+        :param user: The user
+        :param kind: What went wrong
+        """
+        self.error(kind)
+        self.leave(user)
+        if user.sock is not None:
+            try:
+                self.selector.unregister(user.sock)
+            except (KeyError, ValueError):
+                pass
+            user.sock.close()
+        user.state = FAILED
+        self.place(user)
+
+    def place(self, user):
+        """
+        Counts a user which has been connected to or queued for its first channel, or has failed
+
+        :param user: The user
+        """
+        if not user.placed:
+            user.placed = True
+            self.placed += 1
+
+    def join(self, user):
+        """
+        Marks a user as connected to its channel, able to act and to receive whispers and files
+
+        :param user: The user
+        """
+        user.state = CONNECTED
+        self.rosters[user.channel].add(user)
+        self.active.add(user)
+        self.place(user)
+
+    def leave(self, user):
+        """
+        Marks a user as unable to act until the server has answered
+
+        :param user: The user
+        """
+        self.rosters[user.channel].remove(user)
+        self.active.remove(user)
+
+    def write(self, user, data):
+        """
+        Sends bytes to the server, keeping what the socket does not take until it is writable again
+
+        :param user: The sending user
+        :param data: The framed bytes
+        """
+        if user.state == FAILED:
+            return
+        if not user.out:
+            try:
+                sent = user.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.fail(user, "send")
+                return
+            if sent == len(data):
+                return
+            data = data[sent:]
+            self.selector.modify(user.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, user)
+        user.out += data
+
+    def flush(self, user):
+        """
+        Sends what is waiting once the socket is writable
+
+        :param user: The user
+        """
+        try:
+            sent = user.sock.send(user.out)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.fail(user, "send")
+            return
+        del user.out[:sent]
+        if not user.out:
+            self.selector.modify(user.sock, selectors.EVENT_READ, user)
+
+    def readable(self, user):
+        """
+        Reads and handles everything the server sent to a user
+
+        :param user: The user
+        """
+        try:
+            data = user.sock.recv(1 << 16)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.fail(user, "disconnected")
+            return
+        user.decoder.feed(data)
+        try:
+            for payload in user.decoder:
+                self.handle(user, payload, user.decoder.chunk)
+                if user.state == FAILED:
+                    break
+        except ValueError:
+            self.fail(user, "protocol")
+
+    def handle(self, user, payload, chunk):
+        """
+        Handles one frame sent to a user
+
+        :param user: The user
+        :param payload: The bytes of the frame
+        :param chunk: True if the frame holds a chunk of a file
+        """
+        now = time.monotonic()
+        if chunk:
+            user.download -= len(payload)
+            return
+
+        text = payload.decode('utf-8', 'replace').rstrip('\n')
+        if text.startswith("/sending "):
+            name, size = text.split(" ")[1:3]
+            user.download = int(size)
+            user.download_started = name
+        elif text.startswith("/sent "):
+            if text.split(" ")[1] != self.file_digest:
+                self.error("file damaged")
+            elif self.measuring and user.download_started is not None:
+                self.received[SEND] += 1
+                self.latency[SEND].add(now - int(user.download_started[4:-4]) / 1e9)
+            user.download = 0
+            user.download_started = None
+        elif text == "/send_ok":
+            frames = [f"/file {len(self.file)}".encode('ascii')]
+            frames += [self.file[start:start + CHUNK_SIZE] for start in range(0, len(self.file), CHUNK_SIZE)]
+            frames.append(f"/file_end {self.file_digest}".encode('ascii'))
+            self.write(user, encode_frames(frames))
+            self.join(user)
+        elif text == "/send_bad_user":
+            self.error("send target gone")
+            self.join(user)
+        elif text.startswith("[Channel] "):
+            if user.list_sent is not None:
+                if self.measuring:
+                    self.received[LIST] += 1
+                    self.latency[LIST].add(now - user.list_sent)
+                user.list_sent = None
+        elif text.startswith("[Server message"):
+            self.server_message(user, text)
+        elif " whispers to you: " in text:
+            self.delivered(user, WHISPER, text, now)
+        else:
+            self.delivered(user, CHAT, text, now)
+
+    def server_message(self, user, text):
+        """
+        Follows the state of a user from the server messages sent to it
+
+        :param user: The user
+        :param text: The message
+        """
+        text = text[text.find("] ") + 2:]
+        if text.startswith("Welcome to the "):
+            user.channel = text.split(" ")[3]
+        elif text == f"{user.name} has joined the channel.":
+            self.join(user)
+        elif text.startswith("You are in the waiting queue"):
+            if user.state in (JOINING, SWITCHING):
+                user.state = QUEUE
+                self.active.add(user)
+                self.place(user)
+        elif text.startswith("Cannot connect"):
+            self.fail(user, "name taken")
+        elif text.startswith("Cannot switch") or text.endswith("does not exist."):
+            self.error("switch refused")
+            self.join(user)
+        elif text.endswith("is not here."):
+            self.error("whisper target gone")
+        elif text.startswith("You are still muted"):
+            self.error("muted")
+
+    def delivered(self, user, kind, text, now):
+        """
+        Records the delivery latency of a chat message or whisper sent by a load process. Messages replayed from the
+        history arrive before the user is marked connected, so they are not counted.
+
+        :param user: The receiving user
+        :param kind: CHAT or WHISPER
+        :param text: The message
+        :param now: When it arrived
+        """
+        start = text.find("] load ")
+        if start == -1 or not self.measuring or user.state != CONNECTED:
+            return
+        try:
+            sent = int(text[start + 7:].split(" ")[0]) / 1e9
+        except ValueError:
+            return
+        self.received[kind] += 1
+        self.latency[kind].add(now - sent)
+
+    def act(self, kind):
+        """
+        Makes one action on a random active user
+
+        :param kind: CHAT, WHISPER, SWITCH, LIST or SEND
+        """
+        user = self.active.pick(None)
+        if user is None:
+            return
+        if user.state == QUEUE and kind != LIST:
+            return
+        stamp = time.monotonic_ns()
+
+        if kind == CHAT:
+            self.write(user, encode_frame(f"load {stamp} {self.padding}".encode('ascii')))
+        elif kind == WHISPER:
+            target = self.rosters[user.channel].pick(user)
+            if target is None:
+                return
+            self.write(user, encode_frame(f"/whisper {target.name} load {stamp}".encode('ascii')))
+        elif kind == SWITCH:
+            if len(self.channels) < 2:
+                return
+            channel = random.choice([name for name, port in self.channels if name != user.channel])
+            self.leave(user)
+            user.state = SWITCHING
+            self.write(user, encode_frame(f"/switch {channel}".encode('ascii')))
+        elif kind == LIST:
+            if user.list_sent is not None:
+                return
+            user.list_sent = time.monotonic()
+            self.write(user, encode_frame(b"/list"))
+        elif kind == SEND:
+            target = self.rosters[user.channel].pick(user)
+            if target is None:
+                return
+            # The receiver reads the send time back from the file name
+            self.leave(user)
+            user.state = SENDING
+            self.write(user, encode_frame(f"/send {target.name} load{stamp}.bin".encode('ascii')))
+        self.sent[kind] += 1
+
+    def poll(self, timeout):
+        """
+        Handles the socket events of one select call
+
+        :param timeout: The longest time to wait in seconds
+        """
+        for key, events in self.selector.select(timeout):
+            user = key.data
+            if user.state == FAILED:
+                continue
+            if user.state == CONNECTING:
+                self.connected(user)
+                continue
+            if events & selectors.EVENT_READ:
+                self.readable(user)
+            if events & selectors.EVENT_WRITE and user.out and user.state != FAILED:
+                self.flush(user)
+
+    def ramp(self, rate, deadline):
+        """
+        Connects every user, at most rate new connections a second, and waits until each is in a channel or queue
+
+        :param rate: Connections started per second, 0 to start them all at once
+        :param deadline: The monotonic time to give up at
+        :return: The monotonic time the last user was placed
+        """
+        start = time.monotonic()
+        started = 0
+        while self.placed < len(self.users) and time.monotonic() < deadline:
+            due = len(self.users) if rate <= 0 else min(len(self.users), int((time.monotonic() - start) * rate) + 1)
+            while started < due:
+                self.connect(self.users[started])
+                started += 1
+            self.poll(TICK)
+        for user in self.users:
+            if not user.placed:
+                self.fail(user, "ramp timeout")
+        return time.monotonic()
+
+    def run(self, duration):
+        """
+        Makes actions at the configured rates for the given time
+
+        :param duration: How long to run in seconds
+        """
+        self.measuring = True
+        start = last = time.monotonic()
+        while last - start < duration:
+            self.poll(TICK)
+            now = time.monotonic()
+            active = len(self.active.users)
+            for kind in ACTIONS:
+                self.budget[kind] += self.rates[kind] * active * (now - last)
+                while self.budget[kind] >= 1:
+                    self.budget[kind] -= 1
+                    self.act(kind)
+            last = now
+
+    def drain(self, duration):
+        """
+        Keeps reading for a while after the run so messages still on their way are counted
+
+        :param duration: How long to keep reading in seconds
+        """
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            self.poll(TICK)
+        self.measuring = False
+
+    def results(self):
+        """
+        :return: The counts and latency samples of this process
+        """
+        states = {}
+        for user in self.users:
+            states[user.state] = states.get(user.state, 0) + 1
+        return {"sent": self.sent, "received": self.received, "errors": self.errors, "states": states,
+                "latency": {kind: samples.values for kind, samples in self.latency.items()},
+                "seen": {kind: samples.seen for kind, samples in self.latency.items()}}
+
+
+def run_loader(args, channels, names, begin, ramped, results):
+    """
+    The main function of a load process
+
+    :param args: The parsed command line arguments
+    :param channels: The name and port of every channel
+    :param names: The usernames and first channels of the users of this process
+    :param begin: Event set by the main process once every load process is ready to ramp
+    :param ramped: Shared counter of the load processes which have connected all their users
+    :param results: Queue the results are put on
+    """
+    loader = Loader(args, channels, names)
+    begin.wait()
+    finished = loader.ramp(args.ramp_rate / args.processes, time.monotonic() + args.ramp_timeout)
+    with ramped.get_lock():
+        ramped.value += 1
+    # Keeps reading while the other processes ramp, so the server never waits on this one
+    while ramped.value < args.processes:
+        loader.poll(TICK)
+    loader.run(args.duration)
+    loader.drain(args.drain)
+    result = loader.results()
+    result["ramped"] = finished
+    results.put(result)
+
+
+def raise_file_limit():
+    """
+    Raises the limit of open files to the hard limit, thousands of users need as many sockets
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def start_server(args):
+    """
+    Starts chatserver.py with the config file and the extra arguments given
+
+    :param args: The parsed command line arguments
+    :return: The server process
+    """
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "chatserver.py"),
+                               args.config] + args.server_arg, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, text=True)
+    time.sleep(args.server_wait)
+    return server
+
+
+def report(args, channels, outcome, ramp_time, rss):
+    """
+    Adds up the results of every load process
+
+    :param args: The parsed command line arguments
+    :param channels: The name and port of every channel
+    :param outcome: The results of the load processes
+    :param ramp_time: Seconds until the last user was placed
+    :param rss: The server memory at the start, after the ramp, and at its peak during the run, None if not known
+    :return: The report as a dictionary
+    """
+    sent = dict.fromkeys(ACTIONS, 0)
+    received = dict.fromkeys(ACTIONS, 0)
+    errors = {}
+    states = {}
+    latency = {kind: [] for kind in (CHAT, WHISPER, LIST, SEND)}
+    for result in outcome:
+        for kind in ACTIONS:
+            sent[kind] += result["sent"][kind]
+            received[kind] += result["received"][kind]
+        for part, total in (("errors", errors), ("states", states)):
+            for key, value in result[part].items():
+                total[key] = total.get(key, 0) + value
+        for kind, values in result["latency"].items():
+            latency[kind] += values
+
+    return {
+        "config": {"users": args.users, "channels": len(channels), "processes": args.processes,
+                   "duration": args.duration, "rates": {CHAT: args.chat_rate, WHISPER: args.whisper_rate,
+                                                        SWITCH: args.switch_rate, LIST: args.list_rate,
+                                                        SEND: args.send_rate},
+                   "length": args.length, "file_bytes": args.file_bytes, "server_args": args.server_arg},
+        "ramp": {"seconds": round(ramp_time, 3), "connected": states.get(CONNECTED, 0) + states.get(SWITCHING, 0)
+                 + states.get(SENDING, 0), "queued": states.get(QUEUE, 0), "failed": states.get(FAILED, 0)},
+        "sent": sent,
+        "sent_per_second": {kind: round(count / args.duration, 1) for kind, count in sent.items()},
+        "received": received,
+        "received_per_second": {kind: round(count / args.duration, 1) for kind, count in received.items()},
+        "latency_ms": {kind: percentiles(values) for kind, values in latency.items()},
+        "errors": errors,
+        "server_rss_bytes": rss,
+    }
+
+
+def print_report(result):
+    """
+    Prints the report in a readable form
+
+    :param result: The report
+    """
+    ramp = result["ramp"]
+    print(f"ramp: {ramp['connected']} connected, {ramp['queued']} queued, {ramp['failed']} failed in "
+          f"{ramp['seconds']:.2f}s", flush=True)
+    print(f"{'action':>8} {'sent/s':>9} {'recv/s':>10} {'p50':>9} {'p99':>9} {'p999':>9}")
+    for kind in ACTIONS:
+        stats = result["latency_ms"].get(kind)
+        columns = ""
+        if stats is not None and stats["count"]:
+            columns = f"{stats['p50']:>7.2f}ms {stats['p99']:>7.2f}ms {stats['p999']:>7.2f}ms"
+        print(f"{kind:>8} {result['sent_per_second'][kind]:>9.1f} {result['received_per_second'][kind]:>10.1f} "
+              f"{columns}", flush=True)
+    if result["server_rss_bytes"] is not None:
+        rss = result["server_rss_bytes"]
+        print("server rss: " + ", ".join(f"{stage} {value / (1 << 20):.1f} MiB" for stage, value in rss.items()
+                                          if value is not None), flush=True)
+    if result["errors"]:
+        print("errors: " + ", ".join(f"{kind} {count}" for kind, count in sorted(result["errors"].items())),
+              flush=True)
+
+
+def parse_args():
+    """
+    Parses the command line arguments of the load generator
+    """
+    parser = argparse.ArgumentParser(description="Load generator for the chat server.")
+    parser.add_argument("config", help="path to the channel config file of the server")
+    parser.add_argument("--host", default=socket.gethostbyname(socket.gethostname()), help="address of the server")
+    parser.add_argument("--users", type=int, default=1000, help="simulated users, spread evenly over the channels")
+    parser.add_argument("--processes", type=int, default=max(1, min(4, (os.cpu_count() or 1) // 2)),
+                        help="load processes the users are split across")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run the load for after the ramp")
+    parser.add_argument("--drain", type=float, default=1, help="seconds to keep reading after the run")
+    parser.add_argument("--ramp-rate", type=float, default=0, help="new connections per second, 0 for all at once")
+    parser.add_argument("--ramp-timeout", type=float, default=60, help="seconds to wait for every user to be placed")
+    parser.add_argument("--chat-rate", type=float, default=0.05, help="chat messages per user per second")
+    parser.add_argument("--whisper-rate", type=float, default=0.02, help="whispers per user per second")
+    parser.add_argument("--switch-rate", type=float, default=0.005, help="channel switches per user per second")
+    parser.add_argument("--list-rate", type=float, default=0.02, help="/list requests per user per second")
+    parser.add_argument("--send-rate", type=float, default=0.001, help="file transfers per user per second")
+    parser.add_argument("--length", type=int, default=80, help="length of a chat message")
+    parser.add_argument("--file-bytes", type=int, default=64 * 1024, help="size of a transferred file")
+    parser.add_argument("--samples", type=int, default=100000,
+                        help="latencies kept per kind of message and load process, picked at random beyond that")
+    parser.add_argument("--spawn", action="store_true", help="start chatserver.py with the config file for the run")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="argument passed on to the spawned server, may be given several times")
+    parser.add_argument("--server-wait", type=float, default=2, help="seconds to wait for the spawned server to start")
+    parser.add_argument("--pid", type=int, help="process id of a running server to measure the memory of")
+    parser.add_argument("--json", help="file to write the results to as JSON, - for stdout")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    raise_file_limit()
+    channels = read_config(args.config)
+    server = start_server(args) if args.spawn else None
+    pid = server.pid if server is not None else args.pid
+
+    names = [(f"load{i}", channels[i % len(channels)][0]) for i in range(args.users)]
+    begin = multiprocessing.Event()
+    ramped = multiprocessing.Value('i', 0)
+    results = multiprocessing.Queue()
+    processes = []
+    for index in range(args.processes):
+        process = multiprocessing.Process(target=run_loader, args=(args, channels, names[index::args.processes],
+                                                                   begin, ramped, results), daemon=True)
+        process.start()
+        processes.append(process)
+
+    time.sleep(0.5)
+    rss = {"start": process_rss(pid), "ramped": None, "peak": None} if pid is not None else None
+    start = time.monotonic()
+    begin.set()
+    while ramped.value < args.processes and any(process.is_alive() for process in processes):
+        time.sleep(TICK)
+    if rss is not None:
+        rss["ramped"] = rss["peak"] = process_rss(pid)
+
+    outcome = []
+    while len(outcome) < args.processes:
+        try:
+            outcome.append(results.get(timeout=0.5))
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                break
+        if rss is not None:
+            rss["peak"] = max(rss["peak"] or 0, process_rss(pid) or 0)
+    ramp_time = max((result["ramped"] for result in outcome), default=start) - start
+
+    result = report(args, channels, outcome, ramp_time, rss)
+    print_report(result)
+    if args.json == "-":
+        print(json.dumps(result, indent=2))
+    elif args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+
+    if server is not None:
+        server.stdin.write("/shutdown\n")
+        server.stdin.flush()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
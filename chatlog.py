@@ -0,0 +1,374 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD = struct.Struct('!IIdB')
+CHAT = 1
+WHISPER = 2
+JOIN = 3
+LEAVE = 4
+SEGMENT_BYTES = 16 << 20
+COMMIT_INTERVAL = 0.05
+COMMIT_BYTES = 1 << 20
+# Most bytes of records a channel keeps in memory while its log cannot be written, newer records are dropped
+PENDING_BYTES = 64 << 20
+
+
+def encode_record(kind, payload, when):
+    """
+    Packs one record: its length, a checksum of the payload, when it happened and what kind of event it is
+
+    :param kind: CHAT, WHISPER, JOIN or LEAVE
+    :param payload: The bytes of the message
+    :param when: The time.time() of the event
+    :return: The bytes of the record
+    """
+    return RECORD.pack(len(payload), zlib.crc32(payload), when, kind) + payload
+
+
+def scan(data, start=0):
+    """
+    Walks the records in a segment, stopping at the first record which is cut short or damaged, such as one being
+    written when the server stopped
+
+    :param data: The segment contents, usually an mmap
+    :param start: The offset to start at
+    :return: Yields the offset, time, kind and payload of every record, the payload as a memoryview of data
+    """
+    view = memoryview(data)
+    offset = start
+    try:
+        while offset + RECORD.size <= len(data):
+            length, checksum, when, kind = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + length
+            if end > len(data):
+                return
+            payload = view[offset + RECORD.size:end]
+            if zlib.crc32(payload) != checksum:
+                return
+            yield offset, when, kind, payload
+            offset = end
+    finally:
+        view.release()
+
+
+def valid_length(path):
+    """
+    :param path: The segment file
+    :return: The length of the segment up to the end of its last complete record
+    """
+    if os.path.getsize(path) == 0:
+        return 0
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        end = 0
+        for offset, when, kind, payload in scan(data):
+            end = offset + RECORD.size + len(payload)
+            payload.release()
+        return end
+
+
+class ChannelLog:
+    """
+    The append-only log of one channel, kept as numbered segment files in its own directory. Appending only copies
+    the record into memory, the MessageLog writes and syncs every pending record of a channel together.
+    """
+    def __init__(self, directory, segment_bytes, pending_limit=PENDING_BYTES):
+        """
+        Constructor of the log, opens the newest segment for appending and cuts off a partly written record left by a
+        crash
+
+        :param directory: The directory of the channel
+        :param segment_bytes: The size after which a new segment is started
+        :param pending_limit: Most bytes of records kept waiting while the disk fails
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.pending_limit = pending_limit
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.records = 0
+        self.failing = False
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self.segments()
+        self.number = int(os.path.basename(segments[-1]).split('.')[0]) if segments else 0
+        path = self.segment_path(self.number)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self.size = valid_length(path)
+        os.ftruncate(self.fd, self.size)
+        os.lseek(self.fd, self.size, os.SEEK_SET)
+
+    def segment_path(self, number):
+        """
+        :param number: The number of the segment
+        :return: The path of the segment file
+        """
+        return os.path.join(self.directory, f"{number:08d}.log")
+
+    def segments(self):
+        """
+        :return: The paths of every segment, oldest first
+        """
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.endswith('.log'))
+
+    def append(self, kind, payload, when=None):
+        """
+        Adds a record to the log. Nothing is written here, so the caller never waits on the disk. Once pending_limit
+        are waiting, which only happens while the disk fails, the record is dropped and counted instead.
+
+        :param kind: CHAT, WHISPER, JOIN or LEAVE
+        :param payload: The bytes of the message
+        :param when: The time of the event, now if not given
+        """
+        record = encode_record(kind, payload, time.time() if when is None else when)
+        with self.lock:
+            if len(self.pending) >= self.pending_limit:
+                self.dropped += 1
+                return
+            self.pending += record
+            self.records += 1
+
+    def commit(self):
+        """
+        Writes every pending record with one write call and syncs the segment once, called by the writer thread. If the
+        disk fails the records are put back in front of the pending ones, so they are written by a later commit.
+
+        :return: The number of bytes written
+        :raises OSError: If the records could not be written and synced
+        """
+        with self.lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, bytearray()
+
+        try:
+            if self.size > 0 and self.size + len(batch) > self.segment_bytes:
+                # Records never span segments, so each segment can be read on its own
+                fd = os.open(self.segment_path(self.number + 1), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                os.close(self.fd)
+                self.fd = fd
+                self.number += 1
+                self.size = 0
+
+            view = memoryview(batch)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+            os.fsync(self.fd)
+        except OSError:
+            self.rewind()
+            with self.lock:
+                self.pending[:0] = batch
+            raise
+        self.size += len(batch)
+        self.commits += 1
+        return len(batch)
+
+    def rewind(self):
+        """
+        Cuts off whatever part of a failed commit reached the segment, so it is not written twice
+        """
+        try:
+            os.ftruncate(self.fd, self.size)
+            os.lseek(self.fd, self.size, os.SEEK_SET)
+        except OSError:
+            pass
+
+    def pending_bytes(self):
+        """
+        :return: How many bytes wait to be written
+        """
+        with self.lock:
+            return len(self.pending)
+
+    def read(self):
+        """
+        Replays every record which has been written, oldest first, reading the segments through mmap
+
+        :return: Yields the time, kind and payload bytes of every record
+        """
+        for path in self.segments():
+            yield from self.read_segment(path)
+
+    def read_segment(self, path):
+        """
+        Replays the records of one segment
+
+        :param path: The segment file
+        :return: Yields the time, kind and payload bytes of every record
+        """
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, when, kind, payload in scan(data):
+                yield when, kind, bytes(payload)
+                payload.release()
+
+    def tail(self, count, kind):
+        """
+        Fetches the newest records of one kind, reading back from the newest segment only as far as needed
+
+        :param count: How many records to fetch at most
+        :param kind: The kind of record
+        :return: The payloads, oldest first
+        """
+        found = []
+        for path in reversed(self.segments()):
+            found = [payload for when, record_kind, payload in self.read_segment(path) if record_kind == kind] + found
+            if len(found) >= count:
+                break
+        return found[-count:] if count > 0 else []
+
+    def search(self, text):
+        """
+        Finds every record holding the given bytes. mmap.find jumps from one match to the next, so only the payloads a
+        match falls in are checked and segments without any match are not walked at all.
+
+        :param text: The bytes to look for
+        :return: Yields the time, kind and payload bytes of every matching record
+        """
+        for path in self.segments():
+            if os.path.getsize(path) == 0:
+                continue
+            with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                hit = data.find(text)
+                if hit == -1:
+                    continue
+                for offset, when, kind, payload in scan(data):
+                    end = offset + RECORD.size + len(payload)
+                    if hit < end:
+                        # The match found may start in the header or run into the next record, so look again within
+                        # the payload
+                        if data.find(text, offset + RECORD.size, end) != -1:
+                            yield when, kind, bytes(payload)
+                        hit = data.find(text, end)
+                    payload.release()
+                    if hit == -1:
+                        break
+
+    def close(self):
+        """
+        Writes what is left and closes the segment. The segment is closed even if the disk fails, the records which
+        could not be written are then dropped and counted.
+
+        :raises OSError: If the records left could not be written
+        """
+        try:
+            self.commit()
+        except OSError:
+            with self.lock:
+                for offset, when, kind, payload in scan(self.pending):
+                    payload.release()
+                    self.dropped += 1
+                self.pending = bytearray()
+            raise
+        finally:
+            os.close(self.fd)
+
+
+class MessageLog:
+    """
+    The logs of every channel and the thread which commits them. Records are written in groups: every commit_interval
+    seconds, or sooner once commit_bytes are waiting, each channel with pending records is written with one call and
+    synced once, so a burst of messages costs one fsync rather than one per message.
+    """
+    def __init__(self, directory, commit_interval=COMMIT_INTERVAL, commit_bytes=COMMIT_BYTES,
+                 segment_bytes=SEGMENT_BYTES, pending_limit=PENDING_BYTES, on_error=None):
+        """
+        Constructor of the message log, starts the writer thread
+
+        :param directory: The directory holding a subdirectory for every channel
+        :param commit_interval: The longest time in seconds a record waits before it is written
+        :param commit_bytes: How many pending bytes cause a commit before the interval is over
+        :param segment_bytes: The size after which a channel starts a new segment
+        :param pending_limit: Most bytes of records a channel keeps waiting while its log cannot be written
+        :param on_error: Called with the directory of a channel, the OSError and the number of records dropped since
+                         the last call when its log first fails to commit or fails to close, and with None instead of
+                         the OSError once a commit succeeds again
+        """
+        self.directory = directory
+        self.on_error = on_error
+        self.commit_interval = commit_interval
+        self.commit_bytes = commit_bytes
+        self.segment_bytes = segment_bytes
+        self.pending_limit = pending_limit
+        self.logs = {}
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def channel(self, name):
+        """
+        :param name: The name of the channel
+        :return: The ChannelLog of the channel, created if it does not exist yet
+        """
+        if name not in self.logs:
+            self.logs[name] = ChannelLog(os.path.join(self.directory, name), self.segment_bytes, self.pending_limit)
+        return self.logs[name]
+
+    def append(self, log, kind, payload):
+        """
+        Adds a record to a channel log and wakes the writer early if enough is waiting
+
+        :param log: The ChannelLog
+        :param kind: CHAT, WHISPER, JOIN or LEAVE
+        :param payload: The bytes of the message
+        """
+        log.append(kind, payload)
+        if len(log.pending) >= self.commit_bytes:
+            self.wakeup.set()
+
+    def run(self):
+        """
+        The writer thread, commits every channel log once per interval until the log is closed
+        """
+        while self.running:
+            self.wakeup.wait(self.commit_interval)
+            self.wakeup.clear()
+            for log in list(self.logs.values()):
+                try:
+                    log.commit()
+                except OSError as error:
+                    # The records are kept and tried again every interval, the failure is reported once
+                    if not log.failing:
+                        self.report(log, error)
+                    log.failing = True
+                    continue
+                if log.failing:
+                    log.failing = False
+                    self.report(log, None)
+
+    def report(self, log, error):
+        """
+        Passes a failure of a channel log, or the end of one, to on_error along with the records dropped since the
+        last report
+
+        :param log: The ChannelLog
+        :param error: The OSError, None once the log is written again
+        """
+        if self.on_error is None:
+            return
+        with log.lock:
+            dropped, log.dropped = log.dropped, 0
+        self.on_error(log.directory, error, dropped)
+
+    def close(self):
+        """
+        Stops the writer thread, writes every record still pending and closes every channel log. A log which cannot
+        be written is reported and closed anyway, so closing never fails.
+        """
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        for log in self.logs.values():
+            try:
+                log.close()
+            except OSError as error:
+                self.report(log, error)
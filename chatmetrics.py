@@ -0,0 +1,265 @@
+import bisect
+import collections
+import http.server
+import threading
+import time
+
+MESSAGES = 'chat_messages_total'
+WHISPERS = 'chat_whispers_total'
+BYTES_IN = 'chat_received_bytes_total'
+BYTES_OUT = 'chat_sent_bytes_total'
+DELIVERIES = 'chat_deliveries_total'
+SEND_CALLS = 'chat_send_calls_total'
+TIMEOUTS = 'chat_timeouts_total'
+KICKS = 'chat_kicks_total'
+THROTTLED = 'chat_throttled_total'
+CONNECTED_CLIENTS = 'chat_connected_clients'
+QUEUED_CLIENTS = 'chat_queued_clients'
+OUTBOX_BYTES = 'chat_outbox_bytes'
+CONSOLE_DROPPED = 'chat_console_dropped_total'
+BROADCAST_SECONDS = 'chat_broadcast_seconds'
+SEND_SECONDS = 'chat_send_seconds'
+START_TIME = 'chat_start_time_seconds'
+
+METRICS = {
+    MESSAGES: ('counter', "Chat messages broadcast in the channel."),
+    WHISPERS: ('counter', "Whispers sent in the channel."),
+    BYTES_IN: ('counter', "Bytes received from the clients of the channel."),
+    BYTES_OUT: ('counter', "Bytes sent to the clients of the channel."),
+    DELIVERIES: ('counter', "Messages queued for a recipient by a broadcast."),
+    SEND_CALLS: ('counter', "Send calls made to client sockets."),
+    TIMEOUTS: ('counter', "Clients dropped from the channel for being AFK."),
+    KICKS: ('counter', "Clients kicked from the channel."),
+    THROTTLED: ('counter', "Messages and commands dropped for going over the flood limits of the channel."),
+    CONNECTED_CLIENTS: ('gauge', "Clients connected to the channel."),
+    QUEUED_CLIENTS: ('gauge', "Clients in the waiting queue of the channel."),
+    OUTBOX_BYTES: ('gauge', "Bytes waiting to be sent to the clients of the channel."),
+    CONSOLE_DROPPED: ('counter', "Server messages dropped because the console could not keep up."),
+    BROADCAST_SECONDS: ('histogram', "Time taken to queue a broadcast for every recipient."),
+    SEND_SECONDS: ('histogram', "Time taken by a send call to a client, only every 8th call is timed."),
+    START_TIME: ('gauge', "Unix time the server started at."),
+}
+
+# Only one send call in this many is timed, the others cost one addition
+SEND_SAMPLE = 8
+
+# Upper bounds of the latency buckets in seconds, from a microsecond to a second
+BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1,
+           0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """
+    Counts observed values in fixed buckets, so recording a value is one bisect and three additions no matter how many
+    values have been seen
+    """
+    def __init__(self, bounds=BUCKETS):
+        """
+        Constructor of the histogram
+
+        :param bounds: The upper bounds of the buckets, in increasing order. A last bucket holds everything larger.
+        """
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        :param value: The value to record
+        """
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """
+        :return: The counts of every bucket, the sum and the count of the values
+        """
+        return list(self.buckets), self.sum, self.count
+
+
+class Metrics:
+    """
+    The counters and histograms of one server process. Updates take no lock, so they cost little enough to always be
+    on; in threaded mode two threads counting at the same moment may very rarely lose one count.
+    """
+    def __init__(self):
+        """
+        Constructor of the metrics
+        """
+        self.started = time.time()
+        self.counters = collections.defaultdict(int)
+        self.sends = 0
+        self.histograms = {name: Histogram() for name, (kind, text) in METRICS.items() if kind == 'histogram'}
+
+    def count(self, name, label=None, amount=1):
+        """
+        Adds to a counter
+
+        :param name: The name of the counter
+        :param label: The channel the count belongs to, None for the whole server
+        :param amount: How much to add
+        """
+        self.counters[name, label] += amount
+
+    def observe(self, name, value):
+        """
+        Records a value in a histogram
+
+        :param name: The name of the histogram
+        :param value: The value, a duration in seconds
+        """
+        self.histograms[name].observe(value)
+
+    def snapshot(self, gauges):
+        """
+        Copies the current values, so they can be sent to another process or rendered without holding anything up
+
+        :param gauges: The current values of the gauges, keyed by name and label like the counters
+        :return: A dictionary holding every value
+        """
+        counters = dict(self.counters)
+        counters[SEND_CALLS, None] = self.sends
+        return {"time": time.time(), "started": self.started, "counters": counters, "gauges": gauges,
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+
+
+def merge(snapshots):
+    """
+    Adds up the snapshots of several worker processes
+
+    :param snapshots: The snapshots to merge
+    :return: One snapshot holding the totals
+    """
+    merged = {"time": time.time(), "started": min((snapshot["started"] for snapshot in snapshots), default=time.time()),
+              "counters": {}, "gauges": {}, "histograms": {}}
+    for snapshot in snapshots:
+        for part in ("counters", "gauges"):
+            for key, value in snapshot[part].items():
+                merged[part][key] = merged[part].get(key, 0) + value
+        for name, (buckets, values_sum, count) in snapshot["histograms"].items():
+            if name in merged["histograms"]:
+                old_buckets, old_sum, old_count = merged["histograms"][name]
+                buckets = [old + new for old, new in zip(old_buckets, buckets)]
+                values_sum += old_sum
+                count += old_count
+            merged["histograms"][name] = (buckets, values_sum, count)
+    return merged
+
+
+def total(values, name):
+    """
+    :param values: The counters or gauges of a snapshot
+    :param name: The name of the metric
+    :return: The sum of the metric over every channel
+    """
+    return sum(value for (key, label), value in values.items() if key == name)
+
+
+def quantile(histogram, fraction, bounds=BUCKETS):
+    """
+    Estimates a quantile of a histogram by the upper bound of the bucket it falls in
+
+    :param histogram: The buckets, sum and count of the histogram
+    :param fraction: The quantile, e.g. 0.99
+    :param bounds: The upper bounds of the buckets
+    :return: The estimate in seconds, None if nothing was recorded
+    """
+    buckets, values_sum, count = histogram
+    if count == 0:
+        return None
+    rank = fraction * count
+    seen = 0
+    for index, bucket in enumerate(buckets):
+        seen += bucket
+        if seen >= rank:
+            return bounds[min(index, len(bounds) - 1)]
+    return bounds[-1]
+
+
+def labels(label, extra=''):
+    """
+    :param label: The channel name, None for none
+    :param extra: More labels already formatted, such as le="0.5"
+    :return: The label set of a sample
+    """
+    parts = []
+    if label is not None:
+        parts.append('channel="' + label.replace('\\', '\\\\').replace('"', '\\"') + '"')
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def render(snapshot):
+    """
+    Formats a snapshot in the Prometheus text format
+
+    :param snapshot: The snapshot to format
+    :return: The text
+    """
+    lines = []
+    values = dict(snapshot["counters"])
+    values.update(snapshot["gauges"])
+    values[START_TIME, None] = snapshot["started"]
+    for name, (kind, text) in METRICS.items():
+        samples = sorted((label or '', value) for (key, label), value in values.items() if key == name)
+        if kind != 'histogram' and not samples:
+            continue
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'histogram':
+            buckets, values_sum, count = snapshot["histograms"][name]
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + (None,), buckets):
+                cumulative += bucket
+                le = 'le="' + ('+Inf' if bound is None else repr(bound)) + '"'
+                lines.append(f"{name}_bucket{labels(None, le)} {cumulative}")
+            lines.append(f"{name}_sum {values_sum}")
+            lines.append(f"{name}_count {count}")
+            continue
+        for label, value in samples:
+            lines.append(f"{name}{labels(label or None)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every GET of /metrics with the current values in the Prometheus text format
+    """
+    def do_GET(self):
+        """
+        Handles one request
+        """
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render(self.server.collect()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Scrapes are not written to the console
+        """
+        return
+
+
+def serve(port, collect):
+    """
+    Serves the metrics over HTTP on localhost from a background thread
+
+    :param port: The port to listen on
+    :param collect: Function called without arguments which returns the current snapshot
+    :return: The HTTP server
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    server.daemon_threads = True
+    server.collect = collect
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,248 @@
+import struct
+import zlib
+
+HEADER = struct.Struct('!I')
+MAX_FRAME = 1 << 20
+CHUNK_SIZE = 1 << 16
+# The top bits of the length prefix flag compressed frames, which are only sent once compression was agreed on.
+# STREAM frames continue the deflate stream of the connection, SHARED frames are deflated on their own against ZDICT.
+STREAM = 0x80000000
+SHARED = 0x40000000
+# The next bit flags the chunks of a file relayed by the server, so the receiver can tell them from the messages which
+# reach it while the file streams in
+CHUNK = 0x20000000
+LENGTH = 0x1FFFFFFF
+# A 4 KiB window and a small hash table keep the compressor of every connection to 24 KiB instead of 256 KiB, for a
+# few percent more bytes, and make a compressor for one short message several times cheaper to set up
+WINDOW_BITS = 12
+MEMORY_LEVEL = 4
+# Every sync flush ends with these bytes, so they are left out of STREAM frames and added back by the receiver
+SYNC_TAIL = b'\0\0\xff\xff'
+# Text common to the messages of the server, the most frequent last, so short messages compress on their own
+ZDICT = (b"/sending /sent /send_ok /send_bad_user [Channel]  You are in the waiting queue and there are  user(s) ahead "
+         b"of you.\n Cannot switch to the  does not exist.\n is not here. You are still muted for  seconds.\n You have "
+         b"been muted for  went AFK.\n Welcome to the  channel,  whispers to you: ( has left the channel.\n has joined "
+         b"the channel.\n[Server message (")
+
+
+def encode_frame(payload):
+    """
+    Prefixes the payload with its length so the receiver can tell where it ends
+
+    :param payload: The bytes to send
+    :return: The framed bytes
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_frames(payloads):
+    """
+    Frames several payloads into a single buffer so they can be sent with one call
+
+    :param payloads: The bytes of every message to send
+    :return: The framed bytes of all messages joined together
+    """
+    return b''.join(HEADER.pack(len(payload)) + payload for payload in payloads)
+
+
+def encode_shared(payload, level, flags=0):
+    """
+    Deflates a payload on its own against ZDICT, so the same frame can be sent to every client which takes compressed
+    frames, whatever else it has been sent
+
+    :param payload: The bytes to send
+    :param level: The zlib compression level
+    :param flags: Other flag bits of the length prefix, CHUNK for the chunks of a file
+    :return: The compressed frame, or the plain frame if compressing did not make it smaller
+    """
+    if len(payload) <= 1 << WINDOW_BITS:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -WINDOW_BITS, MEMORY_LEVEL, zdict=ZDICT)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=ZDICT)
+    data = compressor.compress(payload) + compressor.flush()
+    if len(data) >= len(payload):
+        return HEADER.pack(flags | len(payload)) + payload
+    return HEADER.pack(flags | SHARED | len(data)) + data
+
+
+class Deflater:
+    """
+    The compression context of the messages sent on one connection. Every message is deflated in one stream and sync
+    flushed, so later messages refer back to the text of earlier ones and the repeated parts cost a few bytes.
+    Messages must be framed in the order they are sent.
+    """
+    def __init__(self, level):
+        """
+        Constructor of the context
+
+        :param level: The zlib compression level
+        """
+        self.level = level
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -WINDOW_BITS, MEMORY_LEVEL)
+
+    def frame(self, payload):
+        """
+        :param payload: The bytes to send
+        :return: The compressed frame
+        """
+        data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return HEADER.pack(STREAM | (len(data) - len(SYNC_TAIL))) + data[:-len(SYNC_TAIL)]
+
+
+def is_framed(data):
+    """
+    Checks if the first bytes received on a connection come from a client which speaks the framed protocol. A length
+    prefix always starts with a zero byte, while the usernames sent by older clients never do.
+
+    :param data: The first bytes received from the client
+    :return: True if the client uses framing, False for older clients which send raw messages
+    """
+    return data[:1] == b'\0'
+
+
+class BufferPool:
+    """
+    Keeps preallocated receive buffers for reuse, so reading from a socket with recv_into allocates nothing once the
+    pool is warm. Taking and returning a buffer are single list operations, which the GIL makes safe across threads.
+    """
+    def __init__(self, size, limit):
+        """
+        Constructor of the pool
+
+        :param size: The size of every buffer in bytes
+        :param limit: Most free buffers kept, more are left to the garbage collector
+        """
+        self.size = size
+        self.limit = limit
+        self.free = []
+
+    def acquire(self):
+        """
+        :return: A free buffer, a new one if none is left
+        """
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def release(self, buffer):
+        """
+        Returns a buffer once nothing refers to its contents any longer
+
+        :param buffer: The buffer taken with acquire
+        """
+        if len(self.free) < self.limit:
+            self.free.append(buffer)
+
+
+class FrameDecoder:
+    """
+    Incrementally splits a byte stream into the length-prefixed messages it carries. TCP may merge several messages
+    into one read or split one message across reads, so received bytes are buffered until a full message is present.
+    """
+    def __init__(self):
+        """
+        Constructor of the decoder
+        """
+        self.buffer = bytearray()
+        self.pending = None
+        self.inflater = None
+        # True while the message last yielded is a file chunk
+        self.chunk = False
+
+    def inflate(self, flags, payload):
+        """
+        Decompresses the payload of a compressed frame
+
+        :param flags: The flag bits of the length prefix
+        :param payload: The compressed bytes
+        :return: The bytes of the message
+        :raises ValueError: If the frame is not valid or decompresses to more than MAX_FRAME bytes
+        """
+        try:
+            if flags == STREAM:
+                if self.inflater is None:
+                    self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+                inflater = self.inflater
+                data = inflater.decompress(b''.join((payload, SYNC_TAIL)), MAX_FRAME + 1)
+            elif flags == SHARED:
+                inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=ZDICT)
+                data = inflater.decompress(payload, MAX_FRAME + 1)
+            else:
+                raise ValueError(f"Unknown frame flags {flags:#x}.")
+        except zlib.error as error:
+            raise ValueError(f"Compressed frame is damaged: {error}.")
+        if len(data) > MAX_FRAME or inflater.unconsumed_tail:
+            raise ValueError(f"Compressed frame is larger than the limit of {MAX_FRAME} bytes.")
+        return data
+
+    def feed(self, data):
+        """
+        Adds newly received bytes to the decoder. A memoryview, such as one into a pooled receive buffer, is not copied
+        when nothing is buffered: its messages are parsed in place by the next iteration, which keeps a copy of only
+        the partial message at its end. The memory behind it may be reused once that iteration is over.
+
+        :param data: The bytes returned by recv, or a memoryview of the bytes written by recv_into
+        """
+        if self.pending is not None:
+            self.buffer += self.pending
+            self.pending = None
+        if isinstance(data, memoryview) and not self.buffer:
+            self.pending = data
+        else:
+            self.buffer += data
+
+    def __iter__(self):
+        """
+        Yields every complete message in the buffer, partial messages are kept until the rest arrives. The chunk
+        attribute tells whether the message just yielded is a chunk of a file.
+        """
+        for payload in self.views():
+            yield bytes(payload)
+
+    def views(self):
+        """
+        Yields every complete message like iterating over the decoder, except messages of a memoryview which was fed
+        are memoryview slices of it rather than copies. They are only valid until the next message is taken.
+        """
+        if self.pending is not None:
+            view = self.pending
+            start = 0
+            try:
+                while len(view) - start >= HEADER.size:
+                    length, = HEADER.unpack_from(view, start)
+                    flags = length & ~LENGTH
+                    length &= LENGTH
+                    if length > MAX_FRAME:
+                        raise ValueError(f"Frame of {length} bytes is larger than the limit of {MAX_FRAME}.")
+                    end = start + HEADER.size + length
+                    if len(view) < end:
+                        break
+                    payload = view[start + HEADER.size:end]
+                    start = end
+                    self.chunk = flags & CHUNK != 0
+                    flags &= ~CHUNK
+                    yield self.inflate(flags, payload) if flags else payload
+            finally:
+                self.pending = None
+                self.buffer += view[start:]
+            return
+
+        start = 0
+        try:
+            while len(self.buffer) - start >= HEADER.size:
+                length, = HEADER.unpack_from(self.buffer, start)
+                flags = length & ~LENGTH
+                length &= LENGTH
+                if length > MAX_FRAME:
+                    raise ValueError(f"Frame of {length} bytes is larger than the limit of {MAX_FRAME}.")
+                end = start + HEADER.size + length
+                if len(self.buffer) < end:
+                    break
+                payload = bytes(self.buffer[start + HEADER.size:end])
+                start = end
+                self.chunk = flags & CHUNK != 0
+                flags &= ~CHUNK
+                yield self.inflate(flags, payload) if flags else payload
+        finally:
+            del self.buffer[:start]
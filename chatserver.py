@@ -1,16 +1,111 @@
+import argparse
+import collections
+import queue
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import selectors
 import socket
 import sys
 import threading
 import time
+from functools import partial
+from multiprocessing import reduction
+
+import chatconsole
+import chatmetrics
+from chatconsole import DEBUG, ERROR, INFO, WARNING, Console
+from chatlog import CHAT, JOIN, LEAVE, WHISPER, MessageLog
+from chatmetrics import (BROADCAST_SECONDS, BYTES_IN, BYTES_OUT, CONNECTED_CLIENTS, CONSOLE_DROPPED, DELIVERIES, KICKS,
+                         MESSAGES, OUTBOX_BYTES, QUEUED_CLIENTS, SEND_CALLS, SEND_SAMPLE, SEND_SECONDS, THROTTLED,
+                         TIMEOUTS, WHISPERS, Metrics)
+from chatprotocol import (CHUNK, CHUNK_SIZE, HEADER, STREAM, BufferPool, Deflater, FrameDecoder, encode_frame,
+                          encode_frames, encode_shared, is_framed)
 
 TIMEOUT = 2
+AFK_TIMEOUT = 100
+RECV_SIZE = 65536
+# Receive buffers are reused across reads and clients, event mode only ever needs one
+receive_buffers = BufferPool(RECV_SIZE, 64)
+FILE_WINDOW = 4 * CHUNK_SIZE
 ADD = 1
 REMOVE = 0
 channels = []
+channel_index = {}
+activation_lock = threading.Lock()
+listen_host = None
+users = {}
+users_lock = threading.Lock()
 DISCONNECTED = 2
 CONNECTED = 1
 QUEUE = 0
 RANDEXIT = 3
+THREADED = 'threaded'
+EVENT = 'event'
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+COALESCE = 'coalesce'
+mode = THREADED
+outbox_limit = 256 * 1024
+slow_policy = DISCONNECT
+queue_interval = 1.0
+coalesce_interval = 0.0
+coalesce_bytes = 16 * 1024
+fanout_threshold = 0
+flood_mute = 10
+compression_level = 6
+# File chunks are large and relayed once, the fastest level compresses them at a few times the speed for a little less
+FILE_COMPRESSION_LEVEL = 1
+# What the flood limits of a channel apply to, as named in the config file
+FLOOD_KINDS = ("chat", "whisper", "list", "send")
+# Least seconds between two replies telling a muted client that its lines over the flood limits were dropped
+MUTED_REMINDER = 1.0
+fanout_threads = 4
+handshake_timeout = 10.0
+accept_backlog = 1024
+history_lines = 200
+history_bytes = 64 * 1024
+history_replay = 20
+log_dir = None
+log_interval = 0.05
+log_segment_bytes = 16 << 20
+message_log = None
+console = Console()
+metrics = Metrics()
+last_stats = None
+event_loop = None
+scheduler = None
+clock_second = 0
+clock_text = ''
+shard_id = None
+control = None
+# Most connections taken from the listen queue of a channel each time the event loop finds it ready
+ACCEPT_BATCH = 64
+# Most bytes a new connection may send before its username is complete
+HANDSHAKE_BYTES = 1024
+# Most outbox entries handed to one sendmsg call, the usual limit of the kernel
+IOV_MAX = 1024
+# Most sockets passed in one message during a handoff, below the SCM_RIGHTS limit of the kernel
+HANDOFF_BATCH = 200
+# Longest seconds the server waits for the one taking over before it carries on serving
+HANDOFF_TIMEOUT = 30.0
+control_lock = threading.Lock()
+held_clients = []
+held_lock = threading.Lock()
+flush_timer = None
+fanout_workers = []
+fanout_lock = threading.Lock()
+lane_numbers = itertools.count()
+switching = {}
+counts_timer = None
+cluster = None
+handoff_path = None
+handshakes = set()
 
 
 def check_name(name, channel):
@@ -21,10 +116,7 @@ def check_name(name, channel):
     :param channel: Channel to check in
     :return: The client object of the name if it exists, else the name is returned back
     """
-    for client in channel.connected:
-        if name == client.name:
-            return client
-    return name
+    return channel.connected_names.get(name, name)
 
 
 def check_channel(name):
@@ -34,24 +126,239 @@ def check_channel(name):
     :param name: The name to check
     :return: The channel class with that name is returned, else the name is returned.
     """
-    for channel in channels:
-        if channel.name == name:
-            return channel
-    return name
+    return channel_index.get(name, name)
+
+
+def locate(name):
+    """
+    Finds every channel the given name is connected to or queued in, across the whole server
+
+    :param name: The name to look for
+    :return: Dictionary of channel name to the client object with that name
+    """
+    with users_lock:
+        return dict(users.get(name, {}))
+
+
+def track_user(client, channel):
+    """
+    Records that the client has joined the channel or its queue in the server-wide index used by locate
+
+    :param client: The client which joined
+    :param channel: The channel it joined
+    """
+    with users_lock:
+        users.setdefault(client.name, {})[channel.name] = client
+
+
+def untrack_user(client, channel):
+    """
+    Removes the client from the server-wide index once it has left the channel and its queue
+
+    :param client: The client which left
+    :param channel: The channel it left
+    """
+    with users_lock:
+        found = users.get(client.name)
+        if found is not None and found.get(channel.name) is client:
+            del found[channel.name]
+            if not found:
+                del users[client.name]
+
+
+def timestamp():
+    """
+    Formats the current time for server messages. The string only changes once a second, so it is cached instead of
+    calling strftime for every message.
+
+    :return: The current time as HH:MM:SS
+    """
+    global clock_second, clock_text
+    now = int(time.time())
+    if now != clock_second:
+        clock_second = now
+        clock_text = time.strftime('%H:%M:%S', time.localtime(now))
+    return clock_text
 
 
 def broadcast(message, client_list):
     """
-    Sends the given message to every client within the given client list.
+    Sends the given message to every client within the given client list. The message is encoded and framed once and
+    the same bytes object is queued for every recipient, instead of encoding it again for each of them.
 
     :param message: The message to send
     :param client_list: All recipients of the message
+    :return: The encoded message
+    """
+    start = time.perf_counter()
+    data = message.encode('ascii')
+    if client_list and fanout_threshold > 0 and (len(client_list) >= fanout_threshold or fanout_busy()):
+        framed = encode_frame(data)
+        for worker, lane in zip(start_fanout(), lanes(client_list)):
+            if lane:
+                worker.tasks.put(partial(deliver, lane, data, framed))
+    else:
+        deliver(client_list, data, None)
+    metrics.observe(BROADCAST_SECONDS, time.perf_counter() - start)
+    metrics.count(DELIVERIES, None, len(client_list))
+    return data
+
+
+def deliver(client_list, data, framed):
+    """
+    Queues a broadcast for each of the given clients. Clients which take compressed frames all get the same frame,
+    compressed once on its own rather than in the stream of every client.
+
+    :param client_list: The recipients
+    :param data: The encoded message, as sent to clients in compatibility mode
+    :param framed: The message framed for the other clients, None to frame it when first needed
     """
+    hold = coalesce_interval > 0
+    shared = None
     for client in client_list:
-        try:
-            client.conn.sendall(message.encode('ascii'))
-        except BrokenPipeError:
+        if client.decoder is None:
+            # Older clients take every recv as one message, so their output is never merged on purpose
+            client.push(data)
             continue
+        if client.deflater is not None:
+            if shared is None:
+                shared = encode_shared(data, compression_level)
+            client.push(shared, hold)
+            continue
+        if framed is None:
+            framed = encode_frame(data)
+        client.push(framed, hold)
+
+
+def lanes(client_list):
+    """
+    Splits the recipients of a broadcast between the fan-out workers. A client always falls to the same worker, so
+    its messages are delivered in the order they were broadcast. The split of the current member tuple of a channel is
+    kept until the tuple is replaced.
+
+    :param client_list: The recipients
+    :return: One list of clients for every worker
+    """
+    channel = client_list[0].channel
+    cached = channel.lanes
+    if cached is not None and cached[0] is client_list:
+        return cached[1]
+    split = [[] for i in range(fanout_threads)]
+    for client in client_list:
+        split[client.lane % fanout_threads].append(client)
+    channel.lanes = (client_list, split)
+    return split
+
+
+def start_fanout():
+    """
+    Starts the fan-out workers the first time a large broadcast needs them, in the process that uses them
+
+    :return: The workers
+    """
+    if not fanout_workers:
+        with fanout_lock:
+            if not fanout_workers:
+                fanout_workers.extend(FanoutWorker() for i in range(fanout_threads))
+    return fanout_workers
+
+
+def fanout_busy():
+    """
+    :return: True if a fan-out worker has a broadcast it has not finished delivering
+    """
+    return any(worker.tasks.unfinished_tasks for worker in fanout_workers)
+
+
+class FanoutWorker:
+    """
+    A thread delivering its lane of the broadcasts to large channels, one broadcast after another in the order they
+    were handed over. Sending releases the interpreter lock, so the workers write to their sockets at the same time.
+    Messages to one client of the lane which are sent while a broadcast is still waiting here are queued behind it.
+    """
+    def __init__(self):
+        """
+        Constructor of the worker, starts its thread
+        """
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Delivers broadcasts and the messages queued behind them until the server exits
+        """
+        while True:
+            task = self.tasks.get()
+            try:
+                task()
+            except:
+                pass
+            self.tasks.task_done()
+
+
+def hold_output(client):
+    """
+    Puts a client whose output is being held back on the list flushed when the coalescing window closes. One timer
+    serves every client, it is started by the first message held after the last flush.
+
+    :param client: The client, its out_lock is held
+    """
+    global flush_timer
+    with held_lock:
+        held_clients.append(client)
+        if flush_timer is None:
+            flush_timer = scheduler.call_later(coalesce_interval, flush_output)
+
+
+def flush_output():
+    """
+    Called by the scheduler when the coalescing window closes, sends everything held back for every client at once
+    """
+    global flush_timer, held_clients
+    with held_lock:
+        clients, held_clients = held_clients, []
+        flush_timer = None
+    for client in clients:
+        client.on_writable()
+
+
+def announce(message):
+    """
+    Sends a membership change or chat message to every other node of the cluster, does nothing when not clustered
+
+    :param message: The dictionary to send
+    """
+    if cluster is not None:
+        cluster.announce(message)
+
+
+def open_logs():
+    """
+    Starts the message log of this process. The log of a channel is opened, and its history filled from it, when the
+    channel is first used.
+    """
+    global message_log
+    message_log = MessageLog(log_dir, log_interval, segment_bytes=log_segment_bytes, on_error=log_failed)
+
+
+def log_failed(directory, error, dropped):
+    """
+    Reports a channel log which could not be written, or is written again, called by the writer thread of the message
+    log. The records are kept and written once the disk takes them again, unless too many wait or the log is closed.
+
+    :param directory: The directory of the channel log
+    :param error: The OSError raised by the write or the sync, None once the log is written again
+    :param dropped: How many records were dropped since the last report
+    """
+    name = os.path.basename(directory)
+    lost = f", {dropped} record(s) were dropped" if dropped else ""
+    if error is None:
+        console.log(f"[Server message ({timestamp()})] The log of {name} is written again{lost}.", INFO,
+                    event="log_recovered", channel=name, dropped=dropped)
+    else:
+        console.log(f"[Server message ({timestamp()})] Cannot write the log of {name}: {error.strerror}{lost}.", ERROR,
+                    event="log_error", channel=name, dropped=dropped)
 
 
 def name_exists(name, channel):
@@ -62,25 +369,24 @@ def name_exists(name, channel):
     :param channel: The channel to check in
     :return: True if client exists, false otherwise
     """
-    for client in channel.connected:
-        if client.name == name:
-            return True
-    for client in channel.queue:
-        if client.name == name:
-            return True
-    return False
+    return name in channel.connected_names or name in channel.queue
 
 
-def parse_config():
+def parse_config(path):
     """
     Parses the channel config file
+
+    :param path: Path to the config file
     """
     try:
-        file = open(sys.argv[1], 'r')
-        content = file.read().split('\n')
+        file = open(path, 'r')
+        content = file.read().splitlines()
         file.close()
+        ports = set()
 
         for config in content:
+            if not config:
+                continue
             config = config.split(" ")
 
             if int(config[2]) <= 0:
@@ -88,13 +394,29 @@ def parse_config():
 
             this_channel = Channel(config[1], int(config[2]), int(config[3]))
 
+            # Flood limits follow as kind=rate/burst, e.g. chat=2/10, and mute=seconds
+            for option in config[4:]:
+                key, value = option.split("=")
+                if key == "mute":
+                    this_channel.flood_mute = int(value)
+                    if this_channel.flood_mute <= 0:
+                        exit(1)
+                elif key in FLOOD_KINDS:
+                    rate, burst = (float(number) for number in value.split("/"))
+                    if rate <= 0 or burst < 1:
+                        exit(1)
+                    this_channel.limits[key] = (rate, burst)
+                else:
+                    exit(1)
+
             if this_channel.name[0].isdigit():
                 exit(1)
 
-            for channel in channels:
-                if channel.name == this_channel.name or channel.port == this_channel.port or channel.capacity < 5:
-                    exit(1)
+            if this_channel.name in channel_index or this_channel.port in ports or this_channel.capacity < 5:
+                exit(1)
             channels.append(this_channel)
+            channel_index[this_channel.name] = this_channel
+            ports.add(this_channel.port)
 
         if len(channels) < 3:
             exit(1)
@@ -102,11 +424,133 @@ def parse_config():
         exit(1)
 
 
+class TokenBucket:
+    """
+    Allows a burst of messages and then a steady rate. The tokens are topped up from the time passed whenever one is
+    taken, so an idle bucket costs nothing.
+    """
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, limit):
+        """
+        Constructor of the bucket, which starts full
+
+        :param limit: The rate in tokens per second and the burst, as set for the channel
+        """
+        self.rate, self.burst = limit
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def take(self, now):
+        """
+        :param now: The current time.monotonic() value
+        :return: True if a token was left and has been taken, False if the bucket is empty
+        """
+        if now > self.stamp:
+            tokens = self.tokens + (now - self.stamp) * self.rate
+            self.tokens = tokens if tokens < self.burst else self.burst
+            self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Timer:
+    """
+    A single event scheduled on the Scheduler, can be cancelled before it fires.
+    """
+    def __init__(self, deadline, callback):
+        """
+        Constructor of the timer
+
+        :param deadline: The time at which the callback is run
+        :param callback: Function called without arguments once the deadline passes
+        """
+        self.deadline = deadline
+        self.callback = callback
+
+    def cancel(self):
+        """
+        Stops the timer from firing, it is dropped from the heap once its deadline is reached
+        """
+        self.callback = None
+
+
+class Scheduler:
+    """
+    Owns every timed event of the server (AFK deadlines, mute expiries) in one heap, so no client needs its own thread
+    or sleep. The event loop sleeps until the next deadline and runs the due timers. Deadlines are on the monotonic
+    clock, so a step of the wall clock neither fires every timer at once nor holds them back.
+    """
+    def __init__(self, wake):
+        """
+        Constructor of the scheduler
+
+        :param wake: Called when a timer is added which is due before every other timer
+        """
+        self.timers = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.wake = wake
+
+    def call_at(self, deadline, callback):
+        """
+        Schedules the callback to run at the given time
+
+        :param deadline: The time.monotonic() value at which the callback runs
+        :param callback: Function called without arguments
+        :return: The Timer, which can be cancelled
+        """
+        timer = Timer(deadline, callback)
+        with self.lock:
+            heapq.heappush(self.timers, (deadline, next(self.counter), timer))
+            earliest = self.timers[0][2] is timer
+        if earliest:
+            self.wake()
+        return timer
+
+    def call_later(self, delay, callback):
+        """
+        Schedules the callback to run after the given delay
+
+        :param delay: Seconds to wait
+        :param callback: Function called without arguments
+        :return: The Timer, which can be cancelled
+        """
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def next_timeout(self):
+        """
+        :return: Seconds until the next timer is due, or None if nothing is scheduled
+        """
+        with self.lock:
+            if not self.timers:
+                return None
+            return max(0, self.timers[0][0] - time.monotonic())
+
+    def run_due(self):
+        """
+        Runs the callbacks of every timer whose deadline has passed
+        """
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+        for timer in due:
+            if timer.callback is not None:
+                try:
+                    timer.callback()
+                except:
+                    continue
+
+
 class Client:
     """
     This class stores information regarding the client, keeps track of their status, and handles all client messages
     """
-    def __init__(self, name, conn, channel, status):
+    def __init__(self, name, conn, channel, status, decoder=None):
         """
         Constructor of the Client instance which is connected to the server
 
@@ -114,441 +558,2876 @@ class Client:
         :param conn: Socket object which represents the connection to the client
         :param channel: The specific channel that the client is connected to
         :param status: Used to track the current client status
+        :param decoder: The FrameDecoder of the connection, None if the client does not use framing
         """
         self.name = name
         self.conn = conn
         self.channel = channel
         self.status = status
         self.muted = 0
-        self.last_message = time.time()
+        self.last_message = time.monotonic()
         self.kicked = False
+        self.transfer = None
+        self.queue_position = None
+        self.history_cursor = 0
+        self.switching = None
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.drain_waiters = []
+        self.afk_timer = None
+        self.mute_timer = None
+        self.decoder = decoder
+        self.outbox = collections.deque()
+        self.outbox_bytes = 0
+        self.out_lock = threading.Lock()
+        self.writing = False
+        self.held = False
+        self.reading = False
+        self.dropped = 0
+        self.lane = next(lane_numbers)
+        self.buckets = {}
+        self.chat_bucket = None
+        self.throttled_key = None
+        self.reminded = 0.0
+        self.reset_limits()
+        self.deflater = None
+        self.compress_lock = threading.Lock()
 
     def handle_client(self):
         """
         The Client handler which continuously calls recv and parses the message/command.
-        Runs on a thread started in the channel class.
+        Runs on a thread started in the channel class when the server is in threaded mode.
         """
-        # The thread which tracks if the client has gone afk
-        afk = threading.Thread(target=self.timeout, daemon=True)
-        afk.start()
+        try:
+            running = self.process_frames()
+        except:
+            running = False
 
-        while self.status == CONNECTED or self.status == QUEUE:
+        buffer = receive_buffers.acquire()
+        while running and (self.status == CONNECTED or self.status == QUEUE):
             try:
-                message = self.conn.recv(1024).decode('UTF-8')
-                message = message.strip("\n").split(" ")
-
-                if len(' '.join(message)) == 0:
-                    self.channel.process_connection(RANDEXIT, self)
-                    self.status = DISCONNECTED
-                    break
-
-                if message[0] == "/quit" or not message:
-                    self.channel.process_connection(REMOVE, self)
-                    break
-                elif message[0] == "/whisper":
-                    if self.status == CONNECTED:
-                        if self.muted > 0:
-                            self.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] You are still muted for "
-                                              f"{self.muted - round(time.time())} seconds.\n".encode('ascii'))
-                        else:
-                            if len(message) >= 2:
-                                self.whisper(message)
-                            else:
-                                self.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})]  is not here."
-                                                  .encode('ascii'))
-                elif message[0] == "/list":
-                    self.list()
-                elif message[0] == "/switch":
-                    if len(message) == 2:
-                        self.switch(message)
-                    else:
-                        self.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})]  does not exist.\n"
-                                          .encode('ascii'))
-                elif message[0] == "/send":
-                    self.send(message)
-                else:
-                    if self.status == CONNECTED:
-                        if self.muted > 0:
-                            self.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] You are still muted for "
-                                              f"{self.muted - round(time.time())} seconds.\n".encode('ascii'))
-                        else:
-                            broadcast(f"[{self.name} ({time.strftime('%H:%M:%S')})] {' '.join(message)}",
-                                      self.channel.connected)
-                            print(f"[{self.name} ({time.strftime('%H:%M:%S')})] {' '.join(message)}", flush=True)
-                if self.muted == 0:
-                    self.last_message = time.time()
+                if not self.resumed.is_set():
+                    # A file transfer is waiting for its target to catch up
+                    self.resumed.wait()
+                    running = self.process_frames()
+                    continue
+                count = self.conn.recv_into(buffer)
+                running = self.status != DISCONNECTED and self.receive(memoryview(buffer)[:count])
             except:
+                self.leave()
                 break
+        receive_buffers.release(buffer)
 
         self.status = DISCONNECTED
-        self.conn.close()
+        event_loop.call_soon(self.detach)
         return
 
-    def update_status(self, status):
+    def on_readable(self):
         """
-        For the Server to update the client status i.e. muting the client
-
-        :param status: The new client status
+        Called by the event loop whenever the client socket has data waiting, replaces handle_client in event mode.
         """
-        self.status = status
-        return
+        buffer = receive_buffers.acquire()
+        try:
+            count = self.conn.recv_into(buffer)
+            if self.status != DISCONNECTED and self.receive(memoryview(buffer)[:count]):
+                return
+        except:
+            self.leave()
+        finally:
+            receive_buffers.release(buffer)
+        self.detach()
 
-    def mute(self, duration):
+    def leave(self):
+        """
+        Removes the client from its channel when the connection failed, such as when it was reset, instead of closing
+        cleanly. Otherwise its name would stay taken.
         """
-        Sets the duration for which the client is muted and set the client to be muted
+        if self.status == CONNECTED or self.status == QUEUE:
+            self.channel.process_connection(RANDEXIT, self)
 
-        :param duration: How long the client will be muted for
+    def detach(self):
         """
-        self.muted = int(time.time()) + duration
-        self.last_message += duration
-        time.sleep(duration)
-        self.muted = 0
-        return
+        Removes the client from the event loop and closes the connection, runs on the event loop thread
+        """
+        self.status = DISCONNECTED
+        self.reading = False
+        self.on_writable()
+        with self.out_lock:
+            self.outbox.clear()
+            self.outbox_bytes = 0
+            self.writing = False
+            waiters, self.drain_waiters = self.drain_waiters, []
+        event_loop.watch(self.conn, None, None)
+        self.conn.close()
+        for callback in waiters:
+            callback()
 
-    def send(self, message):
+    def receive(self, data):
         """
-        Handles the file sending if the client is trying to send a file
+        Handles the bytes of one recv call. Older clients send one message per call, framed clients may send any number
+        of messages in one call or split a message across calls.
 
-        :param message: The contents of the command
+        :param data: A memoryview of the bytes received from the client, empty if the connection was closed. It points
+                     into a pooled buffer, so only the partial message at its end is copied to be kept.
+        :return: False if the client has left and should no longer be read from, True otherwise
         """
-        target = check_name(message[1], self.channel)
-        if isinstance(target, Client):
-            # Informs the client that the sending target is valid
-            self.conn.sendall("/send_ok".encode('ascii'))
-            file = self.conn.recv(2048).decode('UTF-8')
+        metrics.count(BYTES_IN, self.channel.name, len(data))
+        if self.decoder is None or not data:
+            return self.process_message(data)
 
-            if file == "/bad_path":
-                return
+        self.decoder.feed(data)
+        return self.process_frames()
 
-            # Sends the recipient the filename and then sends the file contents
-            target.conn.sendall(f"/sending {message[2]}".encode('ascii'))
-            target.conn.sendall(file.encode('ascii'))
-            print(f"[Server message ({time.strftime('%H:%M:%S')})] {self.name} sent {message[2]} to {target.name}.",
-                  flush=True)
-            return
+    def process_frames(self):
+        """
+        Processes every complete message waiting in the frame decoder
 
-        self.conn.sendall("/send_bad_user".encode('ascii'))
+        :return: False if the client has left and should no longer be read from, True otherwise
+        """
+        if self.decoder is None:
+            return True
 
-    def get_name(self):
+        for payload in self.decoder.views():
+            if self.status == DISCONNECTED:
+                return False
+            if self.transfer is not None:
+                self.transfer.feed(payload)
+            elif payload and not self.process_message(payload):
+                return False
+            if not self.resumed.is_set():
+                break
+        return True
+
+    def pause(self):
         """
-        Fetches the name of the client
+        Stops reading from the client until resume is called, used while a file target catches up
         """
-        return self.name
+        self.resumed.clear()
+        if self.reading:
+            self.reading = False
+            event_loop.call_soon(self.update_interest)
 
-    def update_lastmsg(self, time):
+    def resume(self):
         """
-        Updates the last message the client sent, used to track AFK timeout
-        :param time: The time the last message was sent
+        Continues reading from the client after pause, runs on the event loop thread
         """
-        self.last_message = time
+        if self.resumed.is_set():
+            return
+        self.resumed.set()
+        if mode == EVENT and self.status != DISCONNECTED:
+            self.reading = True
+            self.update_interest()
+            try:
+                if not self.process_frames():
+                    self.detach()
+            except:
+                self.detach()
 
-    def list(self):
+    def when_drained(self, callback):
         """
-        Sends the client a list of all current channels and channel information
+        Runs the callback on the event loop thread once the outbox of the client is empty
+
+        :param callback: Function called without arguments
         """
-        message = ""
-        for channel in channels:
-            message += f"[Channel] {channel.name} {len(channel.connected)}/{channel.capacity}/{len(channel.queue)}.\n"
-        self.conn.sendall(message[:-1].encode('ascii'))
+        with self.out_lock:
+            if self.outbox and self.status != DISCONNECTED:
+                self.drain_waiters.append(callback)
+                return
+        event_loop.call_soon(callback)
 
-    def whisper(self, message):
+    def write(self, data):
         """
-        Parses the message for the whisper command where the message is only sent to the target
+        Queues bytes to be sent to the client, framing them if the client uses the framed protocol. Nothing here blocks
+        on the network: whatever the socket does not take straight away waits in the outbox until the event loop finds
+        the socket writable again, so a slow reader cannot hold up the sender.
 
-        :param message: The message to be whispered
+        :param data: The encoded message
         """
-        target = check_name(message[1], self.channel)
-        print(f"[{self.name} whispers to {target.get_name() if isinstance(target, Client) else target}: "
-              f"({time.strftime('%H:%M:%S')})] {' '.join(message[2:])}", flush=True)
-        if isinstance(target, Client):
-            target.conn.sendall(
-                f"[{self.name} whispers to you: ({time.strftime('%H:%M:%S')})] {' '.join(message[2:])}".encode('ascii'))
-        else:
-            self.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] {target} is not here.".encode('ascii'))
+        if self.deflater is not None:
+            # The stream has to be sent in the order it was compressed in
+            with self.compress_lock:
+                self.output(self.deflater.frame(data))
+            return
+        if self.decoder is not None:
+            data = encode_frame(data)
+        self.output(data)
 
-    def switch(self, message):
+    def write_batch(self, payloads):
         """
-        Handles the switch command and moves the client to the specified channel
+        Queues several messages as one write, framed together for framed clients and one per line for older clients
 
-        :param message: The message containing the destination channel the client wants to be placed in
+        :param payloads: The encoded messages
         """
-        target = check_channel(message[1].strip('\n'))
-        if isinstance(target, Channel):
-            if not name_exists(self.name, target):
-                self.channel.process_connection(REMOVE, self)
-                target.process_connection(ADD, self)
-                self.channel = target
-            else:
-                # Informs the client they cannot switch because a user of their name is already in the channel
-                self.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] Cannot switch to the "
-                                  f"{target.name} channel.\n".encode('ascii'))
+        if self.deflater is not None:
+            with self.compress_lock:
+                self.output(b''.join(self.deflater.frame(payload) for payload in payloads))
+        elif self.decoder is not None:
+            self.output(encode_frames(payloads))
         else:
-            self.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] {target} does not exist.\n"
-                              .encode('ascii'))
+            self.output(b'\n'.join(payloads) + b'\n')
 
-    def timeout(self):
+    def compress(self):
         """
-        Handles the AFK timeout function, is run from a thread in handle_client because this function blocks
+        Confirms to a client which asked for compression in its handshake that every frame from now on may be
+        compressed, unless compression is turned off. Called before anything else is sent to the client.
         """
-        while (time.time() <= self.last_message + 100 and self.status == CONNECTED) or self.status == QUEUE:
-            time.sleep(0.1)
+        if compression_level <= 0 or self.decoder is None:
+            return
+        self.write(b"/compress_ok")
+        self.deflater = Deflater(compression_level)
 
-        if self.status != DISCONNECTED:
-            self.channel.process_connection(TIMEOUT, self)
-            self.status = DISCONNECTED
-            self.conn.close()
-        return
+    def write_chunk(self, payload, compress):
+        """
+        Queues a chunk of a file. Chunks are compressed on their own, so one which would not shrink, as happens with
+        files which are compressed already, can be sent as it is. Framed chunks are flagged with CHUNK, so messages
+        written to the client while the file streams in are not taken for part of it.
 
-    def kick(self):
+        :param payload: The chunk, may be a memoryview of the receive buffer
+        :param compress: False to send the chunk as it is without trying
+        :return: True if the chunk was sent compressed
         """
-        Used by the channel to set the status of client to be kicked
+        if self.decoder is None:
+            self.output(bytes(payload))
+            return False
+        if self.deflater is None or not compress:
+            self.output(HEADER.pack(CHUNK | len(payload)) + payload)
+            return False
+        data = encode_shared(payload, FILE_COMPRESSION_LEVEL, CHUNK)
+        self.output(data)
+        return len(data) < HEADER.size + len(payload)
+
+    def output(self, data):
         """
-        self.kicked = True
-
+        Queues a message to the client alone, such as a whisper or a server notice, like push. While the fan-out
+        worker of the client still has broadcasts for it, the bytes are handed to the worker to queue after them, so
+        the message does not overtake a broadcast sent before it.
 
-class Channel:
-    """
-    Stores channel information, initializes connections, and spawns new client threads when clients connect are found.
-    Besides these the other responsibility of channel is to clean up after the client has disconnected.
-    """
-    def __init__(self, name, port, capacity):
+        :param data: The bytes to send as they are
         """
-        Constructor of channel which listens for client connections
+        if fanout_workers:
+            worker = fanout_workers[self.lane % fanout_threads]
+            if worker.tasks.unfinished_tasks:
+                worker.tasks.put(partial(self.push, data))
+                return
+        self.push(data)
 
-        :param name: The channel name
-        :param port: Port number which the channel operates on
-        :param capacity: How many clients may be connected at once
+    def push(self, data, hold=False):
         """
-        self.name = name
-        self.port = port
-        self.capacity = capacity
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connected = []
-        self.queue = []
-        self.lock = threading.Lock()
-        self.running = True
+        Queues bytes which are already in the wire format of the client, used by output and broadcast.
 
-    def start(self):
+        With hold the bytes may wait up to coalesce_interval seconds, or until coalesce_bytes are waiting, so that the
+        messages of a busy channel reach the client in one send call rather than one each. Anything pushed without
+        hold goes out with whatever is held, as soon as the socket takes it.
+
+        :param data: The bytes to send as they are
+        :param hold: True to let the bytes wait for more output to the client
         """
-        Initializes the channel connection to listen for new clients.
+        if self.switching is not None:
+            # The connection is being handed to another worker process, which now owns the output
+            return
+        with self.out_lock:
+            if not self.outbox and not hold:
+                try:
+                    sent = self.transmit(data)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    return
+                if sent == len(data):
+                    return
+                data = memoryview(data)[sent:]
+
+            self.outbox.append(data)
+            self.outbox_bytes += len(data)
+            if self.outbox_bytes > outbox_limit:
+                self.overflow()
+            if self.writing or not self.outbox:
+                return
+            if hold and self.outbox_bytes < coalesce_bytes:
+                if not self.held:
+                    self.held = True
+                    hold_output(self)
+                return
+            self.writing = True
+        event_loop.call_soon(self.update_interest)
+
+    def transmit(self, data):
         """
-        host = socket.gethostbyname(socket.gethostname())
-        addr = (host, self.port)
-        self.socket.bind(addr)
-        self.socket.listen()
+        Sends as much of the data as the socket takes without waiting. This runs once per recipient of every broadcast,
+        so only a sample of the calls is timed and the byte count skips the method call of metrics.count.
 
-        count = 0
+        :param data: The bytes to send
+        :return: How many bytes were sent
+        """
+        metrics.sends += 1
+        if metrics.sends % SEND_SAMPLE:
+            sent = self.conn.send(data, socket.MSG_DONTWAIT)
+        else:
+            start = time.perf_counter()
+            try:
+                sent = self.conn.send(data, socket.MSG_DONTWAIT)
+            finally:
+                metrics.observe(SEND_SECONDS, time.perf_counter() - start)
+        metrics.counters[BYTES_OUT, self.channel.name] += sent
+        return sent
 
-        while self.running:
-            conn, addr = self.socket.accept()
-            username = str(conn.recv(1024).decode('UTF-8')).strip('\n')
-            client = Client(username, conn, self, None)
-            count += 1
-            if not name_exists(client.get_name(), self):
-                self.process_connection(ADD, client)
-                thread = threading.Thread(target=client.handle_client, daemon=True)
-                thread.start()
+    def transmit_many(self, buffers):
+        """
+        Sends as much of several buffers as the socket takes without waiting, in one sendmsg call
 
+        :param buffers: The bytes to send, in order
+        :return: How many bytes were sent
+        """
+        if len(buffers) == 1:
+            return self.transmit(buffers[0])
+        metrics.sends += 1
+        sent = self.conn.sendmsg(buffers, (), socket.MSG_DONTWAIT)
+        metrics.counters[BYTES_OUT, self.channel.name] += sent
+        return sent
+
+    def overflow(self):
+        """
+        Applies the slow consumer policy once the outbox grows past the limit, called with out_lock held.
+        The first message may be partly sent already, so it is always kept to avoid corrupting the stream. So are the
+        frames of the deflate stream of a client which takes compressed frames, as each refers back to the ones before
+        it: the client is disconnected instead if they alone are over the limit.
+        """
+        if slow_policy != DISCONNECT:
+            head = self.outbox.popleft()
+            kept = []
+            if slow_policy == DROP:
+                while self.outbox and self.outbox_bytes - len(head) > outbox_limit:
+                    data = self.outbox.popleft()
+                    if self.deflater is not None and HEADER.unpack_from(data)[0] & STREAM:
+                        kept.append(data)
+                        continue
+                    self.outbox_bytes -= len(data)
+                    self.dropped += 1
+                self.outbox.extendleft(reversed(kept))
             else:
-                # Reject the incoming connection because client name already exists
-                client.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] Cannot connect to the "
-                                    f"{self.name} channel.\n".encode('ascii'))
-                client.conn.close()
-        socket.close(socket.SHUT_RDWR)
-        return
+                # Coalesce the backlog into one notice so the client catches up with the newest messages
+                if self.deflater is not None:
+                    kept = [data for data in self.outbox if HEADER.unpack_from(data)[0] & STREAM]
+                skipped = len(self.outbox) - len(kept)
+                self.dropped += skipped
+                self.outbox.clear()
+                self.outbox.extend(kept)
+                notice = f"[Server message ({timestamp()})] {skipped} message(s) were skipped because " \
+                         f"you are reading too slowly.\n".encode('ascii')
+                if self.decoder is not None:
+                    notice = encode_frame(notice)
+                self.outbox.append(notice)
+                self.outbox_bytes = len(head) + sum(len(data) for data in kept) + len(notice)
+            self.outbox.appendleft(head)
+            if self.outbox_bytes - len(head) <= outbox_limit:
+                return
 
-    def process_connection(self, operation, client):
+        self.outbox.clear()
+        self.outbox_bytes = 0
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def on_writable(self):
         """
-        Processes the client operation, handles adding, removing, timeout, and unexpected exit of the client.
+        Called by the event loop when the socket can take more data, and when held output is flushed. Sends as much of
+        the outbox as the socket accepts, up to IOV_MAX messages per send call.
+        """
+        with self.out_lock:
+            self.held = False
+            while self.outbox:
+                try:
+                    sent = self.transmit_many(list(itertools.islice(self.outbox, IOV_MAX)))
+                except BlockingIOError:
+                    break
+                except OSError:
+                    self.outbox.clear()
+                    self.outbox_bytes = 0
+                    break
+                self.outbox_bytes -= sent
+                while sent and sent >= len(self.outbox[0]):
+                    sent -= len(self.outbox.popleft())
+                if sent:
+                    self.outbox[0] = memoryview(self.outbox[0])[sent:]
+                    break
+            writing = bool(self.outbox)
+            waiters = []
+            if not writing:
+                waiters, self.drain_waiters = self.drain_waiters, []
+            changed = writing != self.writing
+            self.writing = writing
+        for callback in waiters:
+            callback()
+        if changed:
+            self.update_interest()
+
+    def update_interest(self):
+        """
+        Tells the event loop which socket events the client is waiting for, runs on the event loop thread
+        """
+        if self.conn.fileno() == -1:
+            return
+        event_loop.watch(self.conn, self.on_readable if self.reading else None,
+                         self.on_writable if self.writing else None)
 
-        :param operation: The operation to be performed on the client, be it to add, remove, timeout the client.
-        :param client: The target client
+    def queue_depth(self):
+        """
+        :return: The number of messages and bytes waiting in the outbox of the client
+        """
+        with self.out_lock:
+            return len(self.outbox), self.outbox_bytes
+
+    def process_message(self, data):
+        """
+        Parses a single message/command received from the client and acts on it. The bytes are decoded once, and only
+        commands are split into words: chat lines are broadcast as they are.
+
+        :param data: The bytes of the message received from the client, may be a memoryview of the receive buffer
+        :return: False if the client has left and should no longer be read from, True otherwise
+        """
+        text = str(data, 'UTF-8')
+        if self.transfer is not None:
+            self.transfer.feed_legacy(text)
+            return True
+
+        text = text.strip("\n")
+        if not text:
+            self.channel.process_connection(RANDEXIT, self)
+            self.status = DISCONNECTED
+            return False
+
+        # One clock read serves the flood limits and the AFK timeout
+        now = time.monotonic()
+        if text[0] != "/":
+            bucket = self.chat_bucket
+            if bucket is None:
+                self.chat(text)
+            # Lines from the waiting queue are never broadcast, so they take no tokens
+            elif self.status == CONNECTED:
+                # TokenBucket.take written out, as it runs for every chat line
+                tokens = bucket.tokens + (now - bucket.stamp) * bucket.rate
+                if tokens > bucket.burst:
+                    tokens = bucket.burst
+                bucket.stamp = now
+                if tokens >= 1:
+                    bucket.tokens = tokens - 1
+                    self.chat(text)
+                else:
+                    bucket.tokens = tokens
+                    self.flooded(now, True)
+            if self.muted == 0:
+                self.last_message = now
+            return True
+
+        message = text.split(" ")
+        if message[0] == "/quit":
+            self.channel.process_connection(REMOVE, self)
+            return False
+        elif message[0] == "/whisper":
+            if self.status == CONNECTED and not self.throttled("whisper", now):
+                if self.muted > 0:
+                    self.write(f"[Server message ({timestamp()})] You are still muted for "
+                               f"{self.muted - round(time.time())} seconds.\n".encode('ascii'))
+                else:
+                    if len(message) >= 2:
+                        self.whisper(message)
+                    else:
+                        self.write(f"[Server message ({timestamp()})]  is not here."
+                                   .encode('ascii'))
+        elif message[0] == "/list":
+            if self.throttled("list", now):
+                self.write(f"[Server message ({timestamp()})] You are sending commands too fast.\n".encode('ascii'))
+            else:
+                self.list()
+        elif message[0] == "/history":
+            if self.status == CONNECTED:
+                self.history(message)
+        elif message[0] == "/switch":
+            if len(message) == 2:
+                self.switch(message)
+            else:
+                self.write(f"[Server message ({timestamp()})]  does not exist.\n"
+                           .encode('ascii'))
+        elif message[0] == "/send":
+            if self.throttled("send", now):
+                # The sender waits for an answer before sending anything more
+                self.write(f"[Server message ({timestamp()})] You are sending commands too fast.\n".encode('ascii'))
+                self.write("/send_bad_user".encode('ascii'))
+            else:
+                self.send(message)
+        elif self.status == CONNECTED and not self.throttled("chat", now):
+            self.chat(text)
+        if self.muted == 0:
+            self.last_message = now
+        return True
+
+    def chat(self, text):
+        """
+        Broadcasts a chat line to the channel unless the client is muted or still waiting in the queue
+
+        :param text: The line the client sent
+        """
+        if self.status != CONNECTED:
+            return
+        if self.muted > 0:
+            self.write(f"[Server message ({timestamp()})] You are still muted for "
+                       f"{self.muted - round(time.time())} seconds.\n".encode('ascii'))
+            return
+        line = f"[{self.name} ({timestamp()})] {text}"
+        self.channel.record(broadcast(line, self.channel.connected))
+        metrics.count(MESSAGES, self.channel.name)
+        announce({"op": "chat", "channel": self.channel.name, "line": line})
+        console.log(line, INFO, event="chat", channel=self.channel.name, user=self.name)
+
+    def reset_limits(self):
+        """
+        Builds a token bucket for every flood limit of the channel the client is in, called when it joins or switches
+        channel, so checking a message looks nothing up. The limits only change with the config, which a new process
+        reads.
+        """
+        self.buckets = {kind: TokenBucket(limit) for kind, limit in self.channel.limits.items()}
+        self.chat_bucket = self.buckets.get("chat")
+        self.throttled_key = (THROTTLED, self.channel.name)
+
+    def throttled(self, kind, now):
+        """
+        Takes a token for a message or command of the given kind if the channel limits it. Chat lines are checked in
+        process_message itself.
+
+        :param kind: One of FLOOD_KINDS
+        :param now: The current time.monotonic() value
+        :return: True if the client is over the limit and the message should be dropped
+        """
+        bucket = self.buckets.get(kind)
+        if bucket is None or bucket.take(now):
+            return False
+        self.flooded(now, kind == "whisper")
+        return True
+
+    def flooded(self, now, remind):
+        """
+        Counts a message over the flood limits. A client which runs out is muted for the flood mute time of the
+        channel. While muted, chat lines and whispers over the limit are dropped with the usual "You are still muted"
+        reply, sent at most once every MUTED_REMINDER seconds so a flood is not echoed back line by line.
+
+        :param now: The current time.monotonic() value
+        :param remind: True for chat lines and whispers, the other commands have their own reply
+        """
+        metrics.counters[self.throttled_key] += 1
+        if self.muted != 0:
+            if remind and now >= self.reminded + MUTED_REMINDER:
+                self.reminded = now
+                self.write(f"[Server message ({timestamp()})] You are still muted for "
+                           f"{self.muted - round(time.time())} seconds.\n".encode('ascii'))
+        else:
+            self.reminded = now
+            duration = self.channel.flood_mute
+            self.write(f"[Server message ({timestamp()})] You have been muted for {duration} seconds for flooding the "
+                       f"channel.\n".encode('ascii'))
+            console.log(f"[Server message ({timestamp()})] Muted {self.name} for {duration} seconds for flooding.",
+                        WARNING, event="mute", channel=self.channel.name, user=self.name)
+            self.mute(duration)
+
+    def update_status(self, status):
+        """
+        For the Server to update the client status i.e. muting the client
+
+        :param status: The new client status
+        """
+        self.status = status
+        return
+
+    def mute(self, duration):
+        """
+        Sets the duration for which the client is muted and set the client to be muted, the scheduler unmutes them
+        once the duration is over. A new mute replaces the one running, so an earlier and shorter one cannot end it.
+
+        :param duration: How long the client will be muted for
+        """
+        self.muted = int(time.time()) + duration
+        self.last_message += duration
+        self.unmute_at(duration)
+        return
+
+    def unmute_at(self, delay):
+        """
+        Schedules the end of the mute, replacing any end scheduled before
+
+        :param delay: Seconds until the client is unmuted
+        """
+        if self.mute_timer is not None:
+            self.mute_timer.cancel()
+        self.mute_timer = scheduler.call_later(delay, self.unmute)
+
+    def unmute(self):
+        """
+        Called by the scheduler when the mute duration is over
+        """
+        self.mute_timer = None
+        self.muted = 0
+
+    def send(self, message):
+        """
+        Handles the file sending if the client is trying to send a file. The file itself follows as the next messages
+        from the client and is relayed by a Transfer.
+
+        :param message: The contents of the command
+        """
+        target = check_name(message[1], self.channel)
+        # Files are not relayed between nodes of a cluster, so the target has to be on this node
+        if isinstance(target, Client) and not isinstance(target, Member):
+            # Informs the client that the sending target is valid
+            self.transfer = Transfer(self, target, message[2])
+            self.write("/send_ok".encode('ascii'))
+            return
+
+        self.write("/send_bad_user".encode('ascii'))
+
+    def get_name(self):
+        """
+        Fetches the name of the client
+        """
+        return self.name
+
+    def update_lastmsg(self, time):
+        """
+        Updates the last message the client sent, used to track AFK timeout
+        :param time: The time.monotonic() value when the last message was sent
+        """
+        self.last_message = time
+
+    def list(self):
+        """
+        Sends the client a list of all current channels and channel information
+        """
+        message = ""
+        for channel in channels:
+            connected, queued = channel.counts()
+            message += f"[Channel] {channel.name} {connected}/{channel.capacity}/{queued}.\n"
+        self.write(message[:-1].encode('ascii'))
+
+    def history(self, message):
+        """
+        Sends the client the messages said before the oldest one it has seen so far, so repeated calls page back
+        through the history of the channel
+
+        :param message: The contents of the command, optionally holding how many messages to show
+        """
+        count = history_replay
+        if len(message) >= 2:
+            if not message[1].isdigit() or int(message[1]) == 0:
+                self.write(f"[Server message ({timestamp()})] Invalid history length.\n".encode('ascii'))
+                return
+            count = int(message[1])
+
+        self.channel.lock.acquire()
+        lines, self.history_cursor = self.channel.replay(count, self.history_cursor)
+        self.channel.lock.release()
+        if lines:
+            self.write_batch(lines)
+        else:
+            self.write(f"[Server message ({timestamp()})] There are no earlier messages.\n".encode('ascii'))
+
+    def whisper(self, message):
+        """
+        Parses the message for the whisper command where the message is only sent to the target
+
+        :param message: The message to be whispered
+        """
+        target = check_name(message[1], self.channel)
+        line = f"[{self.name} whispers to {target.get_name() if isinstance(target, Client) else target}: " \
+               f"({timestamp()})] {' '.join(message[2:])}"
+        console.log(line, INFO, event="whisper", channel=self.channel.name, user=self.name,
+                    target=message[1])
+        if isinstance(target, Client):
+            metrics.count(WHISPERS, self.channel.name)
+            self.channel.log_event(WHISPER, line)
+            target.write(f"[{self.name} whispers to you: ({timestamp()})] {' '.join(message[2:])}"
+                         .encode('ascii'))
+        else:
+            self.write(f"[Server message ({timestamp()})] {target} is not here.".encode('ascii'))
+
+    def switch(self, message):
+        """
+        Handles the switch command and moves the client to the specified channel
+
+        :param message: The message containing the destination channel the client wants to be placed in
+        """
+        target = check_channel(message[1].strip('\n'))
+        if isinstance(target, Channel):
+            if target.shard != shard_id:
+                self.switch_shard(target)
+            elif not target.is_home():
+                self.switch_node(target)
+            elif target is self.channel or not self.channel.move(self, target):
+                # Informs the client they cannot switch because a user of their name is already in the channel
+                self.write(f"[Server message ({timestamp()})] Cannot switch to the "
+                           f"{target.name} channel.\n".encode('ascii'))
+        else:
+            self.write(f"[Server message ({timestamp()})] {target} does not exist.\n"
+                       .encode('ascii'))
+
+    def switch_shard(self, target):
+        """
+        Moves the client to a channel run by another worker process. Reading stops and the output is sent first, then
+        the socket is passed to the supervisor, which hands it to the worker of the target channel.
+
+        :param target: The channel the client wants to be placed in
+        """
+        self.pause()
+        # Deferred so the decoder has dropped the /switch frame before its remaining bytes are handed over
+        scheduler.call_later(0, partial(self.when_drained, partial(self.hand_off, target)))
+
+    def hand_off(self, target):
+        """
+        Sends the socket and state of the client to the supervisor once the outbox is empty
+
+        :param target: The channel the client wants to be placed in
+        """
+        if self.status == DISCONNECTED:
+            return
+        self.switching = target
+        switching[(self.channel.name, self.name)] = self
+        state = {"name": self.name, "source": self.channel.name, "muted": self.muted,
+                 "pending": bytes(self.decoder.buffer) if self.decoder is not None else None,
+                 "compress": self.deflater is not None}
+        send_control(("switch", target.name, state), self.conn.fileno())
+
+    def switched(self, accepted):
+        """
+        Called when the worker of the target channel has answered the switch request
+
+        :param accepted: True if the client was added to the target channel, False if its name was taken
+        """
+        target = self.switching
+        self.switching = None
+        if accepted:
+            # The other worker owns the connection now, so it is closed here without shutting it down
+            self.channel.process_connection(REMOVE, self)
+            self.detach()
+            return
+
+        self.write(f"[Server message ({timestamp()})] Cannot switch to the "
+                   f"{target.name} channel.\n".encode('ascii'))
+        if self.status == CONNECTED:
+            self.start_afk_timer()
+        self.resume()
+
+    def switch_node(self, target):
+        """
+        Moves the client to a channel whose home is another node of the cluster. Reading stops until the home node has
+        checked the name and decided whether the client is connected or queued.
+
+        :param target: The channel the client wants to be placed in
+        """
+        self.pause()
+        cluster.request(target, self.name, partial(self.switched_node, target))
+
+    def switched_node(self, target, status):
+        """
+        Called when the home node of the target channel has answered the switch request
+
+        :param target: The channel the client wants to be placed in
+        :param status: CONNECTED or QUEUE as decided by the home node, None if the switch was refused
+        """
+        if status is None:
+            self.write(f"[Server message ({timestamp()})] Cannot switch to the "
+                       f"{target.name} channel.\n".encode('ascii'))
+        elif self.status != DISCONNECTED:
+            self.channel.process_connection(REMOVE, self)
+            target.place(self, status)
+            self.channel = target
+            self.reset_limits()
+        else:
+            # The client left while waiting, so its place is given up straight away
+            target.place(self, status)
+            target.process_connection(RANDEXIT, self)
+            self.detach()
+        self.resume()
+
+    def start_afk_timer(self):
+        """
+        Schedules the AFK check for the client, called whenever the client is connected to a channel
+        """
+        if self.afk_timer is not None:
+            self.afk_timer.cancel()
+        self.afk_timer = scheduler.call_at(self.last_message + AFK_TIMEOUT, self.timeout)
+
+    def timeout(self):
+        """
+        Handles the AFK timeout function, is run by the scheduler once the AFK deadline passes. Sending a message only
+        updates last_message, so if the deadline has moved since this check was scheduled it is simply scheduled again.
+        """
+        self.afk_timer = None
+        if self.status != CONNECTED or self.switching is not None:
+            return
+
+        deadline = self.last_message + AFK_TIMEOUT
+        if time.monotonic() <= deadline:
+            self.afk_timer = scheduler.call_at(deadline, self.timeout)
+            return
+
+        self.channel.process_connection(TIMEOUT, self)
+        self.disconnect()
+
+    def kick(self):
+        """
+        Used by the channel to set the status of client to be kicked
+        """
+        self.kicked = True
+
+    def disconnect(self):
+        """
+        Used by the server to drop the client, the reader of the connection closes the socket once it notices.
+        """
+        self.status = DISCONNECTED
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Member(Client):
+    """
+    A client connected to another node of the cluster. Every node keeps members in its channels so names, counts, the
+    waiting queue and whispers work across the cluster, while the node the client is connected to owns its socket.
+    """
+    def __init__(self, name, node, channel, status):
+        """
+        Constructor of the member
+
+        :param name: Name of the client
+        :param node: Name of the node the client is connected to
+        :param channel: The channel the client is in
+        :param status: Used to track the current client status
+        """
+        super().__init__(name, None, channel, status)
+        self.node = node
+
+    def write(self, data):
+        """
+        Sends a message to this client alone, such as a whisper, through the node it is connected to
+
+        :param data: The encoded message
+        """
+        cluster.send(self.node, {"op": "deliver", "channel": self.channel.name, "name": self.name,
+                                 "data": data.decode('UTF-8')})
+
+    def push(self, data, hold=False):
+        """
+        Broadcasts are relayed once to every node rather than once per member, so there is nothing to do here
+        """
+        return
+
+    def start_afk_timer(self):
+        """
+        The AFK timeout is run by the node the client is connected to
+        """
+        return
+
+    def mute(self, duration):
+        """
+        Mutes the client on the node it is connected to
+
+        :param duration: How long the client will be muted for
+        """
+        self.muted = int(time.time()) + duration
+        cluster.send(self.node, {"op": "mute", "channel": self.channel.name, "name": self.name, "duration": duration})
+
+    def disconnect(self):
+        """
+        Asks the node the client is connected to to kick it
+        """
+        self.status = DISCONNECTED
+        cluster.send(self.node, {"op": "kick", "channel": self.channel.name, "name": self.name})
+
+
+class Transfer:
+    """
+    Relays one file from a client to another. Framed clients announce the size with "/file <size>", stream the file in
+    chunks of at most CHUNK_SIZE bytes and finish with "/file_end <sha256>", which the target uses to check the file.
+    At most FILE_WINDOW bytes, and less than the outbox limit, are queued for the target, after that the sender is not
+    read from until the target has caught up, so memory use does not depend on the size of the file.
+    Older clients send the whole file as one message, which is relayed as before.
+    """
+    def __init__(self, sender, target, filename):
+        """
+        Constructor of the transfer
+
+        :param sender: The client sending the file
+        :param target: The client receiving the file
+        :param filename: The name of the file as given by the sender
+        """
+        self.sender = sender
+        self.target = target
+        self.filename = filename
+        self.remaining = None
+        self.size = 0
+        self.compress = True
+
+    def feed(self, payload):
+        """
+        Handles the next frame of the transfer received from a framed sender
+
+        :param payload: The bytes of the frame, may be a memoryview of the receive buffer
+        """
+        if self.remaining is None:
+            message = str(payload, 'UTF-8').split(" ")
+            if message[0] != "/file":
+                self.sender.transfer = None
+                return
+            self.size = self.remaining = int(message[1])
+            if self.target.decoder is None:
+                self.target.write(f"/sending {self.filename}".encode('ascii'))
+            else:
+                self.target.write(f"/sending {self.filename} {self.size}".encode('ascii'))
+            return
+
+        if self.remaining > 0:
+            if len(payload) > self.remaining:
+                raise ValueError("File chunk is larger than the announced file size.")
+            self.remaining -= len(payload)
+            if self.target.status == DISCONNECTED:
+                return
+            # The chunk is a view into the receive buffer, which is reused once it has been handled. Framing it copies
+            # it already, otherwise it may wait in the outbox so it is copied here. Once a chunk does not shrink, the
+            # file is taken to be compressed already and the rest is not tried.
+            self.compress = self.target.write_chunk(payload, self.compress)
+            # The window stays a chunk below the outbox limit, or the next chunk would trip the slow consumer policy
+            if self.target.outbox_bytes > min(FILE_WINDOW, outbox_limit - 2 * CHUNK_SIZE):
+                self.sender.pause()
+                self.target.when_drained(self.sender.resume)
+            return
+
+        # The file is complete, the final frame holds its digest
+        self.sender.transfer = None
+        message = str(payload, 'UTF-8').split(" ")
+        if self.target.decoder is not None:
+            self.target.write(f"/sent {message[-1]}".encode('ascii'))
+        self.finish()
+
+    def feed_legacy(self, file):
+        """
+        Relays the file sent by an older client, which sends the whole file as one message
+
+        :param file: The file contents sent by the client
+        """
+        self.sender.transfer = None
+        if file == "/bad_path":
+            return
+
+        data = file.encode('ascii')
+        self.size = len(data)
+        if self.target.decoder is None:
+            self.target.write(f"/sending {self.filename}".encode('ascii'))
+            self.target.write(data)
+        else:
+            self.target.write(f"/sending {self.filename} {self.size}".encode('ascii'))
+            if data:
+                self.target.write(data)
+            self.target.write(f"/sent {hashlib.sha256(data).hexdigest()}".encode('ascii'))
+        self.finish()
+
+    def finish(self):
+        """
+        Logs the completed transfer
+        """
+        console.log(f"[Server message ({timestamp()})] {self.sender.name} sent {self.filename} to {self.target.name}.",
+                    INFO, event="file", user=self.sender.name, target=self.target.name)
+
+
+class Handshake:
+    """
+    A new connection whose username has not arrived yet. Its bytes are read by the event loop as they come in, so a
+    client which connects and sends nothing holds up no one else, and it is closed once handshake_timeout passes.
+    Framed clients send the name as the first frame, older clients send the raw name, in which case the client stays
+    in compatibility mode. A framed client may follow its name with " compress" to ask for compressed frames.
+    """
+    def __init__(self, channel, conn, pending=b''):
+        """
+        Constructor of the handshake, starts reading and the deadline straight away
+
+        :param channel: The channel the connection was made to
+        :param conn: The socket of the new connection
+        :param pending: Bytes of the username already received by the previous server, after a handoff
+        """
+        self.channel = channel
+        self.conn = conn
+        self.decoder = None
+        conn.setblocking(False)
+        self.timer = scheduler.call_later(handshake_timeout, self.expire)
+        handshakes.add(self)
+        event_loop.watch(conn, self.read, None)
+        if pending:
+            self.received(pending)
+
+    def read(self):
+        """
+        Called by the event loop when bytes of the username arrive
+        """
+        try:
+            data = self.conn.recv(HANDSHAKE_BYTES)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close()
+            return
+        self.received(data)
+
+    def received(self, data):
+        """
+        Hands the connection to the channel once the username is complete
+
+        :param data: The bytes just received
+        """
+        try:
+            result = self.parse(data)
+        except (ConnectionError, ValueError):
+            self.close()
+            return
+        if result is None:
+            return
+        self.timer.cancel()
+        handshakes.discard(self)
+        event_loop.watch(self.conn, None, None)
+        self.conn.setblocking(True)
+        self.channel.handshake(self.conn, *result)
+
+    def parse(self, data):
+        """
+        :param data: The bytes just received
+        :return: The username, the frame decoder of the connection or None for older clients and whether the client
+                 asked for compression, None if the username is not complete yet
+        :raises ConnectionError: If the connection was closed or sent too much without a username
+        """
+        if not data:
+            raise ConnectionError("Connection closed during the handshake.")
+        if self.decoder is None:
+            if not is_framed(data):
+                return data.decode('UTF-8').strip('\n'), None, False
+            self.decoder = FrameDecoder()
+        self.decoder.feed(data)
+        for payload in self.decoder:
+            username, *options = payload.decode('UTF-8').strip('\n').split(" ")
+            return username, self.decoder, "compress" in options
+        if len(self.decoder.buffer) > HANDSHAKE_BYTES:
+            raise ConnectionError("No username in the first bytes of the connection.")
+        return None
+
+    def pending(self):
+        """
+        :return: The bytes received so far, passed on when the server hands over to a new process
+        """
+        return bytes(self.decoder.buffer) if self.decoder is not None else b''
+
+    def expire(self):
+        """
+        Called by the scheduler when the username has not arrived in time
+        """
+        console.log(f"[Server message ({timestamp()})] A connection to {self.channel.name} sent no username within "
+                    f"{handshake_timeout:g} seconds.", DEBUG, event="handshake_timeout", channel=self.channel.name)
+        self.close()
+
+    def close(self):
+        """
+        Drops the connection before it became a client
+        """
+        self.timer.cancel()
+        handshakes.discard(self)
+        event_loop.watch(self.conn, None, None)
+        self.conn.close()
+
+
+class Channel:
+    """
+    Stores channel information, initializes connections, and spawns new client threads when clients connect are found.
+    Besides these the other responsibility of channel is to clean up after the client has disconnected.
+
+    A server may run tens of thousands of channels which are mostly empty, so the clients, queue, history and log of a
+    channel are only created by activate when any of them is first used.
+
+    The connected clients are a tuple which is replaced, never changed, whenever someone joins or leaves. Senders and
+    /list read whichever tuple is current without taking the lock, which only orders the changes. Notices about a
+    change are broadcast once the lock has been released, so no network write happens while it is held.
+    """
+    LAZY = frozenset(("connected", "queue", "connected_names", "queue_timer", "queue_notified", "lock", "outgoing",
+                      "history", "history_size", "history_total", "log"))
+
+    def __init__(self, name, port, capacity):
+        """
+        Constructor of channel which listens for client connections
+
+        :param name: The channel name
+        :param port: Port number which the channel operates on
+        :param capacity: How many clients may be connected at once
+        """
+        self.name = name
+        self.port = port
+        self.capacity = capacity
+        self.socket = None
+        self.active = False
+        self.running = True
+        self.shard = None
+        self.remote_counts = None
+        self.home = None
+        self.lanes = None
+        self.limits = {}
+        self.flood_mute = flood_mute
+
+    def __getattr__(self, name):
+        """
+        Only called for attributes which are not set, activates the channel the first time its state is used
+
+        :param name: The name of the attribute
+        :return: The value of the attribute
+        """
+        if name not in Channel.LAZY:
+            raise AttributeError(f"'Channel' object has no attribute '{name}'")
+        self.activate()
+        return self.__dict__[name]
+
+    def activate(self):
+        """
+        Creates the state of the channel and opens its log, filling the history from it. The state is published all at
+        once with the channel lock held until the history is in, so other threads never see a part of it.
+        """
+        with activation_lock:
+            if self.active:
+                return
+            lock = threading.Lock()
+            lock.acquire()
+            self.__dict__.update(connected=(), queue=collections.OrderedDict(), connected_names={}, queue_timer=None,
+                                 queue_notified=0, lock=lock, outgoing=[], history=collections.deque(),
+                                 history_size=0, history_total=0, log=None)
+            self.active = True
+            if message_log is not None and self.shard == shard_id:
+                self.log = message_log.channel(self.name)
+                for data in self.log.tail(history_lines, CHAT):
+                    self.keep(data)
+            lock.release()
+
+    def is_home(self):
+        """
+        :return: True if this node decides who joins the channel, which is always the case when not clustered
+        """
+        return cluster is None or self.home == cluster.name
+
+    def counts(self):
+        """
+        :return: How many clients are connected to the channel and how many are waiting in its queue. For a channel run
+            by another worker process these are the numbers last reported by the supervisor.
+        """
+        if self.remote_counts is not None:
+            return self.remote_counts
+        if not self.active:
+            return 0, 0
+        return len(self.connected), len(self.queue)
+
+    def notify(self, message):
+        """
+        Queues a notice for every client connected right now, called with the lock held. It is sent by unlock.
+
+        :param message: The notice
+        """
+        self.outgoing.append((message, self.connected))
+
+    def unlock(self):
+        """
+        Releases the lock and then sends the notices queued while it was held, to the clients connected at the time
+        """
+        outgoing, self.outgoing = self.outgoing, []
+        self.lock.release()
+        for message, recipients in outgoing:
+            broadcast(message, recipients)
+
+    def record(self, data):
+        """
+        Adds a chat message to the log and the history of the channel
+
+        :param data: The encoded message, shared with the broadcast
+        """
+        if self.log is not None:
+            message_log.append(self.log, CHAT, data)
+        self.remember(data)
+
+    def log_event(self, kind, line):
+        """
+        Adds a whisper, join or leave to the log of the channel, if it is logged
+
+        :param kind: WHISPER, JOIN or LEAVE
+        :param line: The line printed for the event
+        """
+        if self.log is not None:
+            message_log.append(self.log, kind, line.encode('ascii'))
+
+    def remember(self, data):
+        """
+        Adds a chat message to the history of the channel. The oldest messages are dropped once the history holds more
+        than history_lines messages or history_bytes bytes.
+
+        :param data: The encoded message
         """
         self.lock.acquire()
+        self.keep(data)
+        self.lock.release()
+
+    def keep(self, data):
+        """
+        Adds a chat message to the history, called with the lock held
+
+        :param data: The encoded message
+        """
+        self.history.append(data)
+        self.history_size += sys.getsizeof(data)
+        self.history_total += 1
+        while len(self.history) > history_lines or self.history_size > history_bytes:
+            self.history_size -= sys.getsizeof(self.history.popleft())
+
+    def replay(self, count, cursor):
+        """
+        Fetches the messages just before a point in the history, called with the lock held
+
+        :param count: How many messages to fetch at most
+        :param cursor: The number of the message to stop before, counted over every message the channel has recorded
+        :return: The messages, oldest first, and the number of the first of them to continue from
+        """
+        first = self.history_total - len(self.history)
+        cursor = max(cursor, first)
+        start = max(cursor - count, first)
+        return list(itertools.islice(self.history, start - first, cursor - first)), start
+
+    def listen(self):
+        """
+        Creates the channel socket, binds it to its port and starts listening for clients. The address is looked up
+        once for all channels.
+        """
+        global listen_host
+        if listen_host is None:
+            listen_host = socket.gethostbyname(socket.gethostname())
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Connections closed by the last run of the server may still hold the port in TIME_WAIT
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((listen_host, self.port))
+        self.socket.listen(accept_backlog)
+
+    def accept(self):
+        """
+        Called by the event loop when clients are waiting to connect. The event loop accepts for every channel in both
+        modes, so the server needs no thread per channel. Up to ACCEPT_BATCH connections are taken per wakeup so a
+        reconnect storm is not accepted one select call at a time, and their usernames are read as they arrive.
+        """
+        for _ in range(ACCEPT_BATCH):
+            try:
+                conn, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                # Out of file descriptors, the listen queue is left alone for a second rather than retried in a loop
+                console.log(f"[Server message ({timestamp()})] Cannot accept on {self.name}: {error.strerror}.",
+                            WARNING, event="accept_error", channel=self.name)
+                event_loop.watch(self.socket, None, None)
+                scheduler.call_later(1.0, partial(event_loop.watch, self.socket, self.accept, None))
+                return
+            Handshake(self, conn)
+
+    def handshake(self, conn, username, decoder, compress=False):
+        """
+        Called by the event loop once a new connection has sent its username.
+
+        :param conn: The socket of the new connection
+        :param username: The name the client asked for
+        :param decoder: The FrameDecoder of the connection, None if the client does not use framing
+        :param compress: True if the client asked for compressed frames
+        """
+        client = self.admit(username, conn, decoder, compress)
+        if client is None:
+            return
+        if mode == EVENT:
+            self.serve(client)
+        else:
+            thread = threading.Thread(target=client.handle_client, daemon=True)
+            thread.start()
+
+    def serve(self, client):
+        """
+        Starts reading from a client which has been added to the channel, used in event mode
+
+        :param client: The new client
+        """
+        client.reading = True
+        client.update_interest()
+        # Messages sent straight after the username may already be waiting in the decoder
+        try:
+            if not client.process_frames():
+                client.detach()
+        except:
+            client.detach()
+
+    def admit(self, username, conn, decoder=None, compress=False):
+        """
+        Creates the client for a new connection and adds it to the channel if the name is free.
+
+        :param username: The name the client asked for
+        :param conn: The socket of the new connection
+        :param decoder: The FrameDecoder of the connection, None if the client does not use framing
+        :param compress: True if the client asked for compressed frames
+        :return: The new client, or None if the connection was rejected
+        """
+        client = Client(username, conn, self, None, decoder)
+        if compress:
+            client.compress()
+        if not self.is_home():
+            cluster.request(self, username, partial(self.joined, client))
+            return None
+        if not name_exists(client.get_name(), self):
+            self.process_connection(ADD, client)
+            return client
+
+        self.reject(client)
+        return None
+
+    def reject(self, client):
+        """
+        Turns away a new connection because a client of the same name is already in the channel
+
+        :param client: The client of the new connection
+        """
+        client.write(f"[Server message ({timestamp()})] Cannot connect to the "
+                     f"{self.name} channel.\n".encode('ascii'))
+        client.conn.close()
+
+    def joined(self, client, status):
+        """
+        Called when the home node of the channel has answered the join request of a new connection
+
+        :param client: The client of the new connection
+        :param status: CONNECTED or QUEUE as decided by the home node, None if the name is taken
+        """
+        if status is None:
+            self.reject(client)
+            return
+        self.place(client, status)
+        self.serve(client)
+
+    def place(self, client, status):
+        """
+        Adds a client with the status decided by the home node of the channel, used in cluster mode
+
+        :param client: The client, or the Member standing for a client on another node
+        :param status: CONNECTED or QUEUE
+        """
+        self.lock.acquire()
+        if not isinstance(client, Member):
+            client.write(f"[Server message ({timestamp()})] Welcome to the {self.name} channel, "
+                         f"{client.get_name()}.\n".encode('ascii'))
+        if status == CONNECTED:
+            self.edit_connections(ADD, client)
+        else:
+            self.edit_queue(ADD, client)
+        self.unlock()
+
+    def promote(self, name):
+        """
+        Moves a client from the waiting queue into the channel once the home node has made room for it
+
+        :param name: The name of the client
+        """
+        self.lock.acquire()
+        client = self.queue.pop(name, None)
+        if client is not None:
+            untrack_user(client, self)
+            self.queue_changed()
+            self.edit_connections(ADD, client)
+        self.unlock()
+
+    def admit_switch(self, state, fd):
+        """
+        Adds a client which switched from a channel run by another worker process
+
+        :param state: The state of the client sent by the other worker
+        :param fd: The file descriptor of the client socket
+        """
+        conn = socket.socket(fileno=fd)
+        conn.setblocking(True)
+        if name_exists(state["name"], self):
+            # Only this copy of the socket is closed, the client stays in its old channel
+            conn.close()
+            send_control(("switched", state["source"], state["name"], False))
+            return
+
+        decoder = None
+        if state["pending"] is not None:
+            decoder = FrameDecoder()
+            decoder.feed(state["pending"])
+        client = Client(state["name"], conn, self, None, decoder)
+        if state["compress"]:
+            # Every frame sent so far was flushed, so a new stream carries on where the old one stopped
+            client.deflater = Deflater(compression_level)
+        if state["muted"] > time.time():
+            client.muted = state["muted"]
+            client.unmute_at(client.muted - time.time())
+        self.process_connection(ADD, client)
+        send_control(("switched", state["source"], state["name"], True))
+        client.reading = True
+        client.update_interest()
+        try:
+            if not client.process_frames():
+                client.detach()
+        except:
+            client.detach()
+
+    def restore(self, entry, sockets):
+        """
+        Takes over the history and the clients this channel had in the previous server process, each in the place it
+        had there. No one is told, as nothing has changed for them.
+
+        :param entry: The state of the channel sent by the previous server
+        :param sockets: The sockets sent along with the state
+        :return: The clients in the order of the entry, they are read from once every channel is restored
+        """
+        clients = [restore_client(state, sockets[state["socket"]], self) for state in entry["clients"]]
+        self.lock.acquire()
+        self.history.clear()
+        self.history_size = 0
+        for data in entry["history"]:
+            self.keep(data)
+        self.history_total = entry["history_total"]
+        self.connected = tuple(client for client in clients if client.status == CONNECTED)
+        for client in clients:
+            if client.status == CONNECTED:
+                self.connected_names[client.name] = client
+                client.start_afk_timer()
+            else:
+                self.queue[client.name] = client
+            track_user(client, self)
+        # The new config may allow more clients in
+        while len(self.connected) < self.capacity and self.queue:
+            self.edit_connections(ADD, self.edit_queue(REMOVE))
+        self.unlock()
+        return clients
+
+    def process_connection(self, operation, client):
+        """
+        Processes the client operation, handles adding, removing, timeout, and unexpected exit of the client.
+
+        :param operation: The operation to be performed on the client, be it to add, remove, timeout the client.
+        :param client: The target client
+        """
+        self.lock.acquire()
+        self.apply(operation, client)
+        self.unlock()
+        counts_changed()
+
+    def move(self, client, target):
+        """
+        Moves a client from this channel to the target in one step, so it is never in both or neither and no one else
+        can take its name in the target meanwhile. The two locks are always taken in the order of the channel ports,
+        so clients switching both ways at once cannot deadlock.
+
+        :param client: The client, connected to or waiting in this channel
+        :param target: Another channel of this process
+        :return: True if the client was moved, False if its name is taken in the target
+        """
+        first, second = sorted((self, target), key=lambda channel: channel.port)
+        first.lock.acquire()
+        second.lock.acquire()
+        moved = not name_exists(client.name, target)
+        if moved:
+            self.apply(REMOVE, client)
+            client.channel = target
+            client.reset_limits()
+            target.apply(ADD, client)
+        second.unlock()
+        first.unlock()
+        if moved:
+            counts_changed()
+        return moved
+
+    def apply(self, operation, client):
+        """
+        Does the work of process_connection, called with the lock held
+
+        :param operation: ADD, REMOVE, TIMEOUT or RANDEXIT
+        :param client: The target client
+        """
         if operation == ADD:
-            client.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] Welcome to the {self.name} channel, "
-                                f"{client.get_name()}.\n".encode('ascii'))
+            client.write(f"[Server message ({timestamp()})] Welcome to the {self.name} channel, "
+                         f"{client.get_name()}.\n".encode('ascii'))
             if len(self.connected) < self.capacity:
                 self.edit_connections(ADD, client)
             else:
                 self.edit_queue(ADD, client)
+            announce({"op": "placed", "channel": self.name, "name": client.name, "status": client.status})
+
+        elif operation == REMOVE or TIMEOUT:
+            if not isinstance(client, Member) and client.status in (CONNECTED, QUEUE):
+                announce({"op": "leave", "channel": self.name, "name": client.name, "operation": operation})
+            if client.status == CONNECTED or operation == RANDEXIT:
+                self.edit_connections(operation, client)
+                # checks if clients in the queue can be added to the channel after the current client is gone, only
+                # the home node of the channel decides this in a cluster
+                if len(self.connected) < self.capacity and self.is_home():
+                    if len(self.queue) > 0:
+                        client = self.edit_queue(REMOVE)
+                        self.edit_connections(ADD, client)
+                        announce({"op": "promote", "channel": self.name, "name": client.name})
+
+            elif client.status == QUEUE:
+                del self.queue[client.name]
+                untrack_user(client, self)
+                self.queue_changed()
+                if operation != RANDEXIT:
+                    console.log(f"[Server message ({timestamp()})] {client.get_name()} has left the channel.",
+                                INFO, event="leave", channel=self.name, user=client.name)
+
+    def edit_connections(self, operation, current_client):
+        """
+        Called by process_connection to performs the actual operation on the client.
+
+        :param operation: The operation to be performed
+        :param current_client: The target client
+        """
+        if operation == ADD:
+            current_client.update_status(CONNECTED)
+            current_client.update_lastmsg(time.monotonic())
+            current_client.start_afk_timer()
+            # Catches the client up on what was said before it joined in one write
+            lines, current_client.history_cursor = self.replay(history_replay, self.history_total)
+            if lines:
+                current_client.write_batch(lines)
+            self.connected = self.connected + (current_client,)
+            self.connected_names[current_client.name] = current_client
+            track_user(current_client, self)
+            self.notify(f"[Server message ({timestamp()})] {current_client.get_name()} has joined the channel.\n")
+            line = f"[Server message ({timestamp()})] {current_client.get_name()} has joined the {self.name} channel."
+            self.log_event(JOIN, line)
+            console.log(line, INFO, event="join", channel=self.name, user=current_client.name)
+
+        elif operation == REMOVE:
+            self.drop(current_client)
+            untrack_user(current_client, self)
+            self.notify(f"[Server message ({timestamp()})] {current_client.get_name()} has left the channel.\n")
+            self.log_event(LEAVE, f"[Server message ({timestamp()})] {current_client.get_name()} has left the channel.")
+
+            if not current_client.kicked:
+                console.log(f"[Server message ({timestamp()})] {current_client.get_name()} has left the channel.",
+                            INFO, event="leave", channel=self.name, user=current_client.name)
+
+        elif operation == TIMEOUT:
+            self.drop(current_client)
+            untrack_user(current_client, self)
+            self.notify(f"[Server message ({timestamp()})] {current_client.name} went AFK.\n")
+            line = f"[Server message ({timestamp()})] {current_client.name} went AFK."
+            metrics.count(TIMEOUTS, self.name)
+            self.log_event(LEAVE, line)
+            console.log(line, INFO, event="afk", channel=self.name, user=current_client.name)
+
+        elif operation == RANDEXIT:
+            if current_client.status == CONNECTED:
+                self.drop(current_client)
+            else:
+                del self.queue[current_client.name]
+                self.queue_changed()
+            untrack_user(current_client, self)
+            self.log_event(LEAVE, f"[Server message ({timestamp()})] {current_client.name} has left the channel.")
+
+    def drop(self, client):
+        """
+        Publishes the connected clients without the given one, called with the lock held
+
+        :param client: A connected client
+        """
+        self.connected = tuple(other for other in self.connected if other is not client)
+        del self.connected_names[client.name]
+
+    def edit_queue(self, operation, current_client=None):
+        """
+        Processes the client operation for clients in the waiting queue. The queue is ordered by arrival and keyed by
+        name, so joining, leaving from the front and leaving from the middle all take constant time.
+
+        :param operation: The operation to be performed
+        :param current_client: The target client
+        """
+        if operation == ADD:
+            current_client.update_status(QUEUE)
+            current_client.queue_position = len(self.queue)
+            self.queue[current_client.name] = current_client
+            track_user(current_client, self)
+            if not isinstance(current_client, Member):
+                current_client.write(f"[Server message ({timestamp()})] "
+                                     f"You are in the waiting queue and there are "
+                                     f"{current_client.queue_position} user(s) ahead of you.\n".encode('ascii'))
+
+        elif operation == REMOVE:
+            name, current_client = self.queue.popitem(last=False)
+            untrack_user(current_client, self)
+            self.queue_changed()
+
+        return current_client
+
+    def queue_changed(self):
+        """
+        Schedules the waiting clients to be told their new position, called with the lock held. Any number of changes
+        within queue_interval seconds lead to one update, so a busy queue does not flood its clients.
+        """
+        if self.queue_timer is None:
+            self.queue_timer = scheduler.call_at(max(time.monotonic(), self.queue_notified + queue_interval),
+                                                 self.notify_queue)
+
+    def notify_queue(self):
+        """
+        Tells every waiting client whose position changed since the last update how many users are ahead of it
+        """
+        self.lock.acquire()
+        self.queue_timer = None
+        self.queue_notified = time.monotonic()
+        moved = []
+        for position, client in enumerate(self.queue.values()):
+            # Members are told their position by the node they are connected to
+            if client.queue_position != position and not isinstance(client, Member):
+                client.queue_position = position
+                moved.append(client)
+        self.lock.release()
+        for client in moved:
+            client.write(f"[Server message ({timestamp()})] "
+                         f"You are in the waiting queue and there are "
+                         f"{client.queue_position} user(s) ahead of you.\n".encode('ascii'))
+
+    def disconnect(self):
+        """
+        Called in main to end the current channel
+        """
+        self.running = False
+
+
+def raise_file_limit():
+    """
+    Raises the limit of open files to the hard limit, every channel holds a listening socket besides its clients
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def collect_metrics():
+    """
+    Takes a snapshot of the metrics of this process along with the current client counts and queue depths of its
+    channels. Only copies are read, so it is safe to call from the thread serving the metrics endpoint.
+
+    :return: The snapshot
+    """
+    gauges = {}
+    for channel in channels:
+        if channel.remote_counts is not None:
+            continue
+        gauges[CONNECTED_CLIENTS, channel.name], gauges[QUEUED_CLIENTS, channel.name] = channel.counts()
+        gauges[OUTBOX_BYTES, channel.name] = sum(client.outbox_bytes for client in channel.connected) \
+            if channel.active else 0
+    gauges[CONSOLE_DROPPED, None] = console.dropped
+    return metrics.snapshot(gauges)
+
+
+def print_stats(snapshot):
+    """
+    Prints a summary of the metrics for the /stats command. Rates are taken over the time since the last /stats, or
+    since the server started for the first one.
+
+    :param snapshot: The snapshot of the whole server
+    """
+    global last_stats
+    previous = last_stats or {"time": snapshot["started"], "counters": {}}
+    elapsed = max(snapshot["time"] - previous["time"], 1e-9)
+    counters = snapshot["counters"]
+    gauges = snapshot["gauges"]
+    last_stats = snapshot
+
+    console.log(f"[Server message ({timestamp()})] Up {round(snapshot['time'] - snapshot['started'])} seconds, "
+                f"{chatmetrics.total(gauges, CONNECTED_CLIENTS)} connected, "
+                f"{chatmetrics.total(gauges, QUEUED_CLIENTS)} waiting, "
+                f"{chatmetrics.total(counters, BYTES_IN)} bytes in, "
+                f"{chatmetrics.total(counters, BYTES_OUT)} bytes out.")
+    deliveries = chatmetrics.total(counters, DELIVERIES)
+    if deliveries:
+        sends = chatmetrics.total(counters, SEND_CALLS)
+        console.log(f"[Server message ({timestamp()})] Writes: {sends} send call(s) for {deliveries} "
+                    f"delivery(ies), {sends / deliveries:.2f} per delivery.")
+    for channel in channels:
+        messages = counters.get((MESSAGES, channel.name), 0)
+        rate = (messages - previous["counters"].get((MESSAGES, channel.name), 0)) / elapsed
+        console.log(f"[Server message ({timestamp()})] {channel.name}: "
+                    f"{gauges.get((CONNECTED_CLIENTS, channel.name), 0)} connected, "
+                    f"{gauges.get((QUEUED_CLIENTS, channel.name), 0)} waiting, {messages} message(s), "
+                    f"{rate:.1f} per second, {gauges.get((OUTBOX_BYTES, channel.name), 0)} bytes waiting, "
+                    f"{counters.get((TIMEOUTS, channel.name), 0)} timeout(s), "
+                    f"{counters.get((KICKS, channel.name), 0)} kick(s), "
+                    f"{counters.get((THROTTLED, channel.name), 0)} throttled.")
+    for name, text in ((BROADCAST_SECONDS, "Broadcast"), (SEND_SECONDS, "Send")):
+        histogram = snapshot["histograms"][name]
+        if histogram[2] == 0:
+            continue
+        console.log(f"[Server message ({timestamp()})] {text}: {histogram[2]} call(s), mean "
+                    f"{histogram[1] / histogram[2] * 1e6:.1f} us, p50 under "
+                    f"{chatmetrics.quantile(histogram, 0.5) * 1e6:g} us, p99 under "
+                    f"{chatmetrics.quantile(histogram, 0.99) * 1e6:g} us.")
 
-        elif operation == REMOVE or TIMEOUT:
-            if client.status == CONNECTED or operation == RANDEXIT:
-                self.edit_connections(operation, client)
-                # checks if clients in the queue can be added to the channel after the current client is gone
-                if len(self.connected) < self.capacity:
-                    if len(self.queue) > 0:
-                        client = self.edit_queue(REMOVE)
-                        self.edit_connections(ADD, client)
 
-            elif client.status == QUEUE:
-                self.queue.remove(client)
-                for other_client in self.queue:
-                    other_client.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] "
-                                              f"You are in the waiting queue and there are "
-                                              f"{self.queue.index(other_client)} user(s) ahead of you.\n"
-                                              .encode('ascii'))
-                if operation != RANDEXIT:
-                    print(f"[Server message ({time.strftime('%H:%M:%S')})] {client.get_name()} has left the channel.",
-                          flush=True)
+def send_control(message, handle=None):
+    """
+    Sends a message from a worker process to the supervisor
 
-        self.lock.release()
+    :param message: The tuple to send
+    :param handle: A file descriptor to pass along with the message
+    """
+    with control_lock:
+        control.send(message)
+        if handle is not None:
+            reduction.send_handle(control, handle, os.getppid())
 
-    def edit_connections(self, operation, current_client):
+
+def counts_changed():
+    """
+    Schedules the client counts of the channels in this worker process to be reported to the supervisor. Changes are
+    gathered for a tenth of a second so a burst of joins leads to one report.
+    """
+    global counts_timer
+    if shard_id is not None and counts_timer is None:
+        counts_timer = scheduler.call_later(0.1, report_counts)
+
+
+def report_counts():
+    """
+    Reports the client counts of the channels in this worker process to the supervisor
+    """
+    global counts_timer
+    counts_timer = None
+    send_control(("counts", {channel.name: channel.counts() for channel in channels if channel.shard == shard_id}))
+
+
+def receive_control():
+    """
+    Handles a message from the supervisor, called by the event loop of a worker process
+    """
+    try:
+        message = control.recv()
+    except EOFError:
+        event_loop.running = False
+        return
+
+    if message[0] == "command":
+        if not server_command(message[1]):
+            event_loop.running = False
+    elif message[0] == "counts":
+        for name, counts in message[1].items():
+            channel = channel_index[name]
+            if channel.shard != shard_id:
+                channel.remote_counts = counts
+    elif message[0] == "admit":
+        fd = reduction.recv_handle(control)
+        channel_index[message[1]].admit_switch(message[2], fd)
+    elif message[0] == "switched":
+        client = switching.pop((message[1], message[2]), None)
+        if client is not None:
+            client.switched(message[3])
+    elif message[0] == "metrics":
+        send_control(("metrics", message[1], collect_metrics()))
+
+
+def run_worker(index, connection):
+    """
+    The main function of a worker process, serves its share of the channels from its own event loop
+
+    :param index: The number of the worker
+    :param connection: The pipe to the supervisor
+    """
+    global shard_id, control, mode, event_loop, scheduler, console
+    shard_id = index
+    # The writer thread of the console does not survive the fork
+    console = Console(level=console.level, style=console.style, capacity=console.capacity)
+    control = connection
+    mode = EVENT
+    event_loop = EventLoop()
+    scheduler = Scheduler(event_loop.wake)
+
+    for channel in channels:
+        if channel.shard == shard_id:
+            event_loop.add_channel(channel)
+        else:
+            channel.remote_counts = (0, 0)
+    if log_dir is not None:
+        open_logs()
+    event_loop.watch(control, receive_control, None)
+    event_loop.run()
+    console.close()
+
+
+class Supervisor:
+    """
+    Splits the channels across worker processes so the server is not limited to one core by the GIL. The supervisor
+    owns the admin console and forwards commands to the worker running the channel, passes client sockets between
+    workers when a client switches to a channel of another worker, and shares the client counts used by /list.
+    """
+    def __init__(self, count):
         """
-        Called by process_connection to performs the actual operation on the client.
+        Constructor of the supervisor
 
-        :param operation: The operation to be performed
-        :param current_client: The target client
+        :param count: How many worker processes to start
         """
-        if operation == ADD:
-            current_client.update_status(CONNECTED)
-            current_client.update_lastmsg(time.time())
-            self.connected.append(current_client)
-            broadcast(f"[Server message ({time.strftime('%H:%M:%S')})] {current_client.get_name()} "
-                      f"has joined the channel.\n", self.connected)
-            print(f"[Server message ({time.strftime('%H:%M:%S')})] {current_client.get_name()} "
-                  f"has joined the {self.name} channel.", flush=True)
+        self.count = count
+        self.workers = []
+        self.locks = []
+        self.processes = []
+        self.counts = {channel.name: (0, 0) for channel in channels}
+        self.snapshots = queue.Queue()
+        self.requests = itertools.count()
+        self.collect_lock = threading.Lock()
 
-        elif operation == REMOVE:
-            self.connected.remove(current_client)
-            broadcast(f"[Server message ({time.strftime('%H:%M:%S')})] {current_client.get_name()} "
-                      f"has left the channel.\n", self.connected)
+    def start(self):
+        """
+        Assigns the channels to workers, starts the worker processes and the thread relaying their messages
+        """
+        for index, channel in enumerate(channels):
+            channel.shard = index % self.count
+
+        for index in range(self.count):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_worker, args=(index, child), daemon=True)
+            process.start()
+            child.close()
+            self.workers.append(connection)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+
+        thread = threading.Thread(target=self.relay, daemon=True)
+        thread.start()
 
-            if not current_client.kicked:
-                print(f"[Server message ({time.strftime('%H:%M:%S')})] {current_client.get_name()} "
-                      f"has left the channel.", flush=True)
+    def send(self, index, message, handle=None):
+        """
+        Sends a message to a worker process
 
-        elif operation == TIMEOUT:
-            self.connected.remove(current_client)
-            broadcast(f"[Server message ({time.strftime('%H:%M:%S')})] {current_client.name} "
-                      f"went AFK.\n", self.connected)
-            print(f"[Server message ({time.strftime('%H:%M:%S')})] {current_client.name} went AFK.", flush=True)
+        :param index: The number of the worker
+        :param message: The tuple to send
+        :param handle: A file descriptor to pass along with the message
+        """
+        with self.locks[index]:
+            self.workers[index].send(message)
+            if handle is not None:
+                reduction.send_handle(self.workers[index], handle, self.processes[index].pid)
 
-        elif operation == RANDEXIT:
-            if current_client.status == CONNECTED:
-                self.connected.remove(current_client)
-            else:
-                self.queue.remove(current_client)
+    def relay(self):
+        """
+        Handles the messages sent by the workers until they have all exited
+        """
+        connections = list(self.workers)
+        while connections:
+            for connection in multiprocessing.connection.wait(connections):
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    connections.remove(connection)
+                    continue
 
-    def edit_queue(self, operation, current_client=None):
+                if message[0] == "counts":
+                    self.counts.update(message[1])
+                    for index in range(self.count):
+                        self.send(index, ("counts", self.counts))
+                elif message[0] == "switch":
+                    fd = reduction.recv_handle(connection)
+                    self.send(channel_index[message[1]].shard, ("admit", message[1], message[2]), fd)
+                    os.close(fd)
+                elif message[0] == "switched":
+                    self.send(channel_index[message[1]].shard, message)
+                elif message[0] == "metrics":
+                    self.snapshots.put((message[1], message[2]))
+
+    def collect(self):
         """
-        Processes the client operation for clients in the waiting queue.
+        Asks every worker process for a snapshot of its metrics and adds them up. A worker which does not answer within
+        a second is left out.
 
-        :param operation: The operation to be performed
-        :param current_client: The target client
+        :return: The snapshot of the whole server
         """
-        if operation == ADD:
-            current_client.update_status(QUEUE)
-            self.queue.append(current_client)
-            current_client.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] "
-                                        f"You are in the waiting queue and there are "
-                                        f"{self.queue.index(current_client)} user(s) ahead of you.\n".encode('ascii'))
+        with self.collect_lock:
+            request = next(self.requests)
+            for index in range(self.count):
+                self.send(index, ("metrics", request))
+            snapshots = []
+            deadline = time.time() + 1
+            while len(snapshots) < self.count:
+                try:
+                    answer, snapshot = self.snapshots.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                # Answers to an earlier request which timed out are thrown away
+                if answer == request:
+                    snapshots.append(snapshot)
+        return chatmetrics.merge(snapshots)
 
-        elif operation == REMOVE:
-            current_client = self.queue.pop(0)
-            for client in self.queue:
-                client.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] "
-                                    f"You are in the waiting queue and there are "
-                                    f"{self.queue.index(client)} user(s) ahead of you.\n".encode('ascii'))
+    def command(self, cmd):
+        """
+        Forwards an admin command to the worker processes it concerns
 
-        return current_client
+        :param cmd: The command split into words
+        :return: False if the server should shut down, True otherwise
+        """
+        if cmd[0] in ("/kick", "/mute", "/empty", "/outbox", "/history", "/search"):
+            channel = check_channel(cmd[1].split(":")[0].strip('\n'))
+            if not isinstance(channel, Channel):
+                # Prints that the channel does not exist
+                return server_command(cmd)
+            self.send(channel.shard, ("command", cmd))
+        elif cmd[0] == "/stats":
+            print_stats(self.collect())
+        elif cmd[0] in ("/where", "/shutdown"):
+            for index in range(self.count):
+                self.send(index, ("command", cmd))
+            if cmd[0] == "/shutdown":
+                for process in self.processes:
+                    process.join(1)
+                return False
+        return True
+
+
+class PeerLink:
+    """
+    The connection to another node of the cluster. Messages are JSON objects sent as frames, and like client output
+    whatever the socket does not take straight away waits until the event loop finds it writable.
+    """
+    def __init__(self, node, conn, name=None):
+        """
+        Constructor of the link, runs on the event loop thread
 
-    def disconnect(self):
+        :param node: The Node of this server
+        :param conn: The connected socket
+        :param name: The name of the other node, None until its hello arrives on an accepted connection
         """
-        Called in main to end the current channel
+        self.node = node
+        self.conn = conn
+        self.name = name
+        self.decoder = FrameDecoder()
+        self.output = bytearray()
+        self.lock = threading.Lock()
+        self.conn.setblocking(False)
+        event_loop.watch(self.conn, self.on_readable, None)
+
+    def send(self, message):
         """
-        self.running = False
+        Queues a message for the other node
+
+        :param message: The dictionary to send
+        """
+        data = encode_frame(json.dumps(message).encode('ascii'))
+        with self.lock:
+            if not self.output:
+                try:
+                    sent = self.conn.send(data)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    return
+                if sent == len(data):
+                    return
+                data = data[sent:]
+            self.output += data
+        event_loop.call_soon(self.update_interest)
+
+    def on_writable(self):
+        """
+        Called by the event loop when the socket can take more data
+        """
+        with self.lock:
+            try:
+                sent = self.conn.send(self.output)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                sent = len(self.output)
+            del self.output[:sent]
+        self.update_interest()
+
+    def update_interest(self):
+        """
+        Tells the event loop which socket events the link is waiting for, runs on the event loop thread
+        """
+        if self.conn.fileno() == -1:
+            return
+        with self.lock:
+            writing = bool(self.output)
+        event_loop.watch(self.conn, self.on_readable, self.on_writable if writing else None)
+
+    def on_readable(self):
+        """
+        Called by the event loop when the other node has sent data, hands every complete message to the node
+        """
+        try:
+            data = self.conn.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close()
+            return
 
+        self.decoder.feed(data)
+        try:
+            for payload in self.decoder:
+                self.node.receive(self, json.loads(payload))
+        except ValueError:
+            self.close()
 
-if __name__ == '__main__':
+    def close(self):
+        """
+        Closes the link, the members of the other node leave their channels
+        """
+        if self.conn.fileno() == -1:
+            return
+        event_loop.watch(self.conn, None, None)
+        self.conn.close()
+        self.node.link_lost(self)
+
+
+class Node:
     """
-    The main program, launches all the channels and handles any server commands.
+    One server of a cluster. Every node serves every channel of the config file, and each channel has a home node,
+    chosen by its position in the config file, which decides who may join it and keeps its waiting queue. The other
+    nodes ask the home node before adding a client and relay chat messages and membership changes to each other, so
+    the same names, counts and queues are seen everywhere.
+    """
+    def __init__(self, name, port, peers):
+        """
+        Constructor of the node
+
+        :param name: The name of this node
+        :param port: The port other nodes connect to
+        :param peers: The other nodes as NAME=HOST:PORT strings
+        """
+        self.name = name
+        self.port = port
+        self.addresses = {}
+        for peer in peers:
+            peer_name, address = peer.split("=")
+            host, peer_port = address.rsplit(":", 1)
+            self.addresses[peer_name] = (host, int(peer_port))
+        self.links = {}
+        self.dialing = set()
+        self.pending = {}
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        nodes = sorted([name] + list(self.addresses))
+        for index, channel in enumerate(channels):
+            channel.home = nodes[index % len(nodes)]
+
+    def start(self):
+        """
+        Starts listening for other nodes and connecting to them, runs before the event loop is started
+        """
+        host = socket.gethostbyname(socket.gethostname())
+        self.socket.bind((host, self.port))
+        self.socket.listen()
+        self.socket.setblocking(False)
+        event_loop.watch(self.socket, self.accept, None)
+        self.connect_peers()
+
+    def connect_peers(self):
+        """
+        Connects to every node named after this one which is not connected yet, so each pair of nodes has one link.
+        Runs again every second so nodes which start later or restart are picked up.
+        """
+        for name, address in self.addresses.items():
+            if name > self.name and name not in self.links and name not in self.dialing:
+                conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                conn.setblocking(False)
+                conn.connect_ex(address)
+                self.dialing.add(name)
+                event_loop.watch(conn, None, partial(self.dialed, name, conn))
+        scheduler.call_later(1, self.connect_peers)
+
+    def dialed(self, name, conn):
+        """
+        Called by the event loop once a connection to another node has been made or has failed
+
+        :param name: The name of the other node
+        :param conn: The socket
+        """
+        event_loop.watch(conn, None, None)
+        self.dialing.discard(name)
+        if conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            conn.close()
+            return
+        link = PeerLink(self, conn, name)
+        link.send({"op": "hello", "node": self.name})
+        self.linked(link)
+
+    def accept(self):
+        """
+        Called by the event loop when another node connects, it names itself in its first message
+        """
+        try:
+            conn, addr = self.socket.accept()
+        except BlockingIOError:
+            return
+        PeerLink(self, conn)
+
+    def linked(self, link):
+        """
+        Registers a link once the name of the other node is known and tells it about the clients of this node
+
+        :param link: The new link
+        """
+        old = self.links.get(link.name)
+        self.links[link.name] = link
+        if old is not None:
+            old.close()
+        console.log(f"[Server message ({timestamp()})] Linked to node {link.name}.")
+        for channel in channels:
+            if not channel.active:
+                continue
+            for client in channel.connected + tuple(channel.queue.values()):
+                if not isinstance(client, Member):
+                    link.send({"op": "placed", "channel": channel.name, "name": client.name, "status": client.status})
+
+    def link_lost(self, link):
+        """
+        Removes the members of a node whose link has closed, and refuses requests waiting for it
+
+        :param link: The closed link
+        """
+        if link.name is None or self.links.get(link.name) is not link:
+            return
+        del self.links[link.name]
+        console.log(f"[Server message ({timestamp()})] Lost the link to node {link.name}.", WARNING, node=link.name)
+        for channel in channels:
+            if channel.active:
+                for client in channel.connected + tuple(channel.queue.values()):
+                    if isinstance(client, Member) and client.node == link.name:
+                        channel.process_connection(REMOVE, client)
+            for key in [key for key in self.pending if channel_index[key[0]].home == link.name]:
+                self.pending.pop(key)(None)
+
+    def send(self, name, message):
+        """
+        Sends a message to one node
+
+        :param name: The name of the node
+        :param message: The dictionary to send
+        """
+        link = self.links.get(name)
+        if link is not None:
+            link.send(message)
+
+    def announce(self, message):
+        """
+        Sends a message to every connected node
+
+        :param message: The dictionary to send
+        """
+        for link in list(self.links.values()):
+            link.send(message)
+
+    def request(self, channel, name, callback):
+        """
+        Asks the home node of the channel to add a client of this node
+
+        :param channel: The channel to join
+        :param name: The name of the client
+        :param callback: Called with CONNECTED or QUEUE once the client has been placed, or None if it was refused
+        """
+        if channel.home not in self.links or (channel.name, name) in self.pending:
+            # Answered from the scheduler so the caller is never re-entered
+            scheduler.call_later(0, partial(callback, None))
+            return
+        self.pending[(channel.name, name)] = callback
+        self.send(channel.home, {"op": "admit", "channel": channel.name, "name": name})
+
+    def receive(self, link, message):
+        """
+        Handles a message from another node, runs on the event loop thread
+
+        :param link: The link the message arrived on
+        :param message: The decoded dictionary
+        """
+        if message["op"] == "hello":
+            link.name = message["node"]
+            self.linked(link)
+            return
+        if link.name is None:
+            link.close()
+            return
+
+        channel = channel_index.get(message.get("channel"))
+        if channel is None:
+            return
+        name = message.get("name")
+
+        if message["op"] == "chat":
+            channel.record(broadcast(message["line"], channel.connected))
+            console.log(message["line"], INFO, event="chat", channel=channel.name, node=link.name)
+
+        # The home node decides if a client of another node may join and tells every node where it was placed
+        elif message["op"] == "admit":
+            if name_exists(name, channel):
+                link.send({"op": "refused", "channel": channel.name, "name": name})
+                return
+            status = CONNECTED if len(channel.connected) < channel.capacity else QUEUE
+            channel.place(Member(name, link.name, channel, None), status)
+            self.announce({"op": "placed", "channel": channel.name, "name": name, "node": link.name,
+                           "status": status})
+
+        elif message["op"] == "placed":
+            node = message.get("node", link.name)
+            if node == self.name:
+                callback = self.pending.pop((channel.name, name), None)
+                if callback is not None:
+                    callback(message["status"])
+            elif not name_exists(name, channel):
+                channel.place(Member(name, node, channel, None), message["status"])
+
+        elif message["op"] == "refused":
+            callback = self.pending.pop((channel.name, name), None)
+            if callback is not None:
+                callback(None)
+
+        elif message["op"] == "promote":
+            channel.promote(name)
+
+        elif message["op"] == "leave":
+            client = channel.connected_names.get(name) or channel.queue.get(name)
+            if isinstance(client, Member) and client.node == link.name:
+                channel.process_connection(message["operation"], client)
+
+        # The rest act on a client connected to this node
+        else:
+            client = channel.connected_names.get(name) or channel.queue.get(name)
+            if client is None or isinstance(client, Member):
+                return
+            if message["op"] == "deliver":
+                client.write(message["data"].encode('UTF-8'))
+            elif message["op"] == "mute":
+                client.mute(message["duration"])
+            elif message["op"] == "kick":
+                client.kick()
+                channel.process_connection(REMOVE, client)
+                client.disconnect()
+                console.log(f"[Server message ({timestamp()})] Kicked {client.get_name()}.", WARNING, event="kick",
+                            channel=channel.name, user=client.name)
+
+
+def restore_client(state, conn, channel):
     """
-    parse_config()
+    Recreates a client taken over from the previous server process
 
+    :param state: The state of the client sent by the previous server
+    :param conn: The socket of the client
+    :param channel: The channel the client is placed in
+    :return: The client
+    """
+    conn.setblocking(True)
+    decoder = None
+    if state["pending"] is not None:
+        decoder = FrameDecoder()
+        decoder.feed(state["pending"])
+    client = Client(state["name"], conn, channel, state["status"], decoder)
+    if state["compress"]:
+        # Every frame sent so far was flushed, so a new stream carries on where the old one stopped
+        client.deflater = Deflater(compression_level)
+    # The monotonic clock of another process has another origin, so the time is passed on the wall clock
+    client.last_message = state["last_message"] - time.time() + time.monotonic()
+    client.queue_position = state["queue_position"]
+    client.history_cursor = state["history_cursor"]
+    client.dropped = state["dropped"]
+    if state["muted"] > time.time():
+        client.muted = state["muted"]
+        client.unmute_at(client.muted - time.time())
+    if state["outbox"]:
+        # May start in the middle of a message, so it goes out before anything else
+        client.push(state["outbox"])
+    return client
+
+
+def freeze():
+    """
+    Stops watching every socket of the server and collects the state of its channels and clients, runs on the event
+    loop thread. Nothing is read or sent until thaw is called or the process exits.
+
+    :return: The state, and the sockets it refers to by their index
+    """
+    # Broadcasts already handed to the fan-out threads are queued first, so they are part of the outboxes
+    for worker in fanout_workers:
+        worker.tasks.join()
+    sockets = []
+    state = {"channels": [], "handshakes": []}
     for channel in channels:
-        thread = threading.Thread(target=channel.start, daemon=True)
+        event_loop.watch(channel.socket, None, None)
+        entry = {"name": channel.name, "port": channel.port, "socket": len(sockets), "active": channel.active,
+                 "clients": []}
+        sockets.append(channel.socket)
+        state["channels"].append(entry)
+        if not channel.active:
+            continue
+        entry["history"] = list(channel.history)
+        entry["history_total"] = channel.history_total
+        for client in channel.connected + tuple(channel.queue.values()):
+            event_loop.watch(client.conn, None, None)
+            with client.out_lock:
+                outbox = b''.join(client.outbox)
+            transfer = client.transfer
+            if transfer is not None:
+                transfer = {"target": transfer.target.name, "filename": transfer.filename,
+                            "remaining": transfer.remaining, "size": transfer.size, "compress": transfer.compress}
+            entry["clients"].append({"name": client.name, "socket": len(sockets), "status": client.status,
+                                     "muted": client.muted,
+                                     "last_message": client.last_message - time.monotonic() + time.time(),
+                                     "queue_position": client.queue_position, "history_cursor": client.history_cursor,
+                                     "dropped": client.dropped, "compress": client.deflater is not None,
+                                     "pending": bytes(client.decoder.buffer) if client.decoder is not None else None,
+                                     "outbox": outbox, "transfer": transfer})
+            sockets.append(client.conn)
+    for handshake in handshakes:
+        event_loop.watch(handshake.conn, None, None)
+        state["handshakes"].append({"channel": handshake.channel.name, "socket": len(sockets),
+                                    "pending": handshake.pending()})
+        sockets.append(handshake.conn)
+    state["sockets"] = len(sockets)
+    return state, sockets
+
+
+def thaw():
+    """
+    Watches every socket again after a handoff failed, runs on the event loop thread
+    """
+    for channel in channels:
+        event_loop.watch(channel.socket, channel.accept, None)
+        if not channel.active:
+            continue
+        if channel.log is not None:
+            channel.log = message_log.channel(channel.name)
+        for client in channel.connected + tuple(channel.queue.values()):
+            client.update_interest()
+    for handshake in handshakes:
+        event_loop.watch(handshake.conn, handshake.read, None)
+
+
+def serve_handoff(path):
+    """
+    Waits on a Unix socket for a newly started server to take over from this one, runs on its own thread. If the new
+    server fails before it has everything, this one carries on and waits for the next.
+
+    :param path: The path of the Unix socket
+    """
+    while True:
+        # The socket file of a server which was shut down is left behind
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = multiprocessing.connection.Listener(path, family='AF_UNIX')
+        connection = listener.accept()
+        # Only one server takes over at a time
+        listener.close()
+        finished = threading.Event()
+        event_loop.call_soon(partial(hand_over, connection, finished))
+        finished.wait()
+        connection.close()
+
+
+def hand_over(connection, finished):
+    """
+    Passes every socket of the server, with SCM_RIGHTS, and the state of its channels and clients to the server taking
+    over. Runs on the event loop thread, so nothing is read, sent or timed out meanwhile; new connections wait in the
+    listen queues for the new server. This process exits once the new server has everything, if anything goes wrong
+    it carries on serving instead.
+
+    :param connection: The connection from the new server
+    :param finished: Set if the handoff failed
+    """
+    state, sockets = freeze()
+    try:
+        # The new server opens the logs again, after everything logged here is written
+        if message_log is not None:
+            message_log.close()
+        connection.send(("state", state))
+        with socket.fromfd(connection.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            for start in range(0, len(sockets), HANDOFF_BATCH):
+                reduction.sendfds(sock, [conn.fileno() for conn in sockets[start:start + HANDOFF_BATCH]])
+        if not connection.poll(HANDOFF_TIMEOUT) or connection.recv() != ("done",):
+            raise TimeoutError("The new server did not take over in time")
+    except (OSError, EOFError) as error:
+        if message_log is not None:
+            open_logs()
+        thaw()
+        console.log(f"[Server message ({timestamp()})] Handoff failed, still serving: {error}.", WARNING,
+                    event="handoff_failed")
+        finished.set()
+        return
+
+    clients = sum(len(entry["clients"]) for entry in state["channels"])
+    console.log(f"[Server message ({timestamp()})] Handed {clients} client(s) over to the new server.", INFO,
+                event="handoff")
+    console.close()
+    # The new server holds every socket now, so closing the copies of this process disconnects no one
+    os._exit(0)
+
+
+def take_over(path):
+    """
+    Connects to the server serving handoffs on the path and receives its sockets and state, which stops it from
+    reading from or sending to anyone until the new server is ready
+
+    :param path: The path of the Unix socket
+    :return: The connection to the old server, the state, and the sockets it refers to by their index
+    """
+    connection = multiprocessing.connection.Client(path, family='AF_UNIX')
+    kind, state = connection.recv()
+    fds = []
+    with socket.fromfd(connection.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        while len(fds) < state["sockets"]:
+            fds += reduction.recvfds(sock, min(HANDOFF_BATCH, state["sockets"] - len(fds)))
+    return connection, state, [socket.socket(fileno=fd) for fd in fds]
+
+
+def adopt(connection, state, sockets):
+    """
+    Puts the sockets and state taken over from the previous server in place, before the channels of the new config
+    listen. The config is applied as a change to what was running: a channel which is still there keeps its clients,
+    history and, unless its port changed, its listening socket with the connections waiting in it. The clients of a
+    channel which is gone are told and moved to the first channel, and new channels start empty.
+
+    :param connection: The connection to the old server, which exits once told the handoff is done
+    :param state: The state sent by the old server
+    :param sockets: The sockets sent along with the state
+    """
+    restored = {}
+    for entry in state["channels"]:
+        channel = channel_index.get(entry["name"])
+        if channel is not None and channel.port == entry["port"]:
+            channel.socket = sockets[entry["socket"]]
+        else:
+            sockets[entry["socket"]].close()
+        if channel is not None and entry["active"]:
+            restored[entry["name"]] = channel.restore(entry, sockets)
+    serving = [client for clients in restored.values() for client in clients]
+
+    # Moved once every remaining channel holds its own clients, so none of them loses their name
+    first = channels[0]
+    for entry in state["channels"]:
+        if entry["name"] in channel_index:
+            continue
+        restored[entry["name"]] = [restore_client(client, sockets[client["socket"]], first)
+                                   for client in entry["clients"]]
+        for client in restored[entry["name"]]:
+            client.write(f"[Server message ({timestamp()})] The {entry['name']} channel has been closed.\n"
+                         .encode('ascii'))
+            if name_exists(client.name, first):
+                client.status = DISCONNECTED
+                first.reject(client)
+                continue
+            first.process_connection(ADD, client)
+            serving.append(client)
+
+    # Files being sent carry on where they were
+    for entry in state["channels"]:
+        clients = restored.get(entry["name"], [])
+        names = {client.name: client for client in clients}
+        for client, client_state in zip(clients, entry["clients"]):
+            transfer = client_state["transfer"]
+            if transfer is not None and transfer["target"] in names:
+                client.transfer = Transfer(client, names[transfer["target"]], transfer["filename"])
+                client.transfer.remaining = transfer["remaining"]
+                client.transfer.size = transfer["size"]
+                client.transfer.compress = transfer["compress"]
+
+    for client in serving:
+        client.channel.serve(client)
+    for handshake in state["handshakes"]:
+        Handshake(channel_index.get(handshake["channel"], first), sockets[handshake["socket"]], handshake["pending"])
+    connection.send(("done",))
+    connection.close()
+    console.log(f"[Server message ({timestamp()})] Took over {len(serving)} client(s) from the previous server.",
+                INFO, event="takeover")
+
+
+class EventLoop:
+    """
+    Single-threaded I/O engine. In event mode every channel and client socket is registered with one selector, so the
+    whole server runs on one thread instead of two threads per client. In both modes it sends the queued output of
+    every client and runs the scheduler.
+    """
+    def __init__(self):
+        """
+        Constructor of the event loop
+        """
+        self.selector = selectors.DefaultSelector()
+        self.running = True
+        self.ready = collections.deque()
+        self.thread = None
+        self.waker, self.wakee = socket.socketpair()
+        self.wakee.setblocking(False)
+        self.selector.register(self.wakee, selectors.EVENT_READ, (self.drain_wakeup, None))
+
+    def wake(self):
+        """
+        Interrupts the select call, used by other threads when they schedule an earlier timer
+        """
+        try:
+            self.waker.send(b'\0')
+        except OSError:
+            pass
+
+    def drain_wakeup(self):
+        """
+        Empties the wakeup socket once the loop has woken up
+        """
+        try:
+            while self.wakee.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def call_soon(self, callback):
+        """
+        Runs the callback on the event loop thread, straight away if already on it
+
+        :param callback: Function called without arguments
+        """
+        if threading.current_thread() is self.thread:
+            callback()
+            return
+        self.ready.append(callback)
+        self.wake()
+
+    def watch(self, sock, reader, writer):
+        """
+        Sets which events the loop waits for on a socket, runs on the event loop thread
+
+        :param sock: The socket to watch
+        :param reader: Called when the socket is readable, None to stop reading
+        :param writer: Called when the socket is writable, None to stop writing
+        """
+        events = (selectors.EVENT_READ if reader else 0) | (selectors.EVENT_WRITE if writer else 0)
+        try:
+            self.selector.get_key(sock)
+            registered = True
+        except (KeyError, ValueError):
+            registered = False
+
+        if not events:
+            if registered:
+                self.selector.unregister(sock)
+        elif registered:
+            self.selector.modify(sock, events, (reader, writer))
+        else:
+            self.selector.register(sock, events, (reader, writer))
+
+    def add_channel(self, channel):
+        """
+        Starts listening on the channel port, unless its socket was taken over from the previous server, and registers
+        it for incoming connections.
+
+        :param channel: The channel to serve
+        """
+        if channel.socket is None:
+            channel.listen()
+        channel.socket.setblocking(False)
+        self.watch(channel.socket, channel.accept, None)
+
+    def run(self):
+        """
+        Waits for socket events and due timers and dispatches them until the server shuts down.
+        """
+        self.thread = threading.current_thread()
+        while self.running:
+            timeout = 0 if self.ready else scheduler.next_timeout()
+            for key, events in self.selector.select(timeout=timeout):
+                reader, writer = key.data
+                if events & selectors.EVENT_READ and reader is not None:
+                    reader()
+                if events & selectors.EVENT_WRITE and writer is not None:
+                    writer()
+            while self.ready:
+                self.ready.popleft()()
+            scheduler.run_due()
+
+
+def server_command(cmd):
+    """
+    Runs one admin command typed into the server console
+
+    :param cmd: The command split into words
+    :return: False if the server should shut down, True otherwise
+    """
+    # Disconnects the target client from the selected channel
+    if cmd[0] == "/kick":
+        channel, user = cmd[1].split(":")
+        channel = check_channel(channel)
+        if isinstance(channel, Channel):
+            user = check_name(user, channel)
+            if isinstance(user, Client):
+                user.kick()
+                channel.process_connection(REMOVE, user)
+                user.disconnect()
+                metrics.count(KICKS, channel.name)
+                console.log(f"[Server message ({timestamp()})] Kicked {user.get_name()}.", WARNING, event="kick",
+                            channel=channel.name, user=user.name)
+            else:
+                console.log(f"[Server message ({timestamp()})] {user} is not in {channel.name}.")
+        else:
+            console.log(f"[Server message ({timestamp()})] {channel} does not exist.")
+
+    # Mutes the target client in the selected channel
+    elif cmd[0] == "/mute":
+        channel, user = cmd[1].split(":")
+        duration = cmd[2].strip('\n')
+        channel = check_channel(channel)
+        if isinstance(channel, Channel):
+            user = check_name(user, channel)
+            if isinstance(user, Client):
+                if duration.isdigit():
+                    if int(duration) > 0:
+                        user.write(f"[Server message ({timestamp()})] "
+                                   f"You have been muted for {duration} seconds.\n".encode('ascii'))
+                        console.log(f"[Server message ({timestamp()})] Muted {user.get_name()} for {duration} seconds.",
+                                    WARNING, event="mute", channel=channel.name, user=user.name)
+
+                        # The scheduler tracks how long the client is muted for
+                        user.mute(int(duration))
+                        return True
+                console.log(f"[Server message ({timestamp()})] Invalid mute time.")
+                return True
+        console.log(f"[Server message ({timestamp()})] {user} is not here.")
+
+    # Disconnects all connected and in queue clients for the given channel
+    elif cmd[0] == "/empty":
+        channel = cmd[1].strip('\n')
+        channel = check_channel(channel)
+        if isinstance(channel, Channel):
+            channel.lock.acquire()
+            emptied = tuple(channel.queue.values()) + channel.connected
+            channel.connected = ()
+            channel.queue = collections.OrderedDict()
+            channel.connected_names = {}
+            channel.lock.release()
+            for client in emptied:
+                if not isinstance(client, Member):
+                    announce({"op": "leave", "channel": channel.name, "name": client.name, "operation": REMOVE})
+                client.disconnect()
+                untrack_user(client, channel)
+            counts_changed()
+            console.log(f"[Server message ({timestamp()})] {channel.name} has been emptied.", WARNING, event="empty",
+                        channel=channel.name)
+            return True
+        console.log(f"[Server message ({timestamp()})] {channel} does not exist.")
+
+    # Shows every channel the given user is connected to or waiting for
+    elif cmd[0] == "/where":
+        name = cmd[1].strip('\n')
+        found = locate(name)
+        for channel_name, client in found.items():
+            state = "connected to" if client.status == CONNECTED else "waiting for"
+            console.log(f"[Server message ({timestamp()})] {name} is {state} {channel_name}.")
+        # Every worker process is asked when sharded, so only the ones which found the user answer
+        if not found and shard_id is None:
+            console.log(f"[Server message ({timestamp()})] {name} is not here.")
+
+    # Shows how much output is waiting to be sent to every client of the given channel
+    elif cmd[0] == "/outbox":
+        channel = cmd[1].strip('\n')
+        channel = check_channel(channel)
+        if isinstance(channel, Channel):
+            for client in channel.connected + tuple(channel.queue.values()):
+                count, size = client.queue_depth()
+                console.log(f"[Server message ({timestamp()})] {client.get_name()}: {count} message(s), "
+                            f"{size} bytes waiting, {client.dropped} dropped.")
+            return True
+        console.log(f"[Server message ({timestamp()})] {channel} does not exist.")
+
+    # Shows how much memory the message history of the given channel takes
+    elif cmd[0] == "/history":
+        channel = cmd[1].strip('\n')
+        channel = check_channel(channel)
+        if isinstance(channel, Channel):
+            console.log(f"[Server message ({timestamp()})] {channel.name} keeps {len(channel.history)} message(s) in "
+                        f"{channel.history_size} of {history_bytes} bytes.")
+            return True
+        console.log(f"[Server message ({timestamp()})] {channel} does not exist.")
+
+    # Shows the logged messages of the given channel which contain the given text, the newest 20 at most
+    elif cmd[0] == "/search":
+        channel = check_channel(cmd[1].strip('\n'))
+        text = ' '.join(cmd[2:]).strip('\n')
+        if isinstance(channel, Channel):
+            if channel.log is None:
+                console.log(f"[Server message ({timestamp()})] {channel.name} is not logged.")
+                return True
+            found = collections.deque(channel.log.search(text.encode('ascii')), maxlen=20)
+            for when, kind, payload in found:
+                console.log(f"{time.strftime('%Y-%m-%d', time.localtime(when))} {payload.decode('ascii')}")
+            console.log(f"[Server message ({timestamp()})] Found {len(found)} message(s).")
+            return True
+        console.log(f"[Server message ({timestamp()})] {channel} does not exist.")
+
+    # Shows the message rates, client counts, queue depths and latencies of every channel
+    elif cmd[0] == "/stats":
+        print_stats(collect_metrics())
+
+    # Shut down entire server including all channels
+    elif cmd[0] == "/shutdown":
+        for channel in channels:
+            if channel.active:
+                for client in list(channel.queue.values()):
+                    client.update_status(DISCONNECTED)
+                for client in channel.connected:
+                    client.update_status(DISCONNECTED)
+            channel.disconnect()
+        if message_log is not None:
+            message_log.close()
+        return False
+    return True
+
+
+def parse_args():
+    """
+    Parses the command line arguments of the server
+    """
+    parser = argparse.ArgumentParser(description="Multi-channel chat server.")
+    parser.add_argument("config", help="path to the channel config file")
+    parser.add_argument("--mode", choices=(THREADED, EVENT), default=THREADED,
+                        help="threaded runs two threads per client, event serves everything from one event loop")
+    parser.add_argument("--outbox-limit", type=int, default=outbox_limit,
+                        help="bytes which may wait to be sent to one client before the slow consumer policy applies")
+    parser.add_argument("--slow-policy", choices=(DROP, DISCONNECT, COALESCE), default=slow_policy,
+                        help="what happens to a client which reads too slowly: drop its oldest messages, disconnect "
+                             "it, or replace its backlog with a notice of how many messages were skipped")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="number of worker processes to split the channels across, more than one implies event mode")
+    parser.add_argument("--history-lines", type=int, default=history_lines,
+                        help="most chat messages every channel keeps for /history and for clients which join")
+    parser.add_argument("--history-bytes", type=int, default=history_bytes,
+                        help="most bytes the history of one channel may take")
+    parser.add_argument("--history-replay", type=int, default=history_replay,
+                        help="chat messages sent to a client when it joins a channel, also the default page of /history")
+    parser.add_argument("--console-level", choices=tuple(chatconsole.LEVELS), default="info",
+                        help="least important server messages written to the console")
+    parser.add_argument("--console-format", choices=(chatconsole.TEXT, chatconsole.JSON), default=chatconsole.TEXT,
+                        help="text keeps the usual messages, json writes one JSON object per line")
+    parser.add_argument("--console-queue", type=int, default=10000,
+                        help="server messages which may wait to be written before new ones are dropped")
+    parser.add_argument("--metrics-port", type=int,
+                        help="localhost port serving the metrics in the Prometheus text format, not served if not given")
+    parser.add_argument("--log-dir", help="directory to keep a durable log of every channel in, not logged if not given")
+    parser.add_argument("--log-interval", type=float, default=log_interval,
+                        help="longest time in seconds a logged message waits before it is written and synced")
+    parser.add_argument("--log-segment-bytes", type=int, default=log_segment_bytes,
+                        help="size after which the log of a channel starts a new segment file")
+    parser.add_argument("--node", help="name of this node, enables cluster mode which implies event mode")
+    parser.add_argument("--cluster-port", type=int, default=0, help="port other nodes connect to in cluster mode")
+    parser.add_argument("--peer", action="append", default=[], metavar="NAME=HOST:PORT",
+                        help="another node of the cluster, may be given several times")
+    parser.add_argument("--queue-interval", type=float, default=queue_interval,
+                        help="minimum seconds between two updates of the queue position sent to a waiting client")
+    parser.add_argument("--coalesce-interval", type=float, default=coalesce_interval,
+                        help="longest seconds a broadcast may wait to be sent together with the next ones, such as "
+                             "0.005, 0 sends every message straight away")
+    parser.add_argument("--coalesce-bytes", type=int, default=coalesce_bytes,
+                        help="bytes held back for one client after which they are sent without waiting any longer")
+    parser.add_argument("--fanout-threshold", type=int, default=fanout_threshold,
+                        help="members from which a broadcast is split across the fan-out threads, 0 never splits")
+    parser.add_argument("--fanout-threads", type=int, default=fanout_threads,
+                        help="threads delivering the broadcasts to large channels")
+    parser.add_argument("--flood-mute", type=int, default=flood_mute,
+                        help="seconds a client going over the flood limits of a channel is muted for, unless the "
+                             "channel sets its own")
+    parser.add_argument("--compression-level", type=int, default=compression_level,
+                        help="zlib level of the frames sent to clients which ask for compression, 0 turns it off")
+    parser.add_argument("--handshake-timeout", type=float, default=handshake_timeout,
+                        help="seconds a new connection has to send its username before it is closed")
+    parser.add_argument("--accept-backlog", type=int, default=accept_backlog,
+                        help="connections the kernel queues for every channel before they are accepted")
+    parser.add_argument("--handoff", metavar="PATH",
+                        help="Unix socket through which a newly started server can take over from this one without "
+                             "disconnecting anyone, implies event mode")
+    parser.add_argument("--takeover", action="store_true",
+                        help="take over the sockets, channels and clients of the server serving --handoff instead of "
+                             "starting empty")
+    args = parser.parse_args()
+    if args.takeover and args.handoff is None:
+        parser.error("--takeover needs --handoff")
+    if args.handoff is not None and (args.shards > 1 or args.node is not None):
+        parser.error("--handoff cannot be used with --shards or --node")
+    return args
+
+
+if __name__ == '__main__':
+    """
+    The main program, launches all the channels and handles any server commands.
+    """
+    args = parse_args()
+    mode = args.mode
+    outbox_limit = args.outbox_limit
+    slow_policy = args.slow_policy
+    queue_interval = args.queue_interval
+    coalesce_interval = args.coalesce_interval
+    coalesce_bytes = args.coalesce_bytes
+    fanout_threshold = args.fanout_threshold
+    fanout_threads = args.fanout_threads
+    flood_mute = args.flood_mute
+    compression_level = args.compression_level
+    handshake_timeout = args.handshake_timeout
+    accept_backlog = args.accept_backlog
+    history_lines = args.history_lines
+    history_bytes = args.history_bytes
+    history_replay = args.history_replay
+    log_dir = args.log_dir
+    log_interval = args.log_interval
+    log_segment_bytes = args.log_segment_bytes
+    handoff_path = args.handoff
+    if handoff_path is not None:
+        mode = EVENT
+    console = Console(level=chatconsole.LEVELS[args.console_level], style=args.console_format,
+                      capacity=args.console_queue)
+    raise_file_limit()
+    parse_config(args.config)
+    handoff = None
+    if args.takeover:
+        # Taken before the logs are opened, as the old server writes its own until then
+        handoff = take_over(handoff_path)
+    if log_dir is not None and args.shards <= 1:
+        open_logs()
+    command = server_command
+
+    if args.node is not None:
+        mode = EVENT
+        event_loop = EventLoop()
+        scheduler = Scheduler(event_loop.wake)
+        cluster = Node(args.node, args.cluster_port, args.peer)
+        for channel in channels:
+            event_loop.add_channel(channel)
+        cluster.start()
+        thread = threading.Thread(target=event_loop.run, daemon=True)
         thread.start()
+    elif args.shards > 1:
+        supervisor = Supervisor(args.shards)
+        supervisor.start()
+        command = supervisor.command
+    else:
+        event_loop = EventLoop()
+        scheduler = Scheduler(event_loop.wake)
+        if handoff is not None:
+            adopt(*handoff)
+        for channel in channels:
+            event_loop.add_channel(channel)
+        thread = threading.Thread(target=event_loop.run, daemon=True)
+        thread.start()
+        if handoff_path is not None:
+            threading.Thread(target=serve_handoff, args=(handoff_path,), daemon=True).start()
+
+    if args.metrics_port is not None:
+        chatmetrics.serve(args.metrics_port, supervisor.collect if args.shards > 1 and args.node is None
+                          else collect_metrics)
 
     running = True
 
     while running:
         try:
-            cmd = input("").split(" ")
-
-            # Disconnects the target client from the selected channel
-            if cmd[0] == "/kick":
-                channel, user = cmd[1].split(":")
-                channel = check_channel(channel)
-                if isinstance(channel, Channel):
-                    user = check_name(user, channel)
-                    if isinstance(user, Client):
-                        user.kick()
-                        channel.process_connection(REMOVE, user)
-                        user.status = DISCONNECTED
-                        user.conn.shutdown(socket.SHUT_RDWR)
-                        user.conn.close()
-                        print(f"[Server message ({time.strftime('%H:%M:%S')})] Kicked {user.get_name()}.", flush=True)
-                    else:
-                        print(f"[Server message ({time.strftime('%H:%M:%S')})] {user} is not in {channel.name}.",
-                              flush=True)
-                else:
-                    print(f"[Server message ({time.strftime('%H:%M:%S')})] {channel} does not exist.", flush=True)
-
-            # Mutes the target client in the selected channel
-            elif cmd[0] == "/mute":
-                channel, user = cmd[1].split(":")
-                duration = cmd[2].strip('\n')
-                channel = check_channel(channel)
-                if isinstance(channel, Channel):
-                    user = check_name(user, channel)
-                    if isinstance(user, Client):
-                        if duration.isdigit():
-                            if int(duration) > 0:
-                                user.conn.sendall(f"[Server message ({time.strftime('%H:%M:%S')})] "
-                                                  f"You have been muted for {duration} seconds.\n".encode('ascii'))
-                                print(f"[Server message ({time.strftime('%H:%M:%S')})] Muted {user.get_name()} for "
-                                      f"{duration} seconds.", flush=True)
-
-                                # Separate thread to track how long the client is muted for
-                                mute = threading.Thread(target=user.mute(int(duration)), daemon=True)
-                                mute.start()
-                                continue
-                        print(f"[Server message ({time.strftime('%H:%M:%S')})] Invalid mute time.", flush=True)
-                        continue
-                print(f"[Server message ({time.strftime('%H:%M:%S')})] {user} is not here.", flush=True)
-
-            # Disconnects all connected and in queue clients for the given channel
-            elif cmd[0] == "/empty":
-                channel = cmd[1].strip('\n')
-                channel = check_channel(channel)
-                if isinstance(channel, Channel):
-                    for client in channel.queue[:]:
-                        client.update_status(DISCONNECTED)
-                        client.conn.shutdown(socket.SHUT_RDWR)
-                        client.conn.close()
-                    for client in channel.connected[:]:
-                        client.update_status(DISCONNECTED)
-                        client.conn.shutdown(socket.SHUT_RDWR)
-                        client.conn.close()
-                    channel.connected = []
-                    channel.queue = []
-                    print(f"[Server message ({time.strftime('%H:%M:%S')})] {channel.name} has been emptied.",
-                          flush=True)
-                    continue
-                print(f"[Server message ({time.strftime('%H:%M:%S')})] {channel} does not exist.", flush=True)
-
-            # Shut down entire server including all channels
-            elif cmd[0] == "/shutdown":
-                for channel in channels:
-                    for client in channel.queue[:]:
-                        client.update_status(DISCONNECTED)
-                    for client in channel.connected[:]:
-                        client.update_status(DISCONNECTED)
-                    channel.disconnect()
-                running = False
+            running = command(input("").split(" "))
         except:
             continue
-
+    console.close()